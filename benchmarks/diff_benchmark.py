@@ -0,0 +1,73 @@
+"""
+Compares the diff engine in parrotfish.utils.diff with the previous
+implementation (difflib.unified_diff over the whole file) on synthetic
+protocol files of increasing size, with a single edited region (the usual
+case when pushing after a save) and with edits scattered over the file.
+
+Usage::
+
+    python benchmarks/diff_benchmark.py [--repeat 3]
+"""
+
+import argparse
+import difflib
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parrotfish.utils.diff import (color_diff, compare_content,  # noqa: E402
+                                   content_equal)
+
+
+def legacy_compare_content(content1, content2):
+    """The implementation of compare_content before the fast path"""
+    lines1 = content1.split('\n')
+    lines2 = content2.split('\n')
+    diff = color_diff(difflib.unified_diff(lines1, lines2))
+    return ''.join(diff)
+
+
+def make_protocol(num_lines, edits, seed=0):
+    """Returns a protocol-like file and a copy with edited lines"""
+    rng = random.Random(seed)
+    words = ['show', 'take', 'release', 'operations', 'input', 'output',
+             'item', 'collection', 'volume', 'note', 'check', 'end']
+    lines = ["  {} {} {}".format(rng.choice(words), rng.choice(words), i)
+             for i in range(num_lines)]
+    edited = list(lines)
+    for _ in range(edits):
+        i = rng.randrange(num_lines)
+        edited[i] = edited[i] + " # edited"
+    return '\n'.join(lines), '\n'.join(edited)
+
+
+def best_of(fxn, repeat):
+    return min(timeit.repeat(fxn, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for edits in (1, 20):
+        print("\n{} edited line(s)".format(edits))
+        print("{:>8} {:>12} {:>12} {:>12} {:>12}".format(
+            'lines', 'legacy (ms)', 'diff (ms)', 'equal (ms)', 'speedup'))
+        for num_lines in (100, 1000, 10000, 50000):
+            old, new = make_protocol(num_lines, edits)
+            copy = ''.join(list(old))
+            legacy = best_of(lambda: legacy_compare_content(old, new),
+                             args.repeat)
+            current = best_of(lambda: compare_content(old, new), args.repeat)
+            equal = best_of(lambda: content_equal(old, copy), args.repeat)
+            print("{:>8} {:>12.2f} {:>12.2f} {:>12.4f} {:>11.1f}x".format(
+                num_lines, legacy * 1000, current * 1000, equal * 1000,
+                legacy / current))
+
+
+if __name__ == '__main__':
+    main()
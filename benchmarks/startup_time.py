@@ -0,0 +1,104 @@
+"""
+Measures how long trivial `pfish` commands take to start.
+
+Runs each command in a fresh interpreter several times and reports the median
+wall time, then uses `python -X importtime` to list the slowest imports and
+any heavy module that was imported. Exits with a non-zero status if a
+command exceeds the time budget or imports a heavy module.
+
+Usage::
+
+    python benchmarks/startup_time.py [--budget 0.15] [--runs 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# commands that should not need the full environment
+COMMANDS = ['repo', 'sessions']
+
+# modules that trivial commands must not import
+HEAVY_MODULES = ['pydent', 'dill', 'cryptography', 'prompt_toolkit', 'fire',
+                 'opath', 'inflection', 'requests']
+
+RUN_COMMAND = "import sys; sys.argv = ['pfish'] + sys.argv[1:]; " \
+              "from parrotfish.core import run; run()"
+
+
+def run_command(command, importtime=False):
+    """Runs a pfish command in a new interpreter and returns the process"""
+    args = [sys.executable]
+    if importtime:
+        args += ['-X', 'importtime']
+    args += ['-c', RUN_COMMAND, command]
+    path = [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+    return subprocess.run(args, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, env=env,
+                          universal_newlines=True)
+
+
+def time_command(command, runs):
+    """Returns the median wall time of a command in seconds"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_command(command)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def parse_importtime(stderr):
+    """Returns (cumulative microseconds, module) for each imported module"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, module = line.split('|', 2)
+        imports.append((int(cumulative_us), module.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--budget', type=float, default=0.15,
+                        help='maximum median seconds per command')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest imports to list')
+    args = parser.parse_args()
+
+    failed = False
+    for command in COMMANDS:
+        elapsed = time_command(command, args.runs)
+        process = run_command(command, importtime=True)
+        if process.returncode != 0:
+            print("pfish {}: FAILED\n{}".format(
+                command, process.stderr.splitlines()[-1]))
+            failed = True
+            continue
+        imports = parse_importtime(process.stderr)
+        heavy = sorted({module for _, module in imports
+                        if module.split('.')[0] in HEAVY_MODULES})
+        over_budget = elapsed > args.budget
+
+        print("pfish {}: {:.1f} ms (budget {:.0f} ms){}".format(
+            command, elapsed * 1000, args.budget * 1000,
+            " OVER BUDGET" if over_budget else ""))
+        for cumulative_us, module in sorted(imports, reverse=True)[:args.top]:
+            print("    {:>8.1f} ms  {}".format(cumulative_us / 1000, module))
+        if heavy:
+            print("    heavy imports: {}".format(', '.join(heavy)))
+        failed = failed or over_budget or bool(heavy)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
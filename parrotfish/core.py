@@ -3,19 +3,21 @@ Core functions for interacting with ParrotFish
 """
 
 import os
-import tempfile
+import sys
+import threading
+import time
+from itertools import chain
 from pathlib import Path
 
-from opath.utils import rmtree, copytree
-
-import fire
-from cryptography.fernet import Fernet
 from colorama import Fore
-from parrotfish.session_environment import SessionManager
-from parrotfish.utils import (CustomLogging, docker_testing,
-                              format_json, compare_content)
-from parrotfish.shell import Shell
-from requests.exceptions import InvalidSchema
+from parrotfish.launcher import run_quick
+from parrotfish.utils import CustomLogging, format_json, content_equal, Diff
+from parrotfish.utils import sync
+from parrotfish.utils.watch import PollingWatcher
+from parrotfish.utils.workers import imap_ordered
+
+# pydent, opath, fire, cryptography and prompt_toolkit are slow to import and
+# are only imported by the commands that need them (see `run`)
 
 logger = CustomLogging.get_logger(__name__)
 logger.setLevel("VERBOSE")
@@ -38,7 +40,7 @@ class CLI(object):
                 "You must be logged in. Register an Aquarium session.")
 
     def _save(self):
-        """Saves the environment"""
+        """Saves the environment if anything changed"""
         self._session_manager.save()
 
     def session(self):
@@ -48,16 +50,16 @@ class CLI(object):
     def _sessions_json(self):
         """Returns a dictionary of sessions"""
         sess_dict = {}
-        for session_name, session in self._session_manager.sessions.items():
-            val = str(session)
-            sess_dict[session_name] = val
+        for session_env in self._session_manager.session_env_list:
+            sess_dict[session_env.name] = str(session_env)
         return sess_dict
 
     def _get_categories(self):
         """Returns dictionary of category names and Library/OperationType"""
         categories = {}
-        operation_types = self.session.OperationType.all()
-        libraries = self._session_manager.current_session.Library.all()
+        session = self._session_manager.current_session
+        operation_types = session.OperationType.all()
+        libraries = session.Library.all()
         for ot in operation_types:
             category_list = categories.get(ot.category, [])
             category_list.append(ot)
@@ -75,7 +77,6 @@ class CLI(object):
             logger.cli("Environment file loaded from \"{}\"".format(
                 self._session_manager.metadata.env_settings.abspath))
             logger.cli("environment loaded")
-            self._save()
             self.print_env()
             return self._session_manager
         except Exception:
@@ -84,101 +85,668 @@ class CLI(object):
     def print_env(self):
         logger.cli(str(self._session_manager))
 
-    def push_all(self):
-        """Save protocol"""
-        self._check_for_session()
+    def push_all(self, workers=1):
+        """
+        Push every :class:`OperationType` and :class:`Library` in the current
+        session.
+
+        :param workers: number of protocols to push concurrently
+        :type workers: int
+        """
+        # the session only logs in if something needs to be pushed
         current_env = self._session_manager.current_env
-        categories = current_env.categories
-        for cat in categories:
-            self.push_category(cat)
+        if current_env is None:
+            raise Exception(
+                "You must be logged in. Register an Aquarium session.")
+        protocols = [protocol for cat in current_env.categories
+                     for protocol in cat.list_dirs()]
+        self._push_protocols(current_env, protocols, workers=workers)
 
-    def push_category(self, category_name):
+    def push_category(self, category_name, force=False, workers=1):
         """
         Push all :class:`OperationType` and :class:`Library` in a category.
+
+        :param category_name: category to push
+        :type category_name: str
+        :param force: push even if the server version changed
+        :type force: bool
+        :param workers: number of protocols to push concurrently
+        :type workers: int
         """
         current_env = self._session_manager.current_env
         category = current_env.get_category_dir(category_name)
-        for protocol in category.list_dirs():
-            self.push_one(category.name, protocol.name)
+        self._push_protocols(current_env, category.list_dirs(), force=force,
+                             workers=workers)
 
     def push_one(self, category_name, protocol_name, force=False):
+        """
+        Push a single :class:`OperationType` or :class:`Library`. Only code
+        files whose content changed since they were last fetched or pushed
+        are sent to the server unless force is set.
+        """
         current_env = self._session_manager.current_env
-        category = current_env.get_category_dir(category_name)
         protocol = current_env.get_protocol_dir(category_name, protocol_name)
-        if protocol.has("source"):
-            # then its a Library
-            local_lib = current_env.read_library_type(
-                category.name, protocol.name)
-            local_lib.code("source").update()
-        if protocol.has("protocol"):
-            # then its an OperationType
-            local_ot = current_env.read_operation_type(
-                category.name, protocol.name)
-            # TODO: unify accessing this list - used elsewhere
-            for accessor in ['protocol', 'precondition',
-                             'documentation', 'cost_model']:
-                code = getattr(local_ot, accessor)
-                server_code = local_ot.code(accessor)
-
-                diff_str = compare_content(
-                    server_code.content, code.content).strip()
-                if diff_str != '':
-                    # Local change, so fetch remote and compare
-                    remote_ot = self.session.OperationType.where(
-                        {"category": category.name, "name": protocol.name})[0]
-                    remote_code = getattr(remote_ot, accessor)
-                    if code.id != remote_code.id and force is False:
-                        msg = "Local version of {}/{} ({}) out of date. "
-                        "Please fetch before pushing again"
-                        logger.cli(Fore.RED + msg.format(
-                            category.name, protocol.name, accessor))
+        self._push_protocols(current_env, [protocol], force=force)
+
+    def watch(self, force=False, interval=0.5, debounce=0.5):
+        """
+        Watch the current session's protocols and push code files as they
+        are saved. Only the protocols whose files changed are pushed, and
+        only the code that differs from what was last fetched or pushed is
+        sent to the server. Stop with Ctrl-C.
+
+        :param force: push even if the server version changed
+        :type force: bool
+        :param interval: seconds between checks for modified files
+        :type interval: float
+        :param debounce: seconds to wait for a burst of saves to finish
+        :type debounce: float
+        """
+        self._check_for_session()
+        env = self._session_manager.current_env
+        watcher = PollingWatcher(env.protocols.abspath, interval=interval,
+                                 debounce=debounce)
+        logger.cli("Watching {} for changes. Press Ctrl-C to stop.".format(
+            env.protocols.abspath))
+        try:
+            for paths in watcher.batches():
+                protocols = []
+                for path in paths:
+                    found = env.protocol_dir_for_file(path)
+                    if found is None:
+                        continue
+                    protocol, accessor = found
+                    logger.cli("Changed {}/{} ({})".format(
+                        protocol.parent.name, protocol.name, accessor))
+                    if protocol not in protocols:
+                        protocols.append(protocol)
+                if protocols:
+                    self._push_protocols(env, protocols, force=force)
+        except KeyboardInterrupt:
+            logger.cli("Stopped watching")
+
+    # outcomes of pushing a protocol, in the order they are summarized
+    PUSH_STATUSES = ('updated', 'skipped', 'conflicted', 'failed')
+
+    def _push_protocols(self, env, protocols, force=False, workers=1):
+        """
+        Pushes locally modified code of many protocols.
+
+        Local changes are detected from file hashes without contacting the
+        server. The current server code of every modified protocol is then
+        retrieved in bulk and used to decide, per code file, whether to push
+        it or report that the local version is out of date. Libraries are
+        pushed before OperationTypes so dependents never run against an old
+        library. Within each stage, protocols are pushed by a bounded pool of
+        workers.
+
+        :param env: session environment containing the protocols
+        :type env: SessionEnvironment
+        :param protocols: protocol directories
+        :type protocols: list
+        :param force: push every code file even if the server version changed
+        :type force: bool
+        :param workers: number of protocols to push concurrently
+        :type workers: int
+        :return: dictionary of status to protocol names
+        :rtype: dict
+        """
+        from parrotfish.utils.transport import get_transport
+        get_transport().ensure_pool_size(workers)
+        summary = {status: [] for status in self.PUSH_STATUSES}
+        candidates = []
+        for protocol in protocols:
+            if force:
+                changed = env.code_accessors(protocol)
+            else:
+                changed = env.changed_code(protocol)
+            if changed:
+                candidates.append((protocol, changed))
+            else:
+                name = "{}/{}".format(protocol.parent.name, protocol.name)
+                logger.cli("-- No changes for {}".format(name))
+                summary['skipped'].append(name)
+
+        if candidates:
+            jobs = []
+            for protocol, changed in candidates:
+                model_class = "Library" if protocol.has("source") \
+                    else "OperationType"
+                try:
+                    meta = protocol.meta.load_json()
+                    meta['id']
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    # a broken protocol does not prevent pushing the others
+                    name = "{}/{}".format(protocol.parent.name, protocol.name)
+                    logger.cli(Fore.RED + "Failed to read {}: {!r}".format(
+                        name, e))
+                    summary['failed'].append(name)
+                    continue
+                jobs.append((protocol, changed, model_class, meta))
+            snapshot = sync.latest_codes_by_key(
+                self._session_manager.current_session,
+                [(job[2], job[3]['id']) for job in jobs])
+
+            def push(job):
+                protocol, changed, model_class, meta = job
+                return self._push_protocol(
+                    env, protocol, changed, model_class, meta,
+                    snapshot[(model_class, meta['id'])], force)
+
+            # libraries first, then the OperationTypes that depend on them
+            for stage in ("Library", "OperationType"):
+                stage_jobs = [job for job in jobs if job[2] == stage]
+                for result in imap_ordered(push, stage_jobs, workers=workers):
+                    protocol = result.item[0]
+                    name = "{}/{}".format(protocol.parent.name, protocol.name)
+                    if result.ok:
+                        status, messages = result.value
+                        for emit, msg in messages:
+                            emit(msg)
                     else:
-                        logger.cli(
-                            "++ Updating {}/{} ({})".format(category.name,
-                                                            local_ot.name,
-                                                            accessor))
-                        print(diff_str)
-                        code.update()
-                else:
-                    logger.cli(
-                        "-- No changes for {}/{} ({})".format(category.name,
-                                                              local_ot.name,
-                                                              accessor))
-            self._save()
-
-    def _get_operation_types_from_sever(self, category):
-        return self._session_manager.current_session.OperationType.where(
-            {"category": category})
-
-    def _get_library_types_from_server(self, category):
-        return self._session_manager.current_session.Library.where(
-            {"category": category})
-
-    def fetch(self, category):
+                        status = 'failed'
+                        logger.cli(Fore.RED + "Failed to push {}: {}".format(
+                            name, result.error))
+                    summary[status].append(name)
+            env.get_sync_manifest().save()
+
+        self._log_push_summary(summary)
+        return summary
+
+    @staticmethod
+    def _log_push_summary(summary):
+        """Logs the number of protocols with each push status"""
+        logger.cli(", ".join("{} {}".format(len(summary[status]), status)
+                             for status in CLI.PUSH_STATUSES))
+        for status in ('conflicted', 'failed'):
+            for name in summary[status]:
+                logger.cli(Fore.RED + "  {}: {}".format(status, name))
+
+    @staticmethod
+    def _push_protocol(env, protocol, accessors, model_class, meta,
+                       remote_codes, force=False):
+        """
+        Pushes code files of a single protocol using a snapshot of the
+        current server code. Messages are returned rather than logged so
+        concurrent pushes can be reported in a deterministic order.
+
+        :param env: session environment containing the protocol
+        :type env: SessionEnvironment
+        :param protocol: protocol directory
+        :type protocol: ODir
+        :param accessors: code accessors to push
+        :type accessors: list
+        :param model_class: 'OperationType' or 'Library'
+        :type model_class: str
+        :param meta: local metadata of the protocol
+        :type meta: dict
+        :param remote_codes: dictionary of accessor to current server Code
+        :type remote_codes: dict
+        :param force: push even if the server version changed
+        :type force: bool
+        :return: push status ('updated', 'skipped' or 'conflicted') and a
+                 list of (output function, message) pairs
+        :rtype: tuple
+        """
+        manifest = env.get_sync_manifest()
+        entry = manifest.get(model_class, meta['id']) or {}
+        hashes = env.code_hashes(protocol)
+        path = env.protocol_path(protocol)
+        name = "{}/{}".format(protocol.parent.name, protocol.name)
+        messages = []
+        updated = conflicted = False
+        local_model = None
+        for accessor in accessors:
+            content = protocol.get(accessor).read()
+            remote_code = remote_codes.get(accessor)
+            if remote_code is None:
+                # no code on the server yet, so push the local code
+                if local_model is None:
+                    local_model = env.read_protocol(protocol)
+                messages.append(
+                    (logger.cli, "++ Creating {} ({})".format(name, accessor)))
+                code = getattr(local_model, accessor)
+                code.update()
+                updated = True
+                manifest.record_code(model_class, meta['id'], accessor,
+                                     code.id, hashes[accessor], path=path)
+                continue
+
+            # code id the local file is based on
+            base_id = entry.get('codes', {}).get(accessor, {}).get('id')
+            if base_id is None:
+                base_id = (meta.get(accessor) or {}).get('id')
+
+            if content_equal(remote_code.content, content):
+                messages.append(
+                    (logger.cli,
+                     "-- No changes for {} ({})".format(name, accessor)))
+            elif base_id != remote_code.id and force is False:
+                msg = "Local version of {} ({}) out of date. " \
+                      "Please fetch before pushing again"
+                messages.append(
+                    (logger.cli, Fore.RED + msg.format(name, accessor)))
+                conflicted = True
+                continue
+            else:
+                messages.append(
+                    (logger.cli, "++ Updating {} ({})".format(name, accessor)))
+                # rendered only when the message is printed
+                messages.append((print, Diff(remote_code.content, content)))
+                remote_code.content = content
+                remote_code.update()
+                updated = True
+            manifest.record_code(model_class, meta['id'], accessor,
+                                 remote_code.id, hashes[accessor], path=path)
+
+        if conflicted:
+            status = 'conflicted'
+        elif updated:
+            status = 'updated'
+        else:
+            status = 'skipped'
+        return status, messages
+
+    # how each status is described by `status`
+    STATUS_TITLES = {
+        'local_modified': "Modified locally (push to update the server)",
+        'remote_modified': "Modified on the server (fetch to update)",
+        'conflicting': "Modified locally and on the server",
+        'unsynced': "Different from the server, never fetched or pushed "
+                    "with this version",
+        'local_only': "Only on the local machine",
+        'remote_only': "Only on the server",
+    }
+
+    def status(self):
+        """
+        Compare every protocol of the current session with the server and
+        list the protocols modified locally, modified on the server,
+        modified on both sides, or missing on either side.
+        """
+        self._check_for_session()
+        env = self._session_manager.current_env
+        session = self._session_manager.current_session
+        remote = list(session.OperationType.all()) + \
+            list(session.Library.all())
+        snapshot = sync.latest_codes_for(session, remote)
+        report = sync.session_status(env.local_protocols(), remote, snapshot,
+                                     env.get_sync_manifest())
+        for status in sync.STATUSES:
+            if report[status]:
+                logger.cli("{}:".format(self.STATUS_TITLES[status]))
+                for name in report[status]:
+                    logger.cli("    {}".format(name))
+        logger.cli(", ".join("{} {}".format(len(report[status]), status)
+                             for status in ('clean',) + sync.STATUSES))
+        return report
+
+    @staticmethod
+    def _protocol_pages(session, category=None, page_size=50):
+        """
+        Lists the OperationTypes and then the Libraries of a category (or of
+        every category if category is None) one page at a time
+
+        :param session: Aquarium session
+        :type session: AqSession
+        :param category: category to list or None
+        :type category: str
+        :param page_size: number of protocols listed per query
+        :type page_size: int
+        :return: generator of lists of OperationTypes and Libraries
+        :rtype: generator
+        """
+        query = {} if category is None else {"category": category}
+        return chain(
+            sync.iter_pages(session.OperationType, query, page_size),
+            sync.iter_pages(session.Library, query, page_size))
+
+    def fetch(self, category=None, workers=1, force=False,
+              cache_records=False, shared_records=False, page_size=50,
+              all=False):
         """
         Fetch protocols from the current session and category and pull to local
-        repo.
+        repo. Protocols whose code has not changed on the server since the
+        last fetch are skipped unless force is set. Sample and object types
+        shared by several protocols are loaded and serialized once.
+        Protocols are listed `page_size` at a time and written as soon as
+        their page arrives, so memory use does not grow with the size of the
+        category. With `--all`, every category is listed and written in a
+        single run.
+
+        :param category: category to fetch
+        :type category: str
+        :param workers: number of protocols to fetch concurrently
+        :type workers: int
+        :param force: fetch every protocol, even unchanged ones
+        :type force: bool
+        :param cache_records: keep serialized sample and object types in the
+                              session folder for the next fetch
+        :type cache_records: bool
+        :param shared_records: store one copy of each sample and object type
+                               per session and hard link it into the
+                               protocol folders
+        :type shared_records: bool
+        :param page_size: number of protocols listed per query
+        :type page_size: int
+        :param all: fetch every category
+        :type all: bool
         """
+        if all == (category is not None):
+            logger.error("Specify either a category or --all")
+            return
         self._check_for_session()
-        ots = self._get_operation_types_from_sever(category)
-        libs = self._get_library_types_from_server(category)
-        logger.cli("{} operation_types found".format(len(ots)))
-        logger.cli("This may take awhile...")
-        for ot in ots:
-            logger.cli("Saving {}".format(ot.name))
-            curr_env = self._session_manager.current_env
-            curr_env.write_operation_type(ot)
-        for lib in libs:
-            logger.cli("Saving {}".format(lib.name))
-            curr_env = self._session_manager.current_env
-            curr_env.write_library(lib)
-        self._save()
+        session = self._session_manager.current_session
+        pages = self._protocol_pages(session, category, page_size)
+        summary = self._fetch_models(
+            self._session_manager.current_env, session, pages, workers,
+            force, cache_records, shared_records)
+        if all:
+            logger.cli(format_json(summary['categories']))
+
+    def fetch_sessions(self, *sessions, category=None, all=False, workers=1,
+                       force=False, cache_records=False, shared_records=False,
+                       page_size=50):
+        """
+        Fetch a category (or every category with `--all`) from several
+        registered sessions concurrently, each into its own session folder.
+        Every session is fetched by its own worker with its own pool of
+        `workers` threads, and a combined report is printed at the end.
+
+        :param sessions: names of the sessions to fetch (all registered
+                         sessions if none are given)
+        :type sessions: str
+        :param category: category to fetch
+        :type category: str
+        :param all: fetch every category
+        :type all: bool
+        :param workers: number of protocols to fetch concurrently per session
+        :type workers: int
+        :param force: fetch every protocol, even unchanged ones
+        :type force: bool
+        :param cache_records: keep serialized sample and object types in the
+                              session folders for the next fetch
+        :type cache_records: bool
+        :param shared_records: store one copy of each sample and object type
+                               per session and hard link it into the
+                               protocol folders
+        :type shared_records: bool
+        :param page_size: number of protocols listed per query
+        :type page_size: int
+        """
+        if all == (category is not None):
+            logger.error("Specify either a category or --all")
+            return
+        registered = self._session_manager.sessions
+        names = list(sessions) or sorted(registered.keys())
+        if not names:
+            logger.cli("There are no sessions. "
+                       "Use 'pfish register' to register a session.")
+            return
+        unknown = [name for name in names if name not in registered]
+        if unknown:
+            logger.error("Session(s) {} not in available sessions ({})".format(
+                ', '.join(unknown), ', '.join(registered.keys())))
+            return
+        envs = [self._session_manager.get(name) for name in names]
+        logger.cli("Fetching {} from {}".format(
+            "all categories" if all else "\"{}\"".format(category),
+            ', '.join(names)))
+
+        def fetch_session(env):
+            session = env.aquarium_session
+            if session is None:
+                raise Exception("Could not log in to \"{}\"".format(
+                    env.name))
+            # lines of concurrent sessions are interleaved
+            return self._fetch_models(
+                env, session,
+                self._protocol_pages(session, category, page_size),
+                workers, force, cache_records, shared_records,
+                prefix="[{}] ".format(env.name))
+
+        results = list(imap_ordered(fetch_session, envs, workers=len(envs)))
+        self._log_fetch_sessions_report(results)
+
+    @staticmethod
+    def _log_fetch_sessions_report(results):
+        """Logs the outcome of fetching each session"""
+        logger.cli("Fetch report:")
+        for result in results:
+            name = result.item.name
+            if not result.ok:
+                logger.cli(Fore.RED + "  {}: failed ({})".format(
+                    name, result.error))
+                continue
+            summary = result.value
+            line = "  {}: {} listed, {} changed, {} saved, {} failed " \
+                   "({:.1f}s)".format(name, summary['listed'],
+                                      summary['changed'], summary['saved'],
+                                      len(summary['failures']),
+                                      result.elapsed)
+            if summary['failures']:
+                line = Fore.RED + line
+            logger.cli(line)
+
+    @classmethod
+    def _fetch_models(cls, env, session, pages, workers=1, force=False,
+                      cache_records=False, shared_records=False, prefix=''):
+        """
+        Writes only the OperationTypes and Libraries that changed on the
+        server since they were last recorded in the environment's sync
+        manifest. Models are consumed one page at a time and each written
+        model is released once it is recorded in the manifest.
+
+        :param env: session environment to write to
+        :type env: SessionEnvironment
+        :param session: session the models were listed from
+        :type session: AqSession
+        :param pages: lists of OperationTypes and Libraries listed from the
+                      server (see :func:`sync.iter_pages`)
+        :type pages: iterable
+        :param workers: number of models to write concurrently
+        :type workers: int
+        :param force: write every model, even unchanged ones
+        :type force: bool
+        :param cache_records: persist the record cache in the environment
+        :type cache_records: bool
+        :param shared_records: link records from the environment's record
+                               store
+        :type shared_records: bool
+        :param prefix: text logged before every line
+        :type prefix: str
+        :return: number of listed, changed and saved models, the failures and
+                 the number of listed models by category
+        :rtype: dict
+        """
+        manifest = env.get_sync_manifest()
+        summary = {'listed': 0, 'changed': 0, 'saved': 0, 'failures': [],
+                   'categories': {}}
+        # latest codes of the models being written, released once recorded
+        snapshot = {}
+
+        def stale_models():
+            for page in pages:
+                codes_by_key = sync.latest_codes_for(session, page)
+                summary['listed'] += len(page)
+                for model in page:
+                    categories = summary['categories']
+                    categories[model.category] = \
+                        categories.get(model.category, 0) + 1
+                    key = (model.__class__.__name__, model.id)
+                    if force or not env.get_model_dir(model).meta.exists() \
+                            or not manifest.is_current(model,
+                                                       codes_by_key[key]):
+                        snapshot[key] = codes_by_key[key]
+                        summary['changed'] += 1
+                        yield model
+
+        env.reset_tag_table()
+        env.reset_record_cache(persist=cache_records)
+        record_store = env.set_record_store(shared_records)
+        file_writer = env.get_file_writer()
+        file_writer.reset()
+        try:
+            for result in cls._write_models(env, stale_models(), workers,
+                                            prefix, snapshot):
+                model = result.item
+                codes = snapshot.pop((model.__class__.__name__, model.id))
+                if not result.ok:
+                    summary['failures'].append(result)
+                    continue
+                summary['saved'] += 1
+                model_dir = env.get_model_dir(model)
+                manifest.record(model, codes,
+                                path=env.protocol_path(model_dir),
+                                hashes=env.code_hashes(model_dir))
+        finally:
+            # protocols written before an interruption are not fetched again
+            manifest.save()
+            env.get_record_cache().save()
+        if record_store is not None:
+            record_store.prune()
+
+        logger.cli(prefix + "{} of {} protocols changed since last fetch"
+                   .format(summary['changed'], summary['listed']))
+        if summary['changed']:
+            logger.cli(prefix + "{} file(s) modified, {} unchanged".format(
+                file_writer.modified, file_writer.unchanged))
+        cls._log_fetch_failures(summary['failures'], prefix)
+        return summary
+
+    @staticmethod
+    def _write_models(env, models, workers=1, prefix='', snapshot=None):
+        """
+        Writes OperationTypes and Libraries to a session environment using a
+        bounded pool of workers. Models are taken from `models` lazily and
+        the results are yielded in the order the models were given, with
+        progress logged as they are consumed. Failures are yielded as results
+        rather than aborting the remaining writes. Codes found in `snapshot`
+        are written as is instead of being loaded again.
+
+        :param env: session environment to write to
+        :type env: SessionEnvironment
+        :param models: OperationTypes and Libraries to write
+        :type models: iterable
+        :param workers: number of models to write concurrently
+        :type workers: int
+        :param prefix: text logged before every line
+        :type prefix: str
+        :param snapshot: latest codes by (model class name, id), as returned
+                         by :func:`sync.latest_codes_for`
+        :type snapshot: dict
+        :return: generator of results
+        :rtype: generator
+        """
+        from parrotfish.utils.transport import get_transport
+        get_transport().ensure_pool_size(workers)
+        snapshot = snapshot or {}
+
+        def write(model):
+            return env.write_model(model, codes=snapshot.get(
+                (model.__class__.__name__, model.id)))
+
+        def register(models):
+            # directory tree is only modified by the consuming thread
+            for model in models:
+                env.get_model_dir(model)
+                yield model
+
+        for result in imap_ordered(write, register(models),
+                                   workers=workers):
+            model = result.item
+            if result.ok:
+                logger.cli(prefix + "Saving {}".format(model.name))
+            else:
+                logger.cli(Fore.RED + prefix + "Failed to save {}/{}".format(
+                    model.category, model.name))
+            yield result
+
+    @staticmethod
+    def _log_fetch_failures(failures, prefix=''):
+        """Logs the models that could not be written"""
+        if not failures:
+            return
+        logger.cli(Fore.RED + prefix + "{} protocol(s) failed:".format(
+            len(failures)))
+        for result in failures:
+            logger.cli(Fore.RED + prefix + "  {}/{}: {}".format(
+                result.item.category, result.item.name, result.error))
 
     def test(self, category_name, protocol_name, reset=False):
         """ Test a single protocol on an Aquarium Docker container """
-        session = self._session_manager.current_session
-        session_name = session.name
+        self._test_protocols(category_name, [protocol_name], reset=reset)
+
+    def test_protocols(self, category_name, *protocol_names, workers=4,
+                       reset=False):
+        """
+        Test several protocols of a category on one Aquarium Docker
+        container. The container and docker session are set up once, then
+        the test data of up to `workers` protocols is loaded and their plans
+        are run concurrently. A pass/fail and timing report is printed at
+        the end.
+
+        :param category_name: category of the protocols
+        :type category_name: str
+        :param protocol_names: names of the OperationTypes to test
+        :type protocol_names: str
+        :param workers: number of protocols to test concurrently
+        :type workers: int
+        :param reset: restart the container
+        :type reset: bool
+        """
+        self._test_protocols(category_name, protocol_names, workers, reset)
 
+    def test_category(self, category_name, workers=4, reset=False):
+        """
+        Test every OperationType of a category that has test data on one
+        Aquarium Docker container (see `test_protocols`).
+
+        :param category_name: category to test
+        :type category_name: str
+        :param workers: number of protocols to test concurrently
+        :type workers: int
+        :param reset: restart the container
+        :type reset: bool
+        """
+        env = self._session_manager.current_env
+        env.collect()
+        protocol_names = [
+            protocol.name
+            for protocol in env.get_category_dir(category_name).list_dirs()
+            if os.path.isfile(os.path.join(str(protocol.abspath),
+                                           'testing', 'data.json'))]
+        if not protocol_names:
+            logger.cli("No protocols with test data in \"{}\"".format(
+                category_name))
+            return
+        self._test_protocols(category_name, protocol_names, workers, reset)
+
+    def _test_protocols(self, category_name, protocol_names, workers=1,
+                        reset=False):
+        """
+        Tests OperationTypes of the current session on an Aquarium Docker
+        container.
+
+        :param category_name: category of the protocols
+        :type category_name: str
+        :param protocol_names: names of the OperationTypes to test
+        :type protocol_names: list
+        :param workers: number of protocols to test concurrently
+        :type workers: int
+        :param reset: restart the container
+        :type reset: bool
+        :return: results of the tests
+        :rtype: list
+        """
+        source_env = self._session_manager.current_env
+        session_name = source_env.name
+        # fail early on unknown protocols
+        protocol_names = [
+            source_env.get_protocol_dir(category_name, name).name
+            for name in protocol_names]
+
+        start = time.perf_counter()
         try:
             # Start container
             self.start_container(reset)
@@ -192,73 +760,159 @@ class CLI(object):
                 "docker")
             self.set_session("docker")
 
-            # Copy OT from last session to container session
+            # Copy OTs from last session to container session
             logger.cli(
-                "Copying protocol from {} to docker session".format(
-                    session_name))
-            ot = session.OperationType.find_by_name(protocol_name)
-            self._copy_operation_type(session_name, "docker", ot)
-
-            # Load data to container
-            logger.cli("Loading test data into container")
-            current_env = self._session_manager.current_env
-            protocol = current_env.get_protocol_dir(
-                category_name, protocol_name)
-            testing_data = docker_testing.load_data(protocol)
-
-            # Push OT from container session to container
-            logger.cli("Pushing protocol: {}".format(protocol_name))
-            current_env.write_operation_type(testing_data['ot'], no_code=True)
-            self.push_one(category_name, protocol_name, force=True)
-
-            # Test protocol on container
-            logger.cli("Testing protocol: {}".format(protocol_name))
-            result = docker_testing.test_protocol(protocol, testing_data)
-
+                "Copying {} protocol(s) from {} to docker session".format(
+                    len(protocol_names), session_name))
+            protocols = self._copy_operation_types(
+                session_name, "docker", category_name, protocol_names)
+
+            docker_env = self._session_manager.current_env
+            # adding the manifest file changes the directory tree, so it is
+            # created before the workers start
+            docker_env.get_sync_manifest()
+            write_lock = threading.Lock()
+
+            # protocols of a category share most sample and object types;
+            # create them once rather than from several workers at a time
+            from parrotfish.utils import docker_testing
+            docker_testing.load_shared_records(protocols)
+
+            def run(protocol):
+                return self._test_protocol(docker_env, protocol, write_lock)
+
+            from parrotfish.utils.transport import get_transport
+            get_transport().ensure_pool_size(workers)
+            results = []
+            for result in imap_ordered(run, protocols, workers=workers):
+                status = "passed" if result.ok and result.value['success'] \
+                    else "failed"
+                logger.cli("Tested {}: {}".format(result.item.name, status))
+                results.append(result)
+        finally:
             # Remove container session
             logger.cli("Unregistering Docker session")
             self.unregister("docker")
             self.set_session(session_name)
 
-            logger.cli("Plan success: {}".format(result['success']))
-            logger.cli("View plan: {}".format(result['plan_url']))
-        except Exception:
-            self.unregister("docker")
-            self.set_session(session_name)
-            raise
+        self._log_test_report(category_name, results,
+                              time.perf_counter() - start)
+        return results
+
+    def _test_protocol(self, env, protocol, write_lock):
+        """
+        Loads the test data of a protocol into the container, pushes its
+        code and runs its test plan
+
+        :param env: docker session environment
+        :type env: SessionEnvironment
+        :param protocol: directory of the OperationType
+        :type protocol: ODir
+        :param write_lock: lock serializing every step that changes the
+                           directory tree
+        :type write_lock: threading.Lock
+        :return: plan information and the time taken by each step
+        :rtype: dict
+        """
+        from parrotfish.utils import docker_testing
+        timings = {}
+
+        # Load data to container
+        start = time.perf_counter()
+        testing_data = docker_testing.load_data(protocol)
+        timings['load'] = time.perf_counter() - start
+
+        # Push OT from container session to container; writing and reading
+        # the protocol both change the shared directory tree
+        start = time.perf_counter()
+        with write_lock:
+            env.write_operation_type(testing_data['ot'], no_code=True)
+            summary = self._push_protocols(env, [protocol], force=True)
+        if summary['failed'] or summary['conflicted']:
+            raise Exception("Could not push {}".format(protocol.name))
+        timings['push'] = time.perf_counter() - start
+
+        # Test protocol on container
+        start = time.perf_counter()
+        result = docker_testing.test_protocol(protocol, testing_data)
+        timings['plan'] = time.perf_counter() - start
+        result['timings'] = timings
+        return result
+
+    @staticmethod
+    def _log_test_report(category_name, results, elapsed):
+        """Logs the outcome and timings of tested protocols"""
+        passed = 0
+        logger.cli("Test report:")
+        for result in results:
+            name = "{}/{}".format(category_name, result.item.name)
+            if not result.ok:
+                logger.cli(Fore.RED + "  {}: error ({})".format(
+                    name, result.error))
+                continue
+            info = result.value
+            timings = ', '.join(
+                "{} {:.1f}s".format(step, info['timings'][step])
+                for step in ('load', 'push', 'plan'))
+            if info['success']:
+                passed += 1
+                logger.cli("  {}: passed ({})".format(name, timings))
+            else:
+                logger.cli(Fore.RED + "  {}: failed ({})".format(
+                    name, timings))
+            logger.cli("    View plan: {}".format(info['plan_url']))
+        line = "{} passed, {} failed in {:.1f}s".format(
+            passed, len(results) - passed, elapsed)
+        if passed < len(results):
+            line = Fore.RED + line
+        logger.cli(line)
 
     def start_container(self, reset=False):
-        """Start an Aqarium Docker container"""
+        """
+        Start an Aqarium Docker container, or reuse the running one unless
+        reset is set, and wait until Aquarium is ready
+        """
+        from parrotfish.utils import docker_testing
         container_id = self._session_manager.get_container_id()
         result = docker_testing.start_container(reset, container_id)
+        timings = result['timings']
 
         if result['success']:
-            logger.cli("Container started!")
+            logger.cli("Container started in {:.1f}s, ready after {:.1f}s"
+                       .format(timings['start'], timings['ready']))
         else:
-            logger.cli("Container already running: use --reset to restart")
-        self._session_manager.set_container_id(result['id'])
+            logger.cli("Reusing running container (ready after {:.1f}s): "
+                       "use --reset to restart".format(timings['ready']))
+        if result['id'] != container_id:
+            self._session_manager.set_container_id(result['id'])
 
     def stop_container(self):
         """Stop an Aqarium Docker container"""
+        from parrotfish.utils import docker_testing
         container_id = self._session_manager.get_container_id()
         if container_id != '':
-            docker_testing.stop_container(container_id)
+            timings = docker_testing.stop_container(container_id)
             self._session_manager.set_container_id('')
-            logger.cli("Container killed")
+            logger.cli("Container killed in {:.1f}s".format(timings['stop']))
         else:
             logger.cli("No container is currently running")
 
-    def _copy_operation_type(self, sess1_name, sess2_name, ot):
+    def _copy_operation_types(self, sess1_name, sess2_name, category,
+                              names):
         """Copy Operation Type files from one session to another"""
+        from opath.utils import rmtree, copytree
         sess1 = self._session_manager.get(sess1_name)
         sess2 = self._session_manager.get(sess2_name)
 
-        # Copy all files from current_session to docker
-        rmtree(sess2.abspath)
+        # Copy all files from current_session to docker; the folder of a
+        # newly registered session is only created once something is written
+        if os.path.isdir(str(sess2.abspath)):
+            rmtree(sess2.abspath)
         copytree(sess1.abspath, sess2.abspath)
 
-        # Make this operation type visible to ODir
-        sess2.get_operation_type_dir(ot.category, ot.name)
+        # Make these operation types visible to ODir
+        return [sess2.get_operation_type_dir(category, name)
+                for name in names]
 
     @property
     def _sessions(self):
@@ -267,14 +921,14 @@ class CLI(object):
     @property
     def sessions(self):
         """List the current available sessions"""
-        sessions = self._sessions
+        sessions = self._sessions_json()
         if len(sessions) == 0:
             logger.cli(
                 "There are no sessions. "
                 "Use 'pfish register' to register a session. "
                 "Use 'pfish register --h' for help.")
         else:
-            logger.cli(format_json(self._sessions_json()))
+            logger.cli(format_json(sessions))
         return sessions
 
     def protocols(self):
@@ -293,6 +947,72 @@ class CLI(object):
         category_count = {k: len(v) for k, v in categories.items()}
         logger.cli(format_json(category_count))
 
+    def cache(self, enable=True, max_age=600, max_size=50):
+        """
+        Turns the on-disk cache of read-only queries (OperationTypes,
+        Libraries, SampleTypes and ObjectTypes) of the current session on or
+        off. Use `pfish --no-cache <command>` to ignore the cache once.
+
+        :param enable: whether to cache responses
+        :type enable: bool
+        :param max_age: seconds during which cached responses are used
+                        without asking the server
+        :type max_age: float
+        :param max_size: maximum size of the cache in MB
+        :type max_size: float
+        :return: None
+        :rtype: None
+        """
+        self._check_for_session()
+        env = self._session_manager.current_env
+        env.set_response_cache(enable, max_age=max_age,
+                               max_size=int(max_size * 1024 * 1024))
+        self._session_manager.save(force=True)
+        if enable:
+            logger.cli("Caching read-only queries of \"{}\" for {} second(s)"
+                       .format(env.name, max_age))
+        else:
+            logger.cli("Cache of \"{}\" disabled".format(env.name))
+
+    def clear_cache(self):
+        """Deletes the cached queries of the current session"""
+        self._check_for_session()
+        cache = self._session_manager.current_env.get_response_cache()
+        if cache is None:
+            logger.cli("The cache is disabled. Use 'pfish cache' to enable "
+                       "it.")
+            return
+        logger.cli("{} cached response(s) deleted".format(cache.clear()))
+
+    def transport(self, max_connections=None, compress=False):
+        """
+        Sets the maximum number of connections to the Aquarium server of the
+        current session and whether request bodies are gzipped. Use
+        `pfish transport` without options to restore the defaults.
+
+        :param max_connections: maximum number of connections to the server
+                                (grows with the number of workers if None)
+        :type max_connections: int
+        :param compress: gzip large request bodies (the server must accept
+                         gzipped requests)
+        :type compress: bool
+        :return: None
+        :rtype: None
+        """
+        self._check_for_session()
+        env = self._session_manager.current_env
+        if max_connections is not None:
+            max_connections = int(max_connections)
+        env.set_transport(max_connections=max_connections,
+                          compress_requests=bool(compress))
+        self._session_manager.save(force=True)
+        if env.transport_settings is None:
+            logger.cli("\"{}\" uses the default connection pools"
+                       .format(env.name))
+        else:
+            logger.cli("Transport of \"{}\": {}".format(
+                env.name, format_json(env.transport_settings)))
+
     def set_session(self, session_name):
         """
         Set the session by name.
@@ -308,13 +1028,15 @@ class CLI(object):
         self._save()
 
     def set_repo(self, path):
+        from parrotfish.session_environment import SessionManager
         repo_dir = os.path.dirname(path)
         repo_name = os.path.basename(path)
         logger.cli("Setting repo to \"{}\"".format(path))
         self._session_manager = SessionManager(repo_dir, name=repo_name)
 
         logger.cli("Loading environment...")
-        self._save()
+        # record the new root, otherwise loading moves back to the old one
+        self._session_manager.save(force=True)
         self._load()
         logger.cli("{} session(s) loaded".format(len(self._sessions)))
 
@@ -326,7 +1048,6 @@ class CLI(object):
         logger.cli("Moving repo location from {} to {}".format(
             self._session_manager.abspath, path))
         self._session_manager.move_repo(path)
-        self._save()
 
     def reset(self):
         self._session_manager.metadata.rmdirs()
@@ -334,6 +1055,7 @@ class CLI(object):
         self._session_manager.save(force_new_key=True)
 
     def generate_encryption_key(self):
+        from cryptography.fernet import Fernet
         key = Fernet.generate_key().decode()
         logger.warning(
             "SAVE KEY IN A SECURE PLACE TO USE YOUR REPO ON ANOTHER COMPUTER. "
@@ -355,10 +1077,10 @@ class CLI(object):
         :return:
         :rtype:
         """
+        from parrotfish.session_environment import SessionManager
         logger.cli("Encryption key set")
         self._session_manager.save(force_new_key=True, key=key)
         self._session_manager = SessionManager('').load()
-        self._save()
         logger.cli("Loaded sessions with new key")
         return self.sessions
 
@@ -377,6 +1099,7 @@ class CLI(object):
         :return: None
         :rtype: NOne
         """
+        from requests.exceptions import InvalidSchema
         try:
             self._session_manager.register_session(login, password,
                                                    aquarium_url, name)
@@ -386,7 +1109,6 @@ class CLI(object):
                 .format(aquarium_url))
         logger.cli("registering session: {}".format(name))
         self.set_session(name)
-        self._save()
 
     def unregister(self, name):
         """
@@ -399,7 +1121,7 @@ class CLI(object):
         """
         if name in self._session_manager.sessions:
             logger.cli("Unregistering {}: {}".format(
-                name, str(self._session_manager.get_session(name))))
+                name, str(self._session_manager.get(name))))
             self._session_manager.remove_session(name)
         else:
             logger.cli("Session {} does not exist".format(name))
@@ -408,6 +1130,8 @@ class CLI(object):
     def ls(self):
         """List dictionary structure for the session manager"""
         logger.cli(str(self._session_manager.abspath))
+        for session_env in self._session_manager.session_env_list:
+            session_env.collect()
         logger.cli('\n' + self._session_manager.show())
 
     def repo(self):
@@ -416,6 +1140,7 @@ class CLI(object):
 
     def shell(self):
         """Opens an interactive shell"""
+        from parrotfish.shell import Shell
         logger.cli("Opening new shell")
         Shell(self).run()
 
@@ -431,7 +1156,12 @@ def open_from_global():
     :return: CLI instance
     :rtype: CLI
     """
-    sm = SessionManager(tempfile.mkdtemp())
+    from parrotfish.session_environment import SessionManager
+    # the directory is replaced by the root stored in the settings
+    sm = SessionManager('')
+    if not sm.metadata.env_settings.exists():
+        import tempfile
+        sm.set_dir(tempfile.mkdtemp())
     sm.load()
     cli = CLI(sm)
     return cli
@@ -443,9 +1173,9 @@ def open_from_local(directory, encryption_key=None):
     if the following exists::
 
         FishTank          (Master or root directory)
+        |──.session_registry.json   (registered sessions)
         |──nursery      (Aquarium session)
         |   └──Category1            (Protocol Category)
-        |       |──.env_pkl         (SessionEnvironment1's AqSession)
         |       |──protocols        (protocols folder)
 
     this method will attempt to open "FishTank" using the 'env.json' located
@@ -460,6 +1190,7 @@ def open_from_local(directory, encryption_key=None):
     :return: CLI instance
     :rtype: CLI
     """
+    from parrotfish.session_environment import SessionManager
     sm_dir = os.path.dirname(directory)
     sm_name = os.path.basename(directory)
     sm = SessionManager(sm_dir, sm_name, meta_dir=directory)
@@ -473,6 +1204,16 @@ def open_from_local(directory, encryption_key=None):
 
 def run():
     logger.setLevel("VERBOSE")
+    # trivial commands are answered without loading the environment
+    if run_quick(sys.argv[1:]):
+        return
+    no_cache = [arg for arg in sys.argv if arg in ('--no-cache', '--no_cache')]
+    if no_cache:
+        from parrotfish.utils.response_cache import set_enabled
+        set_enabled(False)
+        for arg in no_cache:
+            sys.argv.remove(arg)
+    import fire
     cli = open_from_global()
     fire.Fire(cli)
 
@@ -0,0 +1,90 @@
+"""
+Lightweight command dispatch for the `pfish` entry point.
+
+Commands that only need to read the environment settings and the session
+registry are answered here directly from the json files, without importing
+pydent, opath, fire, cryptography or prompt_toolkit. Every other command is
+handed to the full :class:`parrotfish.core.CLI`.
+"""
+
+import json
+import os
+
+from parrotfish.utils import format_json
+from parrotfish.utils.log import CustomLogging
+
+logger = CustomLogging.get_logger(__name__)
+
+# default location of the global environment settings
+DEFAULT_METADATA_LOC = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'environment_data')
+DEFAULT_METADATA_NAME = 'environment_settings.json'
+
+# name of the file listing every registered session
+SESSION_REGISTRY = '.session_registry.json'
+
+
+def _load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _repo(settings):
+    logger.cli(settings['root'])
+    return True
+
+
+def _sessions(settings):
+    registry = _load_json(os.path.join(settings['root'], SESSION_REGISTRY))
+    if registry is None:
+        # sessions pickled by older versions need the full environment
+        return False
+    sessions = {
+        name: "SessionEnvironment(name={}, login={}, url={})".format(
+            name, entry['login'], entry['aquarium_url'])
+        for name, entry in registry['sessions'].items()
+    }
+    if len(sessions) == 0:
+        logger.cli(
+            "There are no sessions. "
+            "Use 'pfish register' to register a session. "
+            "Use 'pfish register --h' for help.")
+    else:
+        logger.cli(format_json(sessions))
+    return True
+
+
+# commands that can be answered from the settings and registry files
+QUICK_COMMANDS = {
+    'repo': _repo,
+    'sessions': _sessions,
+}
+
+
+def run_quick(args, meta_dir=None, meta_name=None):
+    """
+    Runs a command without loading the full environment if possible.
+
+    :param args: command line arguments (without the program name)
+    :type args: list
+    :param meta_dir: directory of the environment settings
+    :type meta_dir: str
+    :param meta_name: name of the environment settings file
+    :type meta_name: str
+    :return: whether the command was handled
+    :rtype: bool
+    """
+    if len(args) != 1 or args[0] not in QUICK_COMMANDS:
+        return False
+    if meta_dir is None:
+        meta_dir = DEFAULT_METADATA_LOC
+    if meta_name is None:
+        meta_name = DEFAULT_METADATA_NAME
+    settings = _load_json(os.path.join(meta_dir, meta_name))
+    if settings is None or 'root' not in settings:
+        # first run; the full environment creates the settings
+        return False
+    return QUICK_COMMANDS[args[0]](settings)
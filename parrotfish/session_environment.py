@@ -4,19 +4,27 @@ Classes for managing Aquarium sessions and protocols
 
 import datetime
 import os
+import threading
+from collections.abc import Mapping
 from glob import glob
 import json
 
-import dill
 from opath import ODir
 from parrotfish.__version__ import __version__
+from parrotfish import launcher
 from parrotfish.utils import sanitize_filename, sanitize_attribute
+from parrotfish.utils.files import (FileWriter, write_atomic,
+                                    write_if_changed)
 from parrotfish.utils.log import CustomLogging
-from parrotfish.utils.testing_tools import tagify, generate_test_data
+from parrotfish.utils.record_cache import RecordCache, RecordStore
+from parrotfish.utils.response_cache import ResponseCache, is_enabled
+from parrotfish.utils.sync import CODE_ACCESSORS, SyncManifest, hash_file
+from parrotfish.utils.testing_tools import (TagTable, tagify,
+                                            generate_test_data)
+from parrotfish.utils.transport import get_transport, use_shared_transport
 from pydent import AqSession
 from pydent.models import OperationType, Library
 
-from copy import deepcopy
 from cryptography.fernet import Fernet, InvalidToken
 
 logger = CustomLogging.get_logger(__name__)
@@ -37,7 +45,8 @@ class SessionEnvironment(ODir):
     The directory structure for a managed session looks like the following::
 
         SessionEnvironment1
-           |──.session_env.pkl              (pickled environment information)
+           |──.sync_manifest.json           (server state of fetched protocols)
+           |──.response_cache               (cached queries, if enabled)
            └──Category1                     (protocol category folder)
                |──OperationType1            (OperationType folder)
                |   |──object_types
@@ -63,14 +72,28 @@ class SessionEnvironment(ODir):
     For security, ParrotFish does *not* directly store the :class:`AqSession.`
     Instead, passwords are encrypted using Fernet
     (https://cryptography.io/en/latest/fernet/).
-    Passwords are stored as an encrypted string.
+    Passwords are stored as an encrypted string in the
+    :class:`SessionManager`'s session registry.
     This string can be decrypted using the proper key.
     """
 
-    # name of the pickled file when saving or loading
+    # name of the pickled file used by older versions of ParrotFish
     ENV_PKL = '.session_environment.pkl'
 
-    def __init__(self, name, login, password, aquarium_url, encryption_key):
+    # name of the file recording the server state of fetched protocols
+    SYNC_MANIFEST = '.sync_manifest.json'
+
+    # name of the file caching serialized sample and object types
+    RECORD_CACHE = '.record_cache.json'
+
+    # directory keeping one copy of each sample and object type
+    RECORD_STORE = '.records'
+
+    # directory caching responses to read-only queries
+    RESPONSE_CACHE = '.response_cache'
+
+    def __init__(self, name, login, password, aquarium_url, encryption_key,
+                 encrypted_password=None):
         """
         Constructs a new :class:`SessionEnvironment`.
 
@@ -78,29 +101,50 @@ class SessionEnvironment(ODir):
         :type name: str
         :param login: aquarium login
         :type login: str
-        :param password: aquarium password (not stored)
+        :param password: aquarium password (not stored). If provided, the
+                         session is logged in immediately.
         :type password: str
         :param aquarium_url: aquarium url
         :type aquarium_url: str
         :param encryption_key: encryption key to use to store the password
         :type encryption_key: str
+        :param encrypted_password: previously encrypted password to use
+                                   instead of password
+        :type encrypted_password: bytes
         """
         super().__init__(name, push_up=False, check_attr=False)
 
         # set the session
-        cipher_suite = Fernet(encryption_key)
-        self.encrypted_password = cipher_suite.encrypt(str.encode(password))
+        if encrypted_password is None:
+            cipher_suite = Fernet(encryption_key)
+            encrypted_password = cipher_suite.encrypt(str.encode(password))
+        self.encrypted_password = encrypted_password
         self.login = login
         self.aquarium_url = aquarium_url
 
-        # this should never be saved in the pickle
-        self.aquarium_session = self.create_session(encryption_key)
-
-        # add the environment pickle
-        self.add_file(self.ENV_PKL, attr='env_pkl')
+        # these are never saved to the session registry
+        self._encryption_key = encryption_key
+        self._aquarium_session = None
+        # serializes lazy logins triggered from several threads, without
+        # blocking the logins of other sessions
+        self._login_lock = threading.Lock()
+        self.tag_table = None
+        self.record_cache = None
+        self.record_store = None
+        self.file_writer = None
+        self.manifest = None
+
+        # saved to the session registry; None if responses are not cached
+        self.response_cache_settings = None
+        self._response_cache = None
+        # saved to the session registry; None if the default pools are used
+        self.transport_settings = None
+        if password is not None:
+            self.create_session(encryption_key)
 
         # add protocols directory
         self.add('protocols')
+        self._collected = False
 
     def create_session(self, encryption_key):
         """
@@ -121,6 +165,7 @@ class SessionEnvironment(ODir):
                                       self.encrypted_password).decode(),
                                   self.aquarium_url,
                                   name=self.name)
+            self._use_shared_transport(aqsession)
         except InvalidToken:
             logger.warning(self.encrypted_password)
             logger.warning("Encryption key mismatch! Cannot create session. "
@@ -128,27 +173,404 @@ class SessionEnvironment(ODir):
                            "a new key. Alternatively, use "
                            "'pfish set-encryption-key [YOURKEY]' if you have "
                            "a pre-generated key")
-        self.aquarium_session = aqsession
+        self._aquarium_session = aqsession
         return aqsession
 
+    @property
+    def aquarium_session(self):
+        """
+        The :class:`AqSession` of this environment. The password is only
+        decrypted and the session only logged in on first access.
+        """
+        if getattr(self, '_aquarium_session', None) is None:
+            encryption_key = getattr(self, '_encryption_key', None)
+            if encryption_key is not None:
+                with self._login_lock:
+                    if self._aquarium_session is None:
+                        if self.create_session(encryption_key) is None:
+                            # do not retry a key that cannot decrypt
+                            self._encryption_key = None
+        return getattr(self, '_aquarium_session', None)
+
+    @aquarium_session.setter
+    def aquarium_session(self, aqsession):
+        self._aquarium_session = aqsession
+
+    @property
+    def is_logged_in(self):
+        """Whether the :class:`AqSession` has been created"""
+        return getattr(self, '_aquarium_session', None) is not None
+
+    def set_encryption_key(self, encryption_key):
+        """
+        Sets the key used to decrypt the password. The session is created
+        lazily the next time it is accessed.
+
+        :param encryption_key: Fernet key to decrypt the password
+        :type encryption_key: str
+        :return: None
+        :rtype: None
+        """
+        self._encryption_key = encryption_key
+        self._aquarium_session = None
+
+    def to_registry(self):
+        """
+        Returns the information needed to recreate this environment
+
+        :return: registry entry
+        :rtype: dict
+        """
+        entry = {
+            'name': self.name,
+            'login': self.login,
+            'aquarium_url': self.aquarium_url,
+            'encrypted_password': self.encrypted_password.decode()
+        }
+        if self.response_cache_settings is not None:
+            entry['response_cache'] = self.response_cache_settings
+        if self.transport_settings is not None:
+            entry['transport'] = self.transport_settings
+        return entry
+
     @classmethod
-    def load_from_pkl(cls, env_pkl, encryption_key):
-        """Loads from the pickle"""
-        env = None
-        if os.path.isfile(env_pkl):
-            with open(env_pkl, 'rb') as f:
-                env = dill.load(f)
-        env.create_session(encryption_key)
+    def from_registry(cls, entry, encryption_key):
+        """
+        Recreates an environment from a registry entry without logging in
+
+        :param entry: registry entry
+        :type entry: dict
+        :param encryption_key: Fernet key to decrypt the password
+        :type encryption_key: str
+        :return: session environment
+        :rtype: SessionEnvironment
+        """
+        env = cls(entry['name'], entry['login'], None,
+                  entry['aquarium_url'], encryption_key,
+                  encrypted_password=str.encode(
+                      entry['encrypted_password']))
+        env.response_cache_settings = entry.get('response_cache')
+        env.transport_settings = entry.get('transport')
         return env
 
-    def save_to_pkl(self):
-        """Save to pickle"""
-        copied = deepcopy(self)
+    @classmethod
+    def load_from_pkl(cls, env_pkl, encryption_key):
+        """Loads an environment pickled by an older version of ParrotFish"""
+        import dill
+
+        with open(env_pkl, 'rb') as f:
+            legacy = dill.load(f)
+        return cls(legacy.name, legacy.login, None, legacy.aquarium_url,
+                   encryption_key,
+                   encrypted_password=legacy.encrypted_password)
+
+    def collect(self):
+        """
+        Adds the category and protocol directories that exist on the local
+        machine to the directory tree. Only directories are listed, so this
+        is cheap and is done at most once.
+
+        :return: self
+        :rtype: SessionEnvironment
+        """
+        if getattr(self, '_collected', False):
+            return self
+        self._collected = True
+        root = str(self.protocols.abspath)
+        if not os.path.isdir(root):
+            return self
+        for cat_name in sorted(os.listdir(root)):
+            cat_path = os.path.join(root, cat_name)
+            if not os.path.isdir(cat_path):
+                continue
+            for protocol_name in sorted(os.listdir(cat_path)):
+                protocol_path = os.path.join(cat_path, protocol_name)
+                if os.path.isdir(protocol_path):
+                    self._get_local_protocol_dir(cat_name, protocol_name)
+        return self
+
+    def _get_local_protocol_dir(self, category, name):
+        """Returns the directory of a protocol that exists on the local
+        machine, telling OperationTypes and Libraries apart by their files"""
+        precondition = os.path.join(
+            str(self.protocols.abspath), category, name,
+            '{}__precondition.rb'.format(name))
+        if os.path.isfile(precondition):
+            return self.get_operation_type_dir(category, name)
+        return self.get_library_type_dir(category, name)
+
+    def protocol_dir_for_file(self, path):
+        """
+        Returns the protocol directory that a code file belongs to
+
+        :param path: path of a file
+        :type path: str
+        :return: protocol directory and code accessor of the file, or None if
+                 the file is not a code file of a protocol
+        :rtype: tuple
+        """
+        rel = os.path.relpath(os.path.abspath(str(path)),
+                              str(self.protocols.abspath))
+        parts = rel.split(os.sep)
+        if len(parts) != 3 or parts[0] == os.pardir:
+            return None
+        category, name, _ = parts
+        protocol_dir = self._get_local_protocol_dir(category, name)
+        for accessor in self.code_accessors(protocol_dir):
+            code_file = os.path.abspath(
+                str(protocol_dir.get(accessor).abspath))
+            if code_file == os.path.abspath(str(path)):
+                return protocol_dir, accessor
+        return None
+
+    def get_file_writer(self):
+        """
+        Returns the writer used for every file written by this environment.
+        Files are written atomically and only if their content changed.
+
+        :return: file writer
+        :rtype: FileWriter
+        """
+        if getattr(self, 'file_writer', None) is None:
+            self.file_writer = FileWriter()
+        return self.file_writer
+
+    def _write(self, file, content):
+        """Writes content to a managed file if it changed"""
+        return self.get_file_writer().write(file.abspath, content)
+
+    def _dump_json(self, file, data, **kwargs):
+        """Writes json to a managed file if it changed"""
+        return self.get_file_writer().dump_json(file.abspath, data, **kwargs)
+
+    def get_tag_table(self):
+        """
+        Returns the id to tag lookup table shared by all writes of this
+        environment, creating it if necessary.
+
+        :return: lookup table
+        :rtype: TagTable
+        """
+        if getattr(self, 'tag_table', None) is None:
+            self.tag_table = TagTable(self.aquarium_session)
+        return self.tag_table
+
+    def reset_tag_table(self):
+        """
+        Starts a new lookup table, discarding any names remembered from a
+        previous fetch.
+
+        :return: lookup table
+        :rtype: TagTable
+        """
+        self.tag_table = TagTable(self.aquarium_session)
+        return self.tag_table
+
+    def get_record_cache(self):
+        """
+        Returns the cache of records shared by all writes of this
+        environment, creating an in-memory cache if necessary.
+
+        :return: record cache
+        :rtype: RecordCache
+        """
+        if getattr(self, 'record_cache', None) is None:
+            self.record_cache = RecordCache()
+        return self.record_cache
+
+    def reset_record_cache(self, persist=False):
+        """
+        Starts a new record cache, discarding records loaded by a previous
+        fetch.
+
+        :param persist: keep serialized records in the session directory so
+                        they are reused by the next fetch
+        :type persist: bool
+        :return: record cache
+        :rtype: RecordCache
+        """
+        path = None
+        if persist:
+            path = self.add_file(self.RECORD_CACHE,
+                                 attr='record_cache_file').abspath
+        self.record_cache = RecordCache(path)
+        return self.record_cache
+
+    def set_record_store(self, enabled):
+        """
+        Sets whether sample and object types are written as links into a
+        content-addressed store in the session folder instead of as separate
+        copies in every OperationType folder.
+
+        :param enabled: whether to use the store
+        :type enabled: bool
+        :return: the record store or None
+        :rtype: RecordStore
+        """
+        self.record_store = None
+        if enabled:
+            self.record_store = RecordStore(
+                os.path.join(str(self.abspath), self.RECORD_STORE))
+        return self.record_store
+
+    def get_response_cache(self):
+        """
+        Returns the on-disk cache of read-only queries (of OperationTypes,
+        Libraries, SampleTypes and ObjectTypes) of this session.
+
+        :return: response cache or None if caching is disabled
+        :rtype: ResponseCache
+        """
+        settings = getattr(self, 'response_cache_settings', None)
+        if settings is None or not is_enabled():
+            return None
+        if getattr(self, '_response_cache', None) is None:
+            self._response_cache = ResponseCache(
+                self._response_cache_dir(), **settings)
+        return self._response_cache
+
+    def _response_cache_dir(self):
+        return os.path.join(str(self.abspath), self.RESPONSE_CACHE)
+
+    def set_response_cache(self, enabled, max_age=600,
+                           max_size=50 * 1024 * 1024):
+        """
+        Sets whether responses to read-only queries are cached on disk.
+        Disabling the cache deletes the cached responses.
+
+        :param enabled: whether to cache responses
+        :type enabled: bool
+        :param max_age: seconds during which a cached response is used
+                        without asking the server
+        :type max_age: float
+        :param max_size: maximum size of the cache in bytes
+        :type max_size: int
+        :return: response cache or None
+        :rtype: ResponseCache
+        """
+        if not enabled:
+            ResponseCache(self._response_cache_dir()).clear()
+        self.response_cache_settings = None
+        if enabled:
+            self.response_cache_settings = {'max_age': max_age,
+                                            'max_size': max_size}
+        self._response_cache = None
+        if self.is_logged_in:
+            self._use_shared_transport(self._aquarium_session)
+        return self.get_response_cache()
+
+    def _use_shared_transport(self, aqsession):
+        """Sends the requests of the session through the shared transport,
+        using the transport settings and response cache of this
+        environment"""
+        get_transport().configure_host(
+            self.aquarium_url,
+            **(getattr(self, 'transport_settings', None) or {}))
+        return use_shared_transport(aqsession,
+                                    cache=self.get_response_cache())
+
+    def set_transport(self, max_connections=None, compress_requests=False):
+        """
+        Sets the connection limit and request compression used for the
+        Aquarium server of this session.
+
+        :param max_connections: maximum number of connections to the server
+                                (the default pool size if None)
+        :type max_connections: int
+        :param compress_requests: gzip request bodies (the server must
+                                  accept gzipped requests)
+        :type compress_requests: bool
+        :return: None
+        :rtype: None
+        """
+        self.transport_settings = None
+        if max_connections is not None or compress_requests:
+            self.transport_settings = {
+                'max_connections': max_connections,
+                'compress_requests': compress_requests}
+        if self.is_logged_in:
+            self._use_shared_transport(self._aquarium_session)
+
+    def get_sync_manifest(self):
+        """
+        Returns the manifest recording the server state of every fetched
+        protocol, loading it on first access.
+
+        :return: sync manifest
+        :rtype: SyncManifest
+        """
+        if getattr(self, 'manifest', None) is None:
+            manifest_file = self.add_file(self.SYNC_MANIFEST,
+                                          attr='sync_manifest')
+            self.manifest = SyncManifest(manifest_file.abspath)
+        return self.manifest
+
+    def protocol_path(self, protocol_dir):
+        """Returns the path of a protocol directory relative to this
+        environment"""
+        return os.path.relpath(str(protocol_dir.abspath), str(self.abspath))
 
-        # remove aquarium_session from the pickle
-        copied.aquarium_session = None
-        with self.env_pkl.open('wb') as f:
-            dill.dump(copied, f)
+    @staticmethod
+    def code_accessors(protocol_dir):
+        """Returns the code accessors of a Library or OperationType
+        directory"""
+        if protocol_dir.has('source'):
+            return CODE_ACCESSORS['Library']
+        return CODE_ACCESSORS['OperationType']
+
+    def code_hashes(self, protocol_dir):
+        """
+        Hashes the local code files of a protocol
+
+        :param protocol_dir: directory that manages the protocol
+        :type protocol_dir: ODir
+        :return: dictionary of accessor to file hash
+        :rtype: dict
+        """
+        return {accessor: hash_file(protocol_dir.get(accessor).abspath)
+                for accessor in self.code_accessors(protocol_dir)}
+
+    def changed_code(self, protocol_dir):
+        """
+        Returns the accessors of a protocol whose local files changed since
+        they were last fetched or pushed. Only local files are read.
+
+        :param protocol_dir: directory that manages the protocol
+        :type protocol_dir: ODir
+        :return: changed accessors
+        :rtype: list
+        """
+        return self.get_sync_manifest().changed_files(
+            self.protocol_path(protocol_dir), self.code_hashes(protocol_dir))
+
+    def local_protocols(self):
+        """
+        Lists every protocol on the local machine along with its local file
+        hashes. Ids are taken from the sync manifest, falling back to the
+        protocol's json file.
+
+        :return: dictionaries with 'name' ("category/name"), 'model' (class
+                 name), 'id', 'path' and 'hashes'
+        :rtype: list
+        """
+        manifest = self.get_sync_manifest()
+        protocols = []
+        for category in self.categories:
+            for protocol_dir in category.list_dirs():
+                path = self.protocol_path(protocol_dir)
+                entry = manifest.get_by_path(path) or {}
+                model_id = entry.get('id')
+                if model_id is None and protocol_dir.meta.exists():
+                    model_id = protocol_dir.meta.load_json().get('id')
+                protocols.append({
+                    'name': "{}/{}".format(category.name, protocol_dir.name),
+                    'model': "Library" if protocol_dir.has('source')
+                             else "OperationType",
+                    'id': model_id,
+                    'path': path,
+                    'hashes': self.code_hashes(protocol_dir)
+                })
+        return protocols
 
     def update_encryption_key(self, old_key, new_key):
         """
@@ -165,27 +587,11 @@ class SessionEnvironment(ODir):
         new_cipher = Fernet(new_key)
         self.encrypted_password = new_cipher.encrypt(
             old_cipher.decrypt(self.encrypted_password))
+        self._encryption_key = new_key
 
-    # def reload_from_pkl(self, encryption_key):
-    #     """Load attributes from the pickle"""
-    #     with self.env_pkl.open('wb') as f:
-    #         sess = self.aquarium_session
-    #         loaded = dill.load(f)
-    #         vars(self).updated(vars(loaded))
-    #         self.aquarium_session = sess
-
-    # def reload_from_pkl(self):
-    #     """Load attributes from the pickle"""
-    #     with self.env_pkl.open('wb') as f:
-    #         loaded = dill.load(f)
-    #         vars(self).updated(vars(loaded))
-
-    # @classmethod
-    # def load_from_pkl(cls, env_pkl):
-    #     """Load from pickle"""
-    #     if os.path.isfile(env_pkl):
-    #         with open(env_pkl, 'rb') as f:
-    #             return dill.load(f)
+    def __str__(self):
+        return "SessionEnvironment(name={}, login={}, url={})".format(
+            self.name, self.login, self.aquarium_url)
 
     def add_category_dir(self, category):
         """Creates a new category directory"""
@@ -213,6 +619,7 @@ class SessionEnvironment(ODir):
         :return: category directory
         :rtype: ODir
         """
+        self.collect()
         cat_name = self._sanitize_name(cat_name)
         if not self.protocols.has(cat_name):
             raise FileNotFoundError(
@@ -240,6 +647,7 @@ class SessionEnvironment(ODir):
     @property
     def categories(self):
         """Return a list of categories (ODir)"""
+        self.collect()
         return self.protocols.list_dirs()
 
     #
@@ -312,89 +720,163 @@ class SessionEnvironment(ODir):
 
         return lib_dir
 
-    def write_operation_type(self, operation_type, no_code=False):
+    def get_model_dir(self, model):
+        """
+        Returns the :class:`ODir` that manages an :class:`OperationType` or
+        :class:`Library`
+
+        :param model: OperationType or Library
+        :type model: OperationType | Library
+        :return: the protocol directory
+        :rtype: ODir
+        """
+        if isinstance(model, Library):
+            return self.get_library_type_dir(model.category, model.name)
+        return self.get_operation_type_dir(model.category, model.name)
+
+    def write_model(self, model, codes=None):
+        """
+        Writes a :class:`OperationType` or :class:`Library` to the local
+        machine
+
+        :param model: OperationType or Library to write to local files
+        :type model: OperationType | Library
+        :param codes: dictionary of accessor to the latest Code, if already
+                      retrieved (e.g. by :func:`sync.latest_codes_for`)
+        :type codes: dict
+        :return: None
+        :rtype: None
+        """
+        if isinstance(model, Library):
+            return self.write_library(model, codes=codes)
+        return self.write_operation_type(model, codes=codes)
+
+    def write_operation_type(self, operation_type, no_code=False,
+                             codes=None):
         """
         Writes a :class:`OperationType` to the local machine
 
         :param operation_type: OperationType to write to local files
         :type operation_type: OperationType
+        :param no_code: do not write the code files
+        :type no_code: bool
+        :param codes: dictionary of accessor to the latest Code. The codes
+                      are loaded from the server if None.
+        :type codes: dict
         :return: None
         :rtype: None
         """
         ot_dir = self.get_operation_type_dir(
             operation_type.category, operation_type.name)
 
-        metadata = operation_type.dump(
-            include={'protocol': {},
-                     'documentation': {},
-                     'cost_model': {},
-                     'precondition': {},
-                     "field_types": {
-                         "allowable_field_types": {
-                             "sample_type",
-                             "object_type"
-                         }
-            }
-            }
-        )
+        accessors = ['protocol', 'precondition', 'documentation',
+                     'cost_model']
+        include = {"field_types": {"allowable_field_types": {}}}
+        if codes is None:
+            include.update({accessor: {} for accessor in accessors})
+        metadata = operation_type.dump(include=include)
+        if codes is not None:
+            for accessor in accessors:
+                code = codes.get(accessor)
+                metadata[accessor] = code and code.dump()
 
         # write codes
         if not no_code:
-            for accessor in ['protocol', 'precondition',
-                             'documentation', 'cost_model']:
+            for accessor in accessors:
                 logger.verbose("    saving {}".format(accessor))
-                ot_dir.get(accessor).write(metadata[accessor]['content'])
+                self._write(ot_dir.get(accessor),
+                            metadata[accessor]['content'])
+
+        # shared records are only fetched the first time a protocol of the
+        # session references them
+        record_cache = self.get_record_cache()
+        afts = [aft for ft in metadata['field_types']
+                for aft in ft['allowable_field_types']]
+        sample_types = record_cache.resolve(
+            self.aquarium_session, 'SampleType',
+            [aft.get('sample_type_id') for aft in afts])
+        object_types = record_cache.resolve(
+            self.aquarium_session, 'ObjectType',
+            [aft.get('object_type_id') for aft in afts])
+        for aft, sample_type, object_type in zip(
+                afts, sample_types, object_types):
+            aft['sample_type'] = sample_type and sample_type.dump()
+            aft['object_type'] = object_type and object_type.dump()
+
+        # records loaded with the OperationType never need to be looked up
+        tag_table = self.get_tag_table()
+        tag_table.add_records('sample_type', sample_types)
+        tag_table.add_records('object_type', object_types)
 
         # write metadata
-        ot_dir.meta.dump_json(
-            tagify(metadata, self.aquarium_session),
+        self._dump_json(
+            ot_dir.meta,
+            tagify(metadata, self.aquarium_session, tag_table),
             indent=4,
         )
 
         # write sample types
         sample_type_dir = ot_dir.add('sample_types')
-        sample_types = [aft.sample_type
-                        for ft in operation_type.field_types
-                        for aft in ft.allowable_field_types]
         self.write_records_to_dir(sample_type_dir, sample_types)
 
         # write object types
         object_type_dir = ot_dir.add('object_types')
-        object_types = [aft.object_type
-                        for ft in operation_type.field_types
-                        for aft in ft.allowable_field_types]
         self.write_records_to_dir(object_type_dir, object_types)
 
         # write test data
         testing_dir = ot_dir.add('testing')
         testing_dir.add_file('data.json', attr='data')
-        testing_dir.get('data').write(generate_test_data(metadata))
+        self._write(testing_dir.get('data'), generate_test_data(metadata))
 
-    def write_library(self, library):
+    def write_library(self, library, codes=None):
         """
         Writes a :class:`Library` to the local machine
 
         :param library: library to write to local files
         :type library: Library
+        :param codes: dictionary of accessor to the latest Code. The source
+                      is loaded from the server if None.
+        :type codes: dict
         :return: None
         :rtype: None
         """
         lib_dir = self.get_library_type_dir(library.category, library.name)
 
+        if codes is None:
+            metadata = library.dump(include={'source'})
+            source = library.code('source')
+        else:
+            metadata = library.dump()
+            source = codes.get('source')
+            metadata['source'] = source and source.dump()
+
         # write json
-        lib_dir.meta.dump_json(library.dump(include={'source'}), indent=4)
+        self._dump_json(lib_dir.meta, metadata, indent=4)
 
         # write codes
-        lib_dir.source.write(library.code('source').content)
+        self._write(lib_dir.source, source.content)
 
     def write_records_to_dir(self, target_dir, records):
+        tag_table = self.get_tag_table()
+        record_cache = self.get_record_cache()
+
+        def dump(rec):
+            data = rec.dump(relations='field_types')
+            return tagify(data, self.aquarium_session, tag_table)
+
+        written = set()
         for rec in records:
-            if rec:
+            if rec and RecordCache.key(rec) not in written:
+                written.add(RecordCache.key(rec))
                 f_name = self._sanitize_name(rec.name)
                 target_dir.add_file('{}.json'.format(f_name), attr=f_name)
-                data = rec.dump(relations='field_types')
-                t_data = tagify(data, self.aquarium_session)
-                target_dir.get(f_name).write(json.dumps(t_data, indent=2))
+                t_data = record_cache.dump(rec, dump)
+                text = json.dumps(t_data, indent=2)
+                if getattr(self, 'record_store', None) is not None:
+                    self.get_file_writer().record(self.record_store.write(
+                        target_dir.get(f_name).abspath, text))
+                else:
+                    self._write(target_dir.get(f_name), text)
 
     def read_operation_type(self, category, name):
         """
@@ -419,6 +901,21 @@ class SessionEnvironment(ODir):
         ot.connect_to_session(self.aquarium_session)
         return ot
 
+    def read_protocol(self, protocol_dir):
+        """
+        Reads the :class:`OperationType` or :class:`Library` managed by a
+        protocol directory
+
+        :param protocol_dir: directory that manages the protocol
+        :type protocol_dir: ODir
+        :return: OperationType or Library read from local files
+        :rtype: OperationType | Library
+        """
+        category = protocol_dir.parent.name
+        if protocol_dir.has('source'):
+            return self.read_library_type(category, protocol_dir.name)
+        return self.read_operation_type(category, protocol_dir.name)
+
     def read_library_type(self, category, name):
         """
         Constructs a :class:`Library` instance constructed out of local
@@ -440,6 +937,30 @@ class SessionEnvironment(ODir):
         return lib
 
 
+class SessionMapping(Mapping):
+    """
+    Read-only mapping of session names to :class:`AqSession`. Listing or
+    checking names never logs in; a session is only logged in when its value
+    is accessed.
+    """
+
+    def __init__(self, session_envs):
+        self._envs = {env.name: env for env in session_envs}
+
+    def __getitem__(self, name):
+        return self._envs[name].aquarium_session
+
+    def __contains__(self, name):
+        # Mapping.__contains__ would look the session up
+        return name in self._envs
+
+    def __iter__(self):
+        return iter(self._envs)
+
+    def __len__(self):
+        return len(self._envs)
+
+
 class SessionManager(ODir):
     """
     Manages multiple :class:`SessionEnvironment` instances.
@@ -452,6 +973,9 @@ class SessionManager(ODir):
     environement_settings file.
     The **environment_settings.json** also stores an encryption key so that
     :class:`SessionEnvironment`s can be decrypted and used properly.
+    The login, url and encrypted password of every :class:`SessionEnvironment`
+    are stored in a single **.session_registry.json** file in the
+    SessionManager directory.
 
     Example session structure::
 
@@ -460,9 +984,9 @@ class SessionManager(ODir):
             └──environment_settings.json      (information about top directory)
 
         SessionManagerName          (Master or root directory)
+        |──.session_registry.json   (login, url, encrypted password by session)
         |──SessionEnvironment1      (Aquarium session)
         |   └──Category1            (Protocol Category)
-        |       |──.env_pkl         (SessionEnvironment1's AqSession)
         |       |──protocols        (protocols folder)
         |       |   |──OperationType1
         |       |   |   |──OperationType1.json
@@ -479,9 +1003,11 @@ class SessionManager(ODir):
             └── ...
     """
 
-    DEFAULT_METADATA_LOC = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), 'environment_data')
-    DEFAULT_METADATA_NAME = 'environment_settings.json'
+    DEFAULT_METADATA_LOC = launcher.DEFAULT_METADATA_LOC
+    DEFAULT_METADATA_NAME = launcher.DEFAULT_METADATA_NAME
+
+    # name of the file listing every registered session
+    SESSION_REGISTRY = launcher.SESSION_REGISTRY
 
     def __init__(self, dir, name="FishTank", meta_dir=None, meta_name=None):
         """
@@ -508,8 +1034,17 @@ class SessionManager(ODir):
         self.metadata = ODir(meta_dir)
         self.metadata.add_file(meta_name, 'env_settings')
 
+        self.add_file(self.SESSION_REGISTRY, attr='session_registry')
+
         self._curr_session_name = None
 
+        # whether anything needs to be persisted by `save`
+        self._dirty = False
+
+        # in-process copy of the settings file and the mtime it was read at
+        self._settings = None
+        self._settings_mtime = None
+
     def register_session(self, login, password, aquarium_url, name):
         """
         Registers a new session by creating a AqSession, creating
@@ -522,6 +1057,7 @@ class SessionManager(ODir):
         session_env = SessionEnvironment(
             name, login, password, aquarium_url, key)
         self._add_session_env(session_env)
+        self._dirty = True
 
     def remove_session(self, name):
         """
@@ -535,17 +1071,49 @@ class SessionManager(ODir):
         session = self.get(name)
         session.remove_parent()
         session.rmdirs()
+        if self._curr_session_name == name:
+            self._curr_session_name = None
+        self._dirty = True
 
     def _add_session_env(self, session_env):
         """Adds the session environment to the session manager"""
         self._add(session_env.name, session_env,
                   push_up=False, check_attr=False)
 
+    def _read_settings(self):
+        """
+        Returns the contents of the settings file. The file is only read again
+        if its modification time changed since it was last read or written.
+
+        :return: settings or None if the file does not exist
+        :rtype: dict
+        """
+        path = str(self.metadata.env_settings.abspath)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._settings = self._settings_mtime = None
+            return None
+        if self._settings is None or mtime != self._settings_mtime:
+            self._settings = self.metadata.env_settings.load_json()
+            self._settings_mtime = mtime
+        return self._settings
+
+    def _write_settings(self, settings):
+        """Writes the settings file and updates the cached settings"""
+        write_atomic(self.metadata.env_settings.abspath,
+                     json.dumps(settings, indent=4))
+        self._settings = settings
+        self._settings_mtime = os.stat(
+            str(self.metadata.env_settings.abspath)).st_mtime_ns
+
     @property
     def __meta(self):
-        if not self.metadata.env_settings.exists():
+        settings = self._read_settings()
+        if settings is None:
             self.save()
-        return self.metadata.env_settings.load_json()
+            settings = self._read_settings()
+        return settings
 
     @property
     def current_env(self):
@@ -566,7 +1134,9 @@ class SessionManager(ODir):
         if name is None:
             return
         if name in self.sessions:
-            self._curr_session_name = name
+            if name != self._curr_session_name:
+                self._curr_session_name = name
+                self._dirty = True
         else:
             logger.warning("'{}' not in sessions ({})".format(
                 name, ', '.join(self.sessions.keys())))
@@ -579,9 +1149,8 @@ class SessionManager(ODir):
 
     @property
     def sessions(self):
-        """Returns all sessions"""
-        return {env.name: env.aquarium_session
-                for env in self.session_env_list}
+        """Returns all sessions by name. Sessions are logged in lazily."""
+        return SessionMapping(self.session_env_list)
 
     def get_session(self, name):
         """Gets a AqSession by name"""
@@ -594,19 +1163,44 @@ class SessionManager(ODir):
         session_env = self.get(name)
         session_env.rmdirs()
         session_env.remove_parent()
+        if self._curr_session_name == name:
+            self._curr_session_name = None
+        self._dirty = True
 
     def move_repo(self, path):
         """Move all of the folders to a new location"""
         super().mvdirs(path)
+        self._dirty = True
         self.save()
 
     def __new_encryption_key(self):
         return Fernet.generate_key()
 
-    def save(self, force_new_key=False, key=None):
-        """Save the metadata"""
+    @property
+    def is_dirty(self):
+        """Whether there are changes that have not been saved"""
+        return self._dirty
+
+    def save(self, force_new_key=False, key=None, force=False):
+        """
+        Save the metadata and the session registry. Nothing is written
+        unless something changed since the last save or load.
+
+        :param force_new_key: write a new encryption key
+        :type force_new_key: bool
+        :param key: encryption key to write (generated if None)
+        :type key: str
+        :param force: save even if nothing changed
+        :type force: bool
+        :return: whether anything was written
+        :rtype: bool
+        """
+        settings = self._read_settings()
+        settings_exist = settings is not None
+        if settings_exist and not (self._dirty or force or force_new_key):
+            return False
         encryption_key = None
-        if not self.metadata.env_settings.exists() or force_new_key:
+        if not settings_exist or force_new_key:
             if key is None:
                 logger.warning(
                     "No encryption key found. Generating new key...")
@@ -614,9 +1208,8 @@ class SessionManager(ODir):
             else:
                 encryption_key = key
         else:
-            encryption_key = self.metadata.env_settings.load_json()[
-                'encryption_key']
-        self.metadata.env_settings.dump_json(
+            encryption_key = settings['encryption_key']
+        self._write_settings(
             {
                 "root": str(self.abspath),
                 'current': self._curr_session_name,
@@ -624,9 +1217,10 @@ class SessionManager(ODir):
                 "version": __version__,
                 "encryption_key": encryption_key,
                 "container_id": self.get_container_id()
-            },
-            indent=4)
+            })
         self.save_environments()
+        self._dirty = False
+        return True
 
     def load(self, meta=None):
         """Load from the metadata"""
@@ -641,13 +1235,19 @@ class SessionManager(ODir):
         encryption_key = meta['encryption_key']
         env = self.load_environments(encryption_key)
         env.set_current(meta['current'])
-        self.save()
+        # state on disk now matches memory; only record the new version
+        self._dirty = __version__ != meta['version']
         return env
 
     def save_environments(self):
-        """Save all of the session environments"""
-        for session_env in self.session_env_list:
-            session_env.save_to_pkl()
+        """Save all of the session environments to the session registry"""
+        write_if_changed(self.session_registry.abspath, json.dumps(
+            {
+                "version": __version__,
+                "sessions": {env.name: env.to_registry()
+                             for env in self.session_env_list}
+            },
+            indent=4, sort_keys=True))
 
     def update_encryption_key(self, new_key):
         """
@@ -657,16 +1257,17 @@ class SessionManager(ODir):
         for session_env in self.session_env_list:
             if session_env:
                 session_env.update_encryption_key(old_key, new_key)
+                self._dirty = True
 
-    # TODO: consolidate password hashes here
     def load_environments(self, encryption_key):
         """
-        Collects the SessionEnvironment pickles and returns a SessionManager
-        with these session_environments.
+        Reads the session registry and returns a SessionManager with its
+        session_environments. Sessions are not logged in until they are used.
 
         For examples `dir="User/Documents/Fishtank"` would load a
         SessionManager with the name "Fishtank."
-        Environments would be loaded from `User/Documents/FishTank/*/.env_pkl`
+        Environments would be loaded from
+        `User/Documents/FishTank/.session_registry.json`
         """
         meta = self.__meta
         self.name = os.path.basename(self.metadata.env_settings.name)
@@ -677,29 +1278,39 @@ class SessionManager(ODir):
         self.set_dir(root_dir)
         self.name = root_name
 
+        if self.session_registry.exists():
+            registry = self.session_registry.load_json()
+            for entry in registry['sessions'].values():
+                self._add_session_env(SessionEnvironment.from_registry(
+                    entry, encryption_key))
+        else:
+            self._load_legacy_environments(encryption_key)
+        self.set_current(meta['current'])
+        return self
+
+    def _load_legacy_environments(self, encryption_key):
+        """Loads environments pickled by older versions of ParrotFish"""
         env_pkls = glob(os.path.join(str(self.abspath),
                                      "*", SessionEnvironment.ENV_PKL))
-        for env_pkl in env_pkls:
+        for env_pkl in sorted(env_pkls):
             session_env = SessionEnvironment.load_from_pkl(
                 env_pkl, encryption_key)
-            if session_env is not None:
-                self._add_session_env(session_env)
-        self.set_current(meta['current'])
-        return self
+            self._add_session_env(session_env)
+        if env_pkls:
+            logger.warning("Converted {} pickled session(s) to \"{}\"".format(
+                len(env_pkls), self.session_registry.abspath))
+            self.save_environments()
 
     def get_container_id(self):
-        try:
-            with self.metadata.env_settings.open(mode='r') as f:
-                settings = json.load(f)
-                return settings.get('container_id', '')
-        except FileNotFoundError:
+        settings = self._read_settings()
+        if settings is None:
             return ''
+        return settings.get('container_id', '')
 
     def set_container_id(self, cid):
-        with self.metadata.env_settings.open(mode='r') as f:
-            settings = json.load(f)
-            settings['container_id'] = cid
-            self.metadata.env_settings.write(json.dumps(settings), 'w')
+        settings = dict(self.__meta)
+        settings['container_id'] = cid
+        self._write_settings(settings)
 
     def __str__(self):
         return "SessionManager(\n" \
@@ -710,7 +1321,7 @@ class SessionManager(ODir):
                "  container_id=\"{container_id}\")".format(
                    name=self.name,
                    metadata=str(self.metadata.env_settings.abspath),
-                   current=self.current_session,
+                   current=self._curr_session_name,
                    container_id=self.get_container_id(),
                    dir=str(self.abspath)
                )
@@ -8,6 +8,7 @@ import re
 
 import fire
 from parrotfish.utils import CustomLogging, get_callables
+from parrotfish.utils.completion_cache import CompletionCache
 from prompt_toolkit import prompt
 from prompt_toolkit.contrib.completers import WordCompleter, PathCompleter
 from prompt_toolkit.styles import style_from_dict
@@ -46,6 +47,22 @@ class CustomCompleter(WordCompleter):
                 yield c
 
 
+class DynamicCompleter(CustomCompleter):
+    """
+    Completer whose words are recomputed by a function every time
+    completions are requested, so completions loaded in the background show
+    up without rebuilding the prompt.
+    """
+
+    def __init__(self, get_words, **kwargs):
+        super().__init__([], **kwargs)
+        self.get_words = get_words
+
+    def get_completions(self, document, complete_event):
+        self.words = self.get_words()
+        return super().get_completions(document, complete_event)
+
+
 class Shell(object):
 
     PROMPT_STYLE = style_from_dict({
@@ -68,14 +85,30 @@ class Shell(object):
 
     EXIT = -1
 
-    def __init__(self, cli_instance):
+    # seconds before category completions are refreshed from the server
+    COMPLETION_TTL = 300
+
+    def __init__(self, cli_instance, completion_ttl=COMPLETION_TTL):
         self.cli = cli_instance
+        self.category_cache = CompletionCache(ttl=completion_ttl)
+        self._words = (None, [])
 
     @property
     def commands(self):
         return get_callables(self.cli.__class__)
 
-    def command_completer(self):
+    def _categories(self):
+        """Cached category names of the current session"""
+        env = self.cli._session_manager.current_env
+        if env is None:
+            return []
+        categories = self.category_cache.get(
+            env.name, lambda: list(self.cli._get_categories().keys()))
+        return categories or []
+
+    def completion_words(self):
+        """Returns all completion words, rebuilding them only when the
+        available categories or sessions change"""
         def add_completions(*iterables):
             words = []
             products = itertools.product(*iterables)
@@ -85,18 +118,26 @@ class Shell(object):
                     words.append(' '.join(partial_prod))
             return list(set(words))
 
+        categories = self._categories()
+        sessions = sorted(self.cli._session_manager.sessions.keys())
+        key = (tuple(categories), tuple(sessions))
+        if self._words[0] == key:
+            return self._words[1]
+
         completions = []
-        if self.cli._session_manager.current_session:
-            categories = list(self.cli._get_categories().keys())
+        if categories:
             completions += add_completions(['fetch'], categories)
+            completions += ['fetch --all']
             completions += add_completions(['push_category'], categories)
-        if self.cli._session_manager.sessions:
-            completions += add_completions(
-                ['set_session'],
-                self.cli._session_manager.sessions.keys())
+        if sessions:
+            completions += add_completions(['set_session'], sessions)
         completions += ["exit"]
         completions += self.commands
-        return CustomCompleter(list(set(completions)))
+        self._words = (key, list(set(completions)))
+        return self._words[1]
+
+    def command_completer(self):
+        return DynamicCompleter(self.completion_words)
 
     def parse_shell_command(self, command):
         args = re.split('\\s+', command)
@@ -159,10 +200,11 @@ class Shell(object):
         login = '<not logged in>'
         url = '<???>'
         name = '<NO SESSION>'
-        if self.cli._session_manager.current_session:
-            login = self.cli._session_manager.current_session.login
-            url = self.cli._session_manager.current_session.url
-            name = self.cli._session_manager.current_session.name
+        env = self.cli._session_manager.current_env
+        if env is not None:
+            login = env.login
+            url = env.aquarium_url
+            name = env.name
 
         return [
             (Token.Username, login),
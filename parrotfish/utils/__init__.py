@@ -5,9 +5,7 @@ General utilities
 import json
 from os import sep
 
-import inflection
-
-from .diff import compare_content
+from .diff import compare_content, content_equal, Diff
 from .log import CustomLogging
 
 def sanitize_filename(name):
@@ -23,6 +21,7 @@ def format_json(j):
 
 
 def attributerize(word):
+    import inflection
     return inflection.parameterize(word).replace('-', '_')
 
 
@@ -0,0 +1,74 @@
+"""
+Completion data refreshed in the background
+"""
+
+import threading
+import time
+
+from parrotfish.utils.log import CustomLogging
+
+logger = CustomLogging.get_logger(__name__)
+
+
+class CompletionCache(object):
+    """
+    Caches completion data by key (e.g. session name). Values older than
+    `ttl` seconds are refreshed in a background thread, so reading from the
+    cache never blocks on the server. Until the first refresh finishes, the
+    previous value (or None) is returned.
+    """
+
+    def __init__(self, ttl=300):
+        """
+        CompletionCache constructor
+
+        :param ttl: seconds before a cached value is refreshed
+        :type ttl: int
+        """
+        self.ttl = ttl
+        self._values = {}
+        self._loaded_at = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, starting a background refresh with
+        loader if the value is missing or older than the ttl.
+
+        :param key: cache key
+        :type key: hashable
+        :param loader: function returning a fresh value
+        :type loader: callable
+        :return: cached value or None
+        """
+        with self._lock:
+            loaded_at = self._loaded_at.get(key)
+            stale = loaded_at is None or \
+                time.monotonic() - loaded_at > self.ttl
+            if stale and key not in self._refreshing:
+                self._refreshing.add(key)
+                thread = threading.Thread(
+                    target=self._refresh, args=(key, loader), daemon=True)
+                thread.start()
+            return self._values.get(key)
+
+    def _refresh(self, key, loader):
+        try:
+            value = loader()
+        except Exception as e:
+            logger.debug("Could not refresh completions: {}".format(e))
+            value = None
+        with self._lock:
+            if value is not None:
+                self._values[key] = value
+            self._loaded_at[key] = time.monotonic()
+            self._refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        """Marks one or all cached values as stale"""
+        with self._lock:
+            if key is None:
+                self._loaded_at.clear()
+            else:
+                self._loaded_at.pop(key, None)
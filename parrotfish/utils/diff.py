@@ -28,8 +28,190 @@ def color_diff(diff):
             yield line
 
 
+def content_equal(content1, content2):
+    """
+    Whether two strings are equal, without computing a diff.
+    Strings of different lengths are told apart without comparing their
+    characters.
+
+    :param content1: first string
+    :type content1: str
+    :param content2: second string
+    :type content2: str
+    :return: True if the strings are equal
+    :rtype: bool
+    """
+    if content1 is content2:
+        return True
+    if content1 is None or content2 is None:
+        return False
+    if len(content1) != len(content2):
+        return False
+    return content1 == content2
+
+
+def _format_range(start, stop):
+    """Formats a hunk range like :func:`difflib.unified_diff`"""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+
+def _common_prefix(content1, content2):
+    """Length of the longest common prefix, found by bisection so the
+    characters are compared in C rather than one by one"""
+    lo, hi = 0, min(len(content1), len(content2))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if content1[:mid] == content2[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(content1, content2, limit):
+    """Length of the longest common suffix no longer than limit"""
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if content1[len(content1) - mid:] == content2[len(content2) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def shared_lines(content1, content2):
+    """
+    Counts the lines shared by the beginning and by the end of two strings
+
+    :param content1: first string
+    :type content1: str
+    :param content2: second string
+    :type content2: str
+    :return: number of shared leading and trailing lines of
+             `content.split('\\n')`
+    :rtype: tuple
+    """
+    if content1 == content2:
+        return content1.count('\n') + 1, 0
+    # start of the first line that differs
+    head = content1.rfind('\n', 0, _common_prefix(content1, content2)) + 1
+    prefix = content1.count('\n', 0, head)
+
+    tail = _common_suffix(content1, content2,
+                          min(len(content1), len(content2)) - head)
+    if tail == 0:
+        return prefix, 0
+    start1 = len(content1) - tail
+    start2 = len(content2) - tail
+    if (start1 == 0 or content1[start1 - 1] == '\n') and \
+            (start2 == 0 or content2[start2 - 1] == '\n'):
+        return prefix, content1.count('\n', start1) + 1
+    # otherwise the shared lines start after a newline inside the shared tail
+    newline = content1.find('\n', start1)
+    if newline == -1:
+        return prefix, 0
+    return prefix, content1.count('\n', newline + 1) + 1
+
+
+def unified_diff(lines1, lines2, n=3, prefix=None, suffix=None):
+    """
+    Unified diff with hunks equivalent to those of
+    :func:`difflib.unified_diff` (with `lineterm=''`), but lines shared by
+    the beginning and end of both inputs are skipped before matching, so a
+    small edit to a very large file is diffed in time proportional to the
+    size of the edit rather than the file. Since the shared lines are not
+    matched, repeated lines may be aligned differently than by difflib.
+
+    :param lines1: lines of the old version
+    :type lines1: list
+    :param lines2: lines of the new version
+    :type lines2: list
+    :param n: number of context lines
+    :type n: int
+    :param prefix: number of shared leading lines, if known
+    :type prefix: int
+    :param suffix: number of shared trailing lines, if known
+    :type suffix: int
+    :return: generator of diff lines
+    :rtype: generator
+    """
+    len1, len2 = len(lines1), len(lines2)
+    if prefix is None:
+        prefix = 0
+        while prefix < min(len1, len2) and \
+                lines1[prefix] == lines2[prefix]:
+            prefix += 1
+    if suffix is None:
+        suffix = 0
+        while suffix < min(len1, len2) - prefix and \
+                lines1[len1 - 1 - suffix] == lines2[len2 - 1 - suffix]:
+            suffix += 1
+    if prefix + suffix >= len1 == len2:
+        # every line is shared
+        return
+
+    # keep enough shared lines around the change for the context
+    start = max(prefix - n, 0)
+    end1 = len1 - max(suffix - n, 0)
+    end2 = len2 - max(suffix - n, 0)
+    matcher = difflib.SequenceMatcher(
+        None, lines1[start:end1], lines2[start:end2])
+
+    yield '--- '
+    yield '+++ '
+    for group in matcher.get_grouped_opcodes(n):
+        first, last = group[0], group[-1]
+        yield '@@ -{} +{} @@'.format(
+            _format_range(start + first[1], start + last[2]),
+            _format_range(start + first[3], start + last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in lines1[start + i1:start + i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in lines1[start + i1:start + i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in lines2[start + j1:start + j2]:
+                    yield '+' + line
+
+
+class Diff(object):
+    """
+    Lazily rendered, colored diff between two strings. Nothing is computed
+    until the diff is displayed with `str` (e.g. when it is printed), so a
+    diff can be created wherever a change is reported at no cost if it is
+    never shown.
+    """
+
+    def __init__(self, content1, content2):
+        self.content1 = content1
+        self.content2 = content2
+
+    def __bool__(self):
+        return not content_equal(self.content1, self.content2)
+
+    def lines(self):
+        """Returns a generator of colored diff lines"""
+        if content_equal(self.content1, self.content2):
+            return iter([])
+        prefix, suffix = shared_lines(self.content1, self.content2)
+        return color_diff(unified_diff(
+            self.content1.split('\n'), self.content2.split('\n'),
+            prefix=prefix, suffix=suffix))
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
 def compare_content(content1, content2):
-    lines1 = content1.split('\n')
-    lines2 = content2.split('\n')
-    diff = color_diff(difflib.unified_diff(lines1, lines2))
-    return ''.join(diff)
+    """Returns the colored diff between two strings"""
+    return str(Diff(content1, content2))
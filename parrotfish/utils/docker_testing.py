@@ -5,7 +5,17 @@ Methods for testing Operation Types in a Docker container
 import json as j
 import os
 import subprocess
-from pydent import AqSession
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from parrotfish.utils.transport import use_shared_transport
+
+# url of the Aquarium server of the container
+AQUARIUM_URL = 'http://localhost:3001/'
+
+# records of the test data that several protocols usually share
+SHARED_RECORDS = ['sample_types', 'object_types']
 
 
 def get_records(session, protocol, records, record_names):
@@ -93,11 +103,15 @@ def make_record(session, name, model_string, data, record_dict):
     record = None
 
     if model_name == "sample_type":
-        record = session.SampleType.load(data)
-        record.save()
+        record = session.SampleType.find_by_name(data['name'])
+        if record is None:
+            record = session.SampleType.load(data)
+            record.save()
     elif model_name == "object_type":
-        record = session.ObjectType.load(data)
-        record.save()
+        record = session.ObjectType.find_by_name(data['name'])
+        if record is None:
+            record = session.ObjectType.load(data)
+            record.save()
     elif model_name == "sample":
         try:
             record = session.Sample.load(data)
@@ -196,6 +210,39 @@ def test_protocol(protocol, record_dict):
     }
 
 
+def container_session():
+    """Opens a session with the running container"""
+    from pydent import AqSession
+    return use_shared_transport(
+        AqSession('neptune', 'aquarium', AQUARIUM_URL))
+
+
+def read_test_data(protocol):
+    """Reads the test data of a protocol"""
+    with protocol.open_file('testing/data.json', mode='r') as f:
+        return j.load(f)
+
+
+def load_shared_records(protocols, session=None):
+    """
+    Creates the sample and object types of the test data of several
+    protocols, one protocol at a time, so that protocols loaded concurrently
+    afterwards find them instead of creating the same names twice
+
+    :param protocols: directories that manage the protocols
+    :type protocols: list
+    :param session: session with container
+    :type session: AqSession
+    :return: None
+    :rtype: None
+    """
+    if session is None:
+        session = container_session()
+    for protocol in protocols:
+        get_records(session, protocol, read_test_data(protocol)['records'],
+                    SHARED_RECORDS)
+
+
 def load_data(protocol):
     """
     Open a session with running container
@@ -206,18 +253,13 @@ def load_data(protocol):
     :rtype: dict
     """
     # OPEN A SESSION
-    session = AqSession('neptune', 'aquarium', 'http://localhost:3001/')
+    session = container_session()
 
     # READ THAT JSON
-    # protocol = environment.get_protocol_dir(cat_name, prot_name)
-    test_data = None
-    with protocol.open_file('testing/data.json', mode='r') as f:
-        test_data = j.load(f)
+    test_data = read_test_data(protocol)
 
     # GET THOSE RECORDS
-    record_names = [
-        'sample_types',
-        'object_types',
+    record_names = SHARED_RECORDS + [
         'operation_types',
         'samples',
         'items',
@@ -229,60 +271,189 @@ def load_data(protocol):
     return record_dict
 
 
-def start_container(reset, cid):
+def probe(url, timeout=5):
     """
-    Start a Docker container
-
-    :param reset: kill the running container if one exists
-    :type reset: bool
-    :return: whether a new container was started
+    Whether a server answers HTTP requests at url (any response other than
+    a server error)
+
+    :param url: url to request
+    :type url: str
+    :param timeout: seconds to wait for a response
+    :type timeout: float
+    :return: whether the server is ready
     :rtype: bool
     """
-    # CHECK IF DOCKER CONTAINER IS RUNNING ALREADY
-    if cid == '':
-        running = False
-    else:
-        command = 'sudo docker ps -aq'
-        check_running = subprocess.Popen(
-            command.split(), stdout=subprocess.PIPE)
-        output, error = check_running.communicate()
-        running_ids = [rid.decode('utf-8') for rid in output.split(b'\n')]
-
-        running = cid in running_ids
-        if not running:
-            cid = ''
-
-    if reset or not running:
-        # RUN THIS DOCKER CONTAINER
-        print('Starting Aquarium container...')
-        here = os.path.abspath(os.path.dirname(__file__))
-        start = subprocess.Popen([
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return response.status < 500
+    except HTTPError as e:
+        return e.code < 500
+    except (URLError, OSError):
+        return False
+
+
+def wait_until_ready(url=AQUARIUM_URL, timeout=300, delay=0.5, max_delay=8,
+                     check=probe):
+    """
+    Polls a server until it is ready, doubling the delay between attempts
+    up to `max_delay` seconds
+
+    :param url: url to request
+    :type url: str
+    :param timeout: seconds to wait before giving up
+    :type timeout: float
+    :param delay: seconds to wait after the first failed attempt
+    :type delay: float
+    :param max_delay: maximum seconds between attempts
+    :type max_delay: float
+    :param check: function telling whether the server at a url is ready
+    :type check: callable
+    :return: seconds waited
+    :rtype: float
+    """
+    start = time.monotonic()
+    while True:
+        if check(url):
+            return time.monotonic() - start
+        elapsed = time.monotonic() - start
+        if elapsed >= timeout:
+            raise TimeoutError("Aquarium at {} not ready after {:.0f}s".format(
+                url, elapsed))
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, max_delay)
+
+
+class DockerCommands(object):
+    """Runs and kills the Aquarium container with docker"""
+
+    here = os.path.abspath(os.path.dirname(__file__))
+
+    def running_ids(self):
+        """Returns the ids of the running containers"""
+        output = subprocess.run(['sudo', 'docker', 'ps', '-q'],
+                                stdout=subprocess.PIPE).stdout
+        return [cid.decode('utf-8') for cid in output.split(b'\n') if cid]
+
+    def run(self, cid):
+        """Starts a new container (killing cid) and returns its id"""
+        output = subprocess.run([
             'bash',
-            '{}/docker_container.sh'.format(here),
+            '{}/docker_container.sh'.format(self.here),
             'run',
             str(cid)
-        ], stdout=subprocess.PIPE)
-        output, error = start.communicate()
-        cid = output.split(b'\n')[-2].decode('utf-8')
+        ], stdout=subprocess.PIPE).stdout
+        return output.split(b'\n')[-2].decode('utf-8')
+
+    def kill(self, cid):
+        """Kills a container"""
+        subprocess.call([
+            'bash',
+            '{}/docker_container.sh'.format(self.here),
+            'kill',
+            cid,
+        ])
+
 
-        return {
-            'success': True,
-            'id': cid
-        }
+class AquariumContainer(object):
+    """
+    Aquarium Docker container kept warm between test runs.
+
+    A running container is reused unless a reset is requested, and the
+    container is only considered started once Aquarium answers HTTP requests.
+    The time taken to start, become ready and stop is recorded in `timings`.
+    """
+
+    def __init__(self, container_id='', url=AQUARIUM_URL, docker=None,
+                 timeout=300, delay=0.5, max_delay=8):
+        """
+        AquariumContainer constructor
+
+        :param container_id: id of a previously started container
+        :type container_id: str
+        :param url: url of the Aquarium server of the container
+        :type url: str
+        :param docker: commands controlling the container
+        :type docker: DockerCommands
+        :param timeout: seconds to wait for Aquarium to be ready
+        :type timeout: float
+        :param delay: seconds between the first readiness probes
+        :type delay: float
+        :param max_delay: maximum seconds between readiness probes
+        :type max_delay: float
+        """
+        self.container_id = container_id or ''
+        self.url = url
+        self.docker = docker or DockerCommands()
+        self.timeout = timeout
+        self.delay = delay
+        self.max_delay = max_delay
+        self.timings = {}
+
+    def is_running(self):
+        """Whether the container is running"""
+        return self.container_id != '' and \
+            self.container_id in self.docker.running_ids()
+
+    def start(self, reset=False):
+        """
+        Makes sure a container is running and ready, reusing the running
+        container unless reset is set
+
+        :param reset: restart the container
+        :type reset: bool
+        :return: whether a new container was started
+        :rtype: bool
+        """
+        start = time.monotonic()
+        started = False
+        if reset or not self.is_running():
+            print('Starting Aquarium container...')
+            self.container_id = self.docker.run(self.container_id)
+            started = True
+        self.timings['start'] = time.monotonic() - start
+        self.timings['ready'] = wait_until_ready(
+            self.url, timeout=self.timeout, delay=self.delay,
+            max_delay=self.max_delay)
+        return started
+
+    def stop(self):
+        """
+        Kills the container
+
+        :return: whether a container was running
+        :rtype: bool
+        """
+        if self.container_id == '':
+            return False
+        start = time.monotonic()
+        self.docker.kill(self.container_id)
+        self.container_id = ''
+        self.timings['stop'] = time.monotonic() - start
+        return True
 
+
+def start_container(reset, cid):
+    """
+    Start a Docker container unless a warm one is running
+
+    :param reset: kill the running container if one exists
+    :type reset: bool
+    :param cid: id of the last container started
+    :type cid: str
+    :return: whether a new container was started, its id and the timings
+    :rtype: dict
+    """
+    container = AquariumContainer(cid)
+    started = container.start(reset)
     return {
-        'success': False,
-        'id': cid
+        'success': started,
+        'id': container.container_id,
+        'timings': container.timings
     }
 
 
 def stop_container(cid):
     """ Stop a Docker container """
-    # KILL THIS DOCKER CONTAINER
-    here = os.path.abspath(os.path.dirname(__file__))
-    subprocess.call([
-        'bash',
-        '{}/docker_container.sh'.format(here),
-        'kill',
-        cid,
-    ])
+    container = AquariumContainer(cid)
+    container.stop()
+    return container.timings
@@ -0,0 +1,124 @@
+"""
+Atomic file writes that leave unchanged files untouched
+"""
+
+import json
+import os
+import threading
+
+
+def _encode(content):
+    if isinstance(content, str):
+        return content.encode('utf-8')
+    return content
+
+
+def write_atomic(path, content):
+    """
+    Writes a file by writing a temporary file next to it and renaming it, so
+    the file is never left half-written.
+
+    :param path: path of the file
+    :type path: str
+    :param content: text or bytes to write
+    :type content: str | bytes
+    :return: None
+    :rtype: None
+    """
+    path = str(path)
+    dirname, basename = os.path.split(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = os.path.join(dirname, '.{}.{}.{}.tmp'.format(
+        basename, os.getpid(), threading.get_ident()))
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(_encode(content))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def is_unchanged(path, content):
+    """
+    Whether a file already contains exactly the given content
+
+    :param path: path of the file
+    :type path: str
+    :param content: text or bytes
+    :type content: str | bytes
+    :return: True if the file exists with the same bytes
+    :rtype: bool
+    """
+    content = _encode(content)
+    try:
+        if os.stat(str(path)).st_size != len(content):
+            return False
+        with open(str(path), 'rb') as f:
+            return f.read() == content
+    except FileNotFoundError:
+        return False
+
+
+def write_if_changed(path, content):
+    """
+    Atomically writes a file unless it already has the same content, in
+    which case the file (and its modification time) is left untouched.
+
+    :param path: path of the file
+    :type path: str
+    :param content: text or bytes to write
+    :type content: str | bytes
+    :return: whether the file was written
+    :rtype: bool
+    """
+    if is_unchanged(path, content):
+        return False
+    write_atomic(path, content)
+    return True
+
+
+class FileWriter(object):
+    """
+    Writes files with :func:`write_if_changed` and counts how many files
+    were modified. Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.modified = 0
+        self.unchanged = 0
+        self._lock = threading.Lock()
+
+    def record(self, changed):
+        """Counts a file written by other means"""
+        with self._lock:
+            if changed:
+                self.modified += 1
+            else:
+                self.unchanged += 1
+        return changed
+
+    def write(self, path, content):
+        """
+        Writes a file if its content changed
+
+        :param path: path of the file
+        :type path: str
+        :param content: text or bytes to write
+        :type content: str | bytes
+        :return: whether the file was written
+        :rtype: bool
+        """
+        return self.record(write_if_changed(path, content))
+
+    def dump_json(self, path, data, **kwargs):
+        """Same as :meth:`write` for json serializable data"""
+        return self.write(path, json.dumps(data, **kwargs))
+
+    def reset(self):
+        """Resets the counts"""
+        with self._lock:
+            self.modified = 0
+            self.unchanged = 0
@@ -0,0 +1,229 @@
+"""
+Identity map and shared storage for records referenced by several protocols
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from parrotfish.utils.files import is_unchanged, write_atomic
+
+
+class RecordCache(object):
+    """
+    Caches records (e.g. :class:`SampleType` and :class:`ObjectType`) and
+    their serialized json by (model name, id).
+
+    Most protocols in a category reference the same few sample and object
+    types. Registering records with :meth:`add` replaces every copy loaded
+    with a different OperationType by a single instance, and :meth:`dump`
+    serializes each record once no matter how many protocols reference it.
+
+    If a path is given, serialized records are also kept on disk and reused
+    by the next fetch as long as the record's `updated_at` is unchanged.
+    """
+
+    def __init__(self, path=None):
+        """
+        RecordCache constructor
+
+        :param path: location of the cache file or None to keep the cache in
+                     memory only
+        :type path: str
+        """
+        self.path = None if path is None else str(path)
+        self._records = {}
+        self._dumps = None
+        self._key_locks = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(rec):
+        return RecordCache.model_key(rec.__class__.__name__, rec.id)
+
+    @staticmethod
+    def model_key(model_name, rec_id):
+        return '{}/{}'.format(model_name, rec_id)
+
+    def add(self, rec):
+        """
+        Returns the cached instance of a record, caching the record if it was
+        not seen before.
+
+        :param rec: record to cache
+        :type rec: ModelBase
+        :return: the cached record or None if rec is None
+        :rtype: ModelBase
+        """
+        if rec is None:
+            return None
+        with self._lock:
+            return self._records.setdefault(self.key(rec), rec)
+
+    def add_records(self, records):
+        """Same as :meth:`add` for a list of records"""
+        return [self.add(rec) for rec in records]
+
+    def resolve(self, session, model_name, ids):
+        """
+        Returns the cached records with the given ids, fetching the ids that
+        were not seen before with a single query.
+
+        :param session: session used to fetch unknown records
+        :type session: AqSession
+        :param model_name: model of the records (e.g. 'SampleType')
+        :type model_name: str
+        :param ids: record ids, in the order of the returned records
+        :type ids: list
+        :return: records or None for ids that are None or do not exist
+        :rtype: list
+        """
+        with self._lock:
+            missing = sorted(set(
+                i for i in ids if i is not None and
+                self.model_key(model_name, i) not in self._records))
+        if missing:
+            interface = getattr(session, model_name)
+            self.add_records(interface.where({'id': missing}))
+        with self._lock:
+            return [None if i is None else
+                    self._records.get(self.model_key(model_name, i))
+                    for i in ids]
+
+    def _load(self):
+        if self._dumps is None:
+            self._dumps = {}
+            if self.path is not None and os.path.isfile(self.path):
+                with open(self.path, 'r') as f:
+                    self._dumps = json.load(f)
+
+    def dump(self, rec, dumper):
+        """
+        Returns the serialized json of a record, calling `dumper` only if the
+        record was not serialized before or changed since.
+
+        :param rec: record to serialize
+        :type rec: ModelBase
+        :param dumper: function serializing the record
+        :type dumper: callable
+        :return: serialized record
+        :rtype: dict
+        """
+        key = self.key(rec)
+        updated_at = str(getattr(rec, 'updated_at', None))
+        with self._lock:
+            self._load()
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # records are serialized at most once even if several protocols
+        # referencing them are written concurrently
+        with key_lock:
+            entry = self._dumps.get(key)
+            if entry is None or entry['updated_at'] != updated_at:
+                entry = {'updated_at': updated_at, 'data': dumper(rec)}
+                with self._lock:
+                    self._dumps[key] = entry
+                    self._dirty = True
+            return entry['data']
+
+    def save(self):
+        """Writes the serialized records if the cache is kept on disk and
+        anything changed"""
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            write_atomic(self.path, json.dumps(self._dumps, sort_keys=True))
+            self._dirty = False
+
+
+class RecordStore(object):
+    """
+    Content-addressed store keeping a single copy of every serialized record
+    of a session.
+
+    Files written through the store are hard links to the stored copy named
+    after the sha1 of its content, so the `sample_types` and `object_types`
+    folders of every OperationType keep their usual files (and `source` paths
+    in test data keep resolving) without duplicating identical records on
+    disk. Files are copied instead if the file system does not support hard
+    links, and copies whose content did not change are left untouched. Since
+    linked files share their content, record files should not be edited in
+    place.
+    """
+
+    def __init__(self, path):
+        """
+        RecordStore constructor
+
+        :param path: directory of the store
+        :type path: str
+        """
+        self.path = str(path)
+        # whether files are copied because hard links are not supported
+        self.copies = False
+        self._written = set()
+        self._lock = threading.Lock()
+
+    def write(self, target, text):
+        """
+        Stores text and links it to target.
+
+        :param target: path of the record file in a protocol folder
+        :type target: str
+        :param text: serialized record
+        :type text: str
+        :return: whether target was modified
+        :rtype: bool
+        """
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        source = os.path.join(self.path, digest + '.json')
+        with self._lock:
+            self._written.add(digest)
+        if not os.path.isfile(source):
+            write_atomic(source, text)
+
+        target = str(target)
+        unchanged = False
+        if os.path.isfile(target):
+            if os.path.samefile(source, target):
+                return False
+            unchanged = is_unchanged(target, text)
+            if unchanged and self.copies:
+                return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        dirname, basename = os.path.split(target)
+        tmp = os.path.join(dirname, '.{}.{}.{}.link'.format(
+            basename, os.getpid(), threading.get_ident()))
+        try:
+            os.link(source, tmp)
+        except OSError:
+            self.copies = True
+            if unchanged:
+                return False
+            write_atomic(target, text)
+            return True
+        os.replace(tmp, target)
+        return not unchanged
+
+    def prune(self):
+        """
+        Deletes stored records that were not written through this store and
+        are no longer linked from any protocol.
+
+        :return: number of deleted records
+        :rtype: int
+        """
+        if not os.path.isdir(self.path):
+            return 0
+        removed = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not name.endswith('.json') or \
+                    name[:-len('.json')] in self._written:
+                continue
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+                removed += 1
+        return removed
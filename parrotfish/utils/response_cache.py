@@ -0,0 +1,206 @@
+"""
+On-disk cache of read-only Aquarium queries
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from parrotfish.utils.files import write_atomic
+
+# set to False (e.g. with `pfish --no-cache`) to bypass every cache
+_ENABLED = True
+
+
+def set_enabled(enabled):
+    """
+    Enables or disables response caching for every session of the process
+
+    :param enabled: whether cached responses may be used
+    :type enabled: bool
+    :return: None
+    :rtype: None
+    """
+    global _ENABLED
+    _ENABLED = bool(enabled)
+
+
+def is_enabled():
+    """Whether response caching is enabled for the process"""
+    return _ENABLED
+
+
+class ResponseCache(object):
+    """
+    Stores responses to read-only queries of a single session in a directory,
+    one json file per query.
+
+    Responses younger than `max_age` seconds are served without contacting
+    the server. Older responses are revalidated: the query is sent with the
+    stored ETag (`If-None-Match`), and a response that is not modified (a
+    304, or the same records with the same `updated_at`) only renews the
+    stored one. Entries unused for `expire` seconds are deleted, and the
+    least recently used entries are deleted once the cache exceeds
+    `max_size` bytes.
+    """
+
+    def __init__(self, path, max_age=600, max_size=50 * 1024 * 1024,
+                 expire=7 * 24 * 3600):
+        """
+        ResponseCache constructor
+
+        :param path: directory of the cache
+        :type path: str
+        :param max_age: seconds during which a response is used without
+                        revalidation
+        :type max_age: float
+        :param max_size: maximum size of the cache in bytes
+        :type max_size: int
+        :param expire: seconds after which unused responses are deleted
+        :type expire: float
+        """
+        self.path = str(path)
+        self.max_age = max_age
+        self.max_size = max_size
+        self.expire = expire
+        self._sizes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, body):
+        """Returns the key of a query"""
+        digest = hashlib.sha1(url.encode('utf-8'))
+        digest.update(b'\n')
+        digest.update(json.dumps(body, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """
+        Returns a stored response
+
+        :param key: key of the query
+        :type key: str
+        :return: entry with 'body', 'headers', 'etag' and 'stored_at' keys,
+                 or None
+        :rtype: dict
+        """
+        try:
+            with open(self._file(key), 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # the modification time records the last use
+        try:
+            os.utime(self._file(key))
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def is_fresh(self, entry, now=None):
+        """Whether an entry can be used without revalidation"""
+        if now is None:
+            now = time.time()
+        return now - entry['stored_at'] < self.max_age
+
+    def put(self, key, body, headers=None, etag=None, now=None):
+        """
+        Stores a response
+
+        :param key: key of the query
+        :type key: str
+        :param body: body of the response
+        :type body: str
+        :param headers: headers to return with the cached response
+        :type headers: dict
+        :param etag: ETag of the response
+        :type etag: str
+        :param now: time the response was received
+        :type now: float
+        :return: the stored entry
+        :rtype: dict
+        """
+        entry = {
+            'body': body,
+            'headers': headers or {},
+            'etag': etag,
+            'stored_at': time.time() if now is None else now
+        }
+        text = json.dumps(entry)
+        with self._lock:
+            sizes = self._load_sizes()
+            write_atomic(self._file(key), text)
+            sizes[key] = len(text.encode('utf-8'))
+            self._evict(sizes)
+        return entry
+
+    def renew(self, key, entry, now=None):
+        """Marks a revalidated entry as fresh again"""
+        entry = dict(entry)
+        entry['stored_at'] = time.time() if now is None else now
+        return self.put(key, entry['body'], entry['headers'],
+                        entry['etag'], now=entry['stored_at'])
+
+    def _load_sizes(self):
+        """Reads the size of every entry, deleting expired entries"""
+        if self._sizes is None:
+            self._sizes = {}
+            if os.path.isdir(self.path):
+                now = time.time()
+                for name in os.listdir(self.path):
+                    if not name.endswith('.json') or name.startswith('.'):
+                        continue
+                    path = os.path.join(self.path, name)
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.expire:
+                        os.remove(path)
+                        continue
+                    self._sizes[name[:-len('.json')]] = stat.st_size
+        return self._sizes
+
+    def _evict(self, sizes):
+        """Deletes the least recently used entries until the cache fits"""
+        total = sum(sizes.values())
+        if total <= self.max_size:
+            return
+
+        def last_used(key):
+            try:
+                return os.stat(self._file(key)).st_mtime_ns
+            except FileNotFoundError:
+                return 0
+
+        for key in sorted(sizes, key=last_used):
+            if total <= self.max_size:
+                break
+            total -= sizes.pop(key)
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+    def size(self):
+        """Returns the size of the cache in bytes"""
+        with self._lock:
+            return sum(self._load_sizes().values())
+
+    def clear(self):
+        """
+        Deletes every stored response
+
+        :return: number of deleted responses
+        :rtype: int
+        """
+        with self._lock:
+            removed = len(self._load_sizes())
+            for key in list(self._sizes):
+                try:
+                    os.remove(self._file(key))
+                except FileNotFoundError:
+                    pass
+            self._sizes = {}
+        return removed
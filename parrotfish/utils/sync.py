@@ -0,0 +1,436 @@
+"""
+Bookkeeping for synchronizing local protocols with an Aquarium server
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from parrotfish.utils.files import write_atomic
+
+# code accessors for each protocol model
+CODE_ACCESSORS = {
+    'OperationType': ['protocol', 'precondition',
+                      'documentation', 'cost_model'],
+    'Library': ['source'],
+}
+
+# differences between local protocols and the server, in the order they are
+# reported by `pfish status`
+STATUSES = ('local_modified', 'remote_modified', 'conflicting', 'unsynced',
+            'local_only', 'remote_only')
+
+
+def hash_file(path):
+    """
+    Returns the sha1 hex digest of a file's bytes or None if the file does
+    not exist
+
+    :param path: path to the file
+    :type path: str
+    :return: hex digest
+    :rtype: str
+    """
+    try:
+        with open(str(path), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def latest_codes(session, parent_class, parent_ids, batch_size=200):
+    """
+    Retrieves the current :class:`Code` of many OperationTypes or Libraries
+    using one query per `batch_size` parents.
+
+    :param session: Aquarium session
+    :type session: AqSession
+    :param parent_class: 'OperationType' or 'Library'
+    :type parent_class: str
+    :param parent_ids: ids of the parents
+    :type parent_ids: iterable
+    :param batch_size: maximum number of parents per query
+    :type batch_size: int
+    :return: dictionary of parent id to a dictionary of accessor to Code
+    :rtype: dict
+    """
+    codes = {}
+    parent_ids = sorted(set(parent_ids))
+    for chunk in _chunks(parent_ids, batch_size):
+        query = {
+            'parent_class': parent_class,
+            'parent_id': chunk,
+            'child_id': None
+        }
+        for code in session.Code.where(query):
+            codes.setdefault(code.parent_id, {})[code.name] = code
+    return codes
+
+
+def keyset_criteria(query, last_id):
+    """
+    Returns criteria selecting the models matching a query whose id is
+    greater than `last_id`. Aquarium hands the criteria of a `where` query to
+    ActiveRecord, which cannot compare ids in a hash, so they are given as a
+    condition with its (sanitized) values.
+
+    :param query: query (e.g. {"category": "Cloning"})
+    :type query: dict
+    :param last_id: largest id already listed
+    :type last_id: int
+    :return: condition followed by its values
+    :rtype: list
+    """
+    conditions = []
+    values = []
+    for key, value in sorted(query.items()):
+        if value is None:
+            conditions.append('{} IS NULL'.format(key))
+        elif isinstance(value, (list, tuple)):
+            conditions.append('{} IN (?)'.format(key))
+            values.append(list(value))
+        else:
+            conditions.append('{} = ?'.format(key))
+            values.append(value)
+    conditions.append('id > ?')
+    values.append(last_id)
+    return [' AND '.join(conditions)] + values
+
+
+def iter_pages(interface, query, page_size=50):
+    """
+    Lists the models matching a query one page at a time, so that no more
+    than `page_size` models are loaded at once. Models are listed by
+    increasing id and each page starts after the last id of the previous one,
+    so models created or deleted on the server meanwhile never cause a model
+    to be skipped or listed twice.
+
+    :param interface: model interface (e.g. `session.OperationType`)
+    :type interface: QueryInterface
+    :param query: query (e.g. {"category": "Cloning"})
+    :type query: dict
+    :param page_size: number of models per page
+    :type page_size: int
+    :return: generator of lists of models
+    :rtype: generator
+    """
+    last_id = 0
+    while True:
+        page = interface.where(keyset_criteria(query, last_id),
+                               opts={'limit': page_size, 'order': 'id'})
+        page = sorted((m for m in page or [] if m.id > last_id),
+                      key=lambda m: m.id)
+        if page:
+            yield page
+            last_id = page[-1].id
+        if len(page) < page_size:
+            return
+
+
+def latest_codes_for(session, models, batch_size=200):
+    """
+    Retrieves the current :class:`Code` of a mixed list of OperationTypes and
+    Libraries.
+
+    :param session: Aquarium session
+    :type session: AqSession
+    :param models: OperationTypes and Libraries
+    :type models: list
+    :return: dictionary of (model class name, id) to a dictionary of accessor
+             to Code
+    :rtype: dict
+    """
+    return latest_codes_by_key(
+        session, [(m.__class__.__name__, m.id) for m in models],
+        batch_size=batch_size)
+
+
+def latest_codes_by_key(session, keys, batch_size=200):
+    """
+    Retrieves the current :class:`Code` of OperationTypes and Libraries
+    identified by (model class name, id) pairs, using one query per model
+    class and `batch_size` parents.
+
+    :param session: Aquarium session
+    :type session: AqSession
+    :param keys: (model class name, id) pairs
+    :type keys: list
+    :return: dictionary of (model class name, id) to a dictionary of accessor
+             to Code
+    :rtype: dict
+    """
+    snapshot = {}
+    for parent_class in CODE_ACCESSORS:
+        ids = [i for model_class, i in keys if model_class == parent_class]
+        if not ids:
+            continue
+        codes = latest_codes(session, parent_class, ids,
+                             batch_size=batch_size)
+        for parent_id in ids:
+            snapshot[(parent_class, parent_id)] = codes.get(parent_id, {})
+    return snapshot
+
+
+class SyncManifest(object):
+    """
+    Records the server state (code ids and `updated_at`) of every protocol
+    as of the last time it was fetched, so unchanged protocols can be
+    skipped. The hash of each local code file is recorded whenever it is
+    fetched or pushed, so locally unmodified files can be detected without
+    contacting the server. The manifest is a small json file that is only
+    rewritten when an entry changes.
+    """
+
+    def __init__(self, path):
+        """
+        SyncManifest constructor
+
+        :param path: location of the manifest file
+        :type path: str
+        """
+        self.path = str(path)
+        self._entries = None
+        self._paths = None
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(model_class, model_id):
+        return '{}/{}'.format(model_class, model_id)
+
+    @property
+    def entries(self):
+        """All manifest entries by key"""
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                if os.path.isfile(self.path):
+                    with open(self.path, 'r') as f:
+                        self._entries = json.load(f)
+            return self._entries
+
+    def get(self, model_class, model_id):
+        """Returns the entry for a protocol or None"""
+        return self.entries.get(self.key(model_class, model_id))
+
+    def get_by_path(self, path):
+        """
+        Returns the entry for the protocol stored in a directory or None
+
+        :param path: directory of the protocol relative to the session
+        :type path: str
+        :return: manifest entry
+        :rtype: dict
+        """
+        with self._lock:
+            if self._paths is None:
+                self._paths = {}
+                for key, entry in self.entries.items():
+                    if 'path' in entry:
+                        # entries recorded by older versions have no id
+                        entry.setdefault('id', int(key.split('/')[-1]))
+                        self._paths[entry['path']] = entry
+            return self._paths.get(path)
+
+    def is_current(self, model, codes):
+        """
+        Whether the recorded state of a protocol matches the server.
+
+        :param model: OperationType or Library listed from the server
+        :type model: OperationType | Library
+        :param codes: dictionary of accessor to the latest Code
+        :type codes: dict
+        :return: True if nothing changed since it was recorded
+        :rtype: bool
+        """
+        entry = self.get(model.__class__.__name__, model.id)
+        if entry is None:
+            return False
+        if entry.get('updated_at') != str(model.updated_at):
+            return False
+        recorded = {accessor: code.get('id')
+                    for accessor, code in entry.get('codes', {}).items()}
+        remote = {accessor: code.id for accessor, code in codes.items()}
+        return recorded == remote
+
+    def record(self, model, codes, path=None, hashes=None):
+        """
+        Records the server state of a protocol.
+
+        :param model: OperationType or Library listed from the server
+        :type model: OperationType | Library
+        :param codes: dictionary of accessor to the latest Code
+        :type codes: dict
+        :param path: directory of the protocol relative to the session
+        :type path: str
+        :param hashes: dictionary of accessor to the hash of the local file
+        :type hashes: dict
+        :return: None
+        :rtype: None
+        """
+        model_class = model.__class__.__name__
+        hashes = hashes or {}
+        entry = {
+            'model': model_class,
+            'id': model.id,
+            'category': model.category,
+            'name': model.name,
+            'updated_at': str(model.updated_at),
+            'codes': {accessor: {'id': code.id, 'hash': hashes.get(accessor)}
+                      for accessor, code in codes.items()}
+        }
+        if path is not None:
+            entry['path'] = path
+        with self._lock:
+            self.entries[self.key(model_class, model.id)] = entry
+            self._paths = None
+            self._dirty = True
+
+    def record_code(self, model_class, model_id, accessor, code_id,
+                    file_hash, path=None):
+        """
+        Records a pushed code file. The entry of the protocol is created if
+        it was never recorded (e.g. the manifest was deleted).
+
+        :param model_class: 'OperationType' or 'Library'
+        :type model_class: str
+        :param model_id: id of the OperationType or Library
+        :type model_id: int
+        :param accessor: code accessor (e.g. 'protocol')
+        :type accessor: str
+        :param code_id: id of the Code on the server
+        :type code_id: int
+        :param file_hash: hash of the local file that was pushed
+        :type file_hash: str
+        :param path: directory of the protocol relative to the session
+        :type path: str
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            key = self.key(model_class, model_id)
+            entry = self.entries.setdefault(
+                key, {'model': model_class, 'id': model_id, 'codes': {}})
+            if path is not None and entry.get('path') != path:
+                entry['path'] = path
+                self._paths = None
+            entry.setdefault('codes', {})[accessor] = {
+                'id': code_id, 'hash': file_hash}
+            self._dirty = True
+
+    def changed_files(self, path, hashes):
+        """
+        Returns the accessors whose local file hash differs from the hash
+        recorded for the protocol stored in a directory. Every accessor is
+        considered changed if the protocol was never recorded.
+
+        :param path: directory of the protocol relative to the session
+        :type path: str
+        :param hashes: dictionary of accessor to the hash of the local file
+        :type hashes: dict
+        :return: changed accessors
+        :rtype: list
+        """
+        entry = self.get_by_path(path)
+        if entry is None:
+            return list(hashes)
+        codes = entry.get('codes', {})
+        return [accessor for accessor, file_hash in hashes.items()
+                if codes.get(accessor, {}).get('hash') != file_hash]
+
+    def save(self):
+        """Writes the manifest if any entry changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            write_atomic(self.path,
+                         json.dumps(self.entries, indent=2, sort_keys=True))
+            self._dirty = False
+
+
+def protocol_status(entry, local_hashes, remote_codes):
+    """
+    Compares a protocol that exists both locally and on the server.
+
+    Local changes are found by comparing file hashes with the manifest and
+    remote changes by comparing code ids, so no code content is needed
+    unless the protocol was never recorded in the manifest.
+
+    :param entry: manifest entry of the protocol or None
+    :type entry: dict
+    :param local_hashes: dictionary of accessor to the hash of the local file
+    :type local_hashes: dict
+    :param remote_codes: dictionary of accessor to the latest Code
+    :type remote_codes: dict
+    :return: 'clean' or one of :data:`STATUSES`
+    :rtype: str
+    """
+    if entry is None:
+        remote_hashes = {
+            accessor: hashlib.sha1(code.content.encode('utf-8')).hexdigest()
+            for accessor, code in remote_codes.items()
+            if code.content is not None}
+        for accessor, file_hash in local_hashes.items():
+            if remote_hashes.get(accessor) != file_hash:
+                return 'unsynced'
+        return 'clean'
+
+    codes = entry.get('codes', {})
+    local_changed = any(codes.get(accessor, {}).get('hash') != file_hash
+                        for accessor, file_hash in local_hashes.items())
+    recorded = {accessor: code.get('id') for accessor, code in codes.items()}
+    remote = {accessor: code.id for accessor, code in remote_codes.items()}
+    remote_changed = recorded != remote
+    if local_changed and remote_changed:
+        return 'conflicting'
+    if local_changed:
+        return 'local_modified'
+    if remote_changed:
+        return 'remote_modified'
+    return 'clean'
+
+
+def session_status(local, remote_models, snapshot, manifest):
+    """
+    Compares every local protocol of a session with the server.
+
+    :param local: local protocols as dictionaries with 'name'
+                  ("category/name"), 'model' (class name), 'id' (None if
+                  unknown), 'path' and 'hashes'
+    :type local: list
+    :param remote_models: every OperationType and Library on the server
+    :type remote_models: list
+    :param snapshot: latest code of each remote model, as returned by
+                     :func:`latest_codes_for`
+    :type snapshot: dict
+    :param manifest: sync manifest of the session
+    :type manifest: SyncManifest
+    :return: dictionary of 'clean' and each of :data:`STATUSES` to sorted
+             protocol names
+    :rtype: dict
+    """
+    report = {status: [] for status in ('clean',) + STATUSES}
+    remote_by_key = {(m.__class__.__name__, m.id): m for m in remote_models}
+    seen = set()
+    for protocol in local:
+        key = (protocol['model'], protocol['id'])
+        if key not in remote_by_key:
+            report['local_only'].append(protocol['name'])
+            continue
+        seen.add(key)
+        status = protocol_status(manifest.get_by_path(protocol['path']),
+                                 protocol['hashes'], snapshot[key])
+        report[status].append(protocol['name'])
+    for key, model in remote_by_key.items():
+        if key not in seen:
+            report['remote_only'].append(
+                "{}/{}".format(model.category, model.name))
+    for names in report.values():
+        names.sort()
+    return report
@@ -3,42 +3,114 @@ Functions for running Aquarium specific server-side tests
 """
 
 import json
+import threading
 
 from parrotfish.utils import sanitize_filename
 
 
-def tagify(data, session):
-    data = _tagify_single(data, session)
+class TagTable(object):
+    """
+    Session-scoped lookup table of :class:`SampleType` and
+    :class:`ObjectType` names by id, used to replace record ids with tags.
+
+    Unknown ids are resolved with a single bulk query per model, and names are
+    remembered for the lifetime of the table so each record is fetched at most
+    once.
+    """
+
+    # record type -> (model name, tag suffix)
+    REC_TYPES = {
+        'sample_type': ('SampleType', 'st'),
+        'object_type': ('ObjectType', 'ot'),
+    }
+
+    def __init__(self, session):
+        self.session = session
+        self._names = {rec_type: {} for rec_type in self.REC_TYPES}
+        self._lock = threading.Lock()
+
+    def add(self, rec_type, rec_id, name):
+        """Adds a known record name to the table"""
+        with self._lock:
+            self._names[rec_type][rec_id] = name
+
+    def add_records(self, rec_type, records):
+        """Adds already loaded records to the table"""
+        for rec in records:
+            if rec:
+                self.add(rec_type, rec.id, rec.name)
+
+    def resolve(self, rec_type, ids):
+        """
+        Fetches names of any ids not yet in the table using a single query
+
+        :param rec_type: 'sample_type' or 'object_type'
+        :type rec_type: str
+        :param ids: record ids
+        :type ids: iterable
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            missing = sorted(set(i for i in ids if i) -
+                             set(self._names[rec_type]))
+        if not missing:
+            return
+        model_name = self.REC_TYPES[rec_type][0]
+        interface = getattr(self.session, model_name)
+        for rec in interface.where({'id': missing}):
+            self.add(rec_type, rec.id, rec.name)
+
+    def tag(self, rec_type, rec_id):
+        """Returns the tag for a record id"""
+        name = self._names[rec_type].get(rec_id)
+        if name is None:
+            self.resolve(rec_type, [rec_id])
+            name = self._names[rec_type][rec_id]
+        return '{}_{}'.format(name.lower(), self.REC_TYPES[rec_type][1])
+
+
+def tagify(data, session, table=None):
+    """
+    Replaces :class:`SampleType` and :class:`ObjectType` ids in data with
+    tags. All ids referenced by the data are resolved in bulk before any
+    replacement is made.
+
+    :param data: record data
+    :type data: dict
+    :param session: session used to look up names
+    :type session: AqSession
+    :param table: lookup table to share between calls
+    :type table: TagTable
+    :return: tagged data
+    :rtype: dict
+    """
+    if table is None:
+        table = TagTable(session)
 
+    afts = []
     if ('field_types' in data and
             data['field_types'][0]['parent_class'] == 'OperationType'):
-        fts = []
-        for ft in data['field_types']:
-            ft['allowable_field_types'] = [
-                _tagify_single(aft, session)
-                for aft in ft['allowable_field_types']
-            ]
-            fts.append(ft)
-        data['field_types'] = fts
+        afts = [aft for ft in data['field_types']
+                for aft in ft['allowable_field_types']]
+
+    for rec_type in TagTable.REC_TYPES:
+        id_key = '{}_id'.format(rec_type)
+        table.resolve(rec_type, [d.get(id_key) for d in [data] + afts])
+
+    data = _tagify_single(data, table)
+    for aft in afts:
+        _tagify_single(aft, table)
 
     return data
 
 
-def _tagify_single(data, session):
-    rec_types = [
-        ('sample_type', 'st'),
-        ('object_type', 'ot'),
-    ]
-    for rec_type in rec_types:
-        id_key = '{}_id'.format(rec_type[0])
-        tag_key = '{}_tag'.format(rec_type[0])
+def _tagify_single(data, table):
+    for rec_type in TagTable.REC_TYPES:
+        id_key = '{}_id'.format(rec_type)
+        tag_key = '{}_tag'.format(rec_type)
         if id_key in data and data[id_key]:
-            rec = None
-            if rec_type[0] == 'sample_type':
-                rec = session.SampleType.find(data[id_key])
-            elif rec_type[0] == 'object_type':
-                rec = session.ObjectType.find(data[id_key])
-            data[tag_key] = '{}_{}'.format(rec.name.lower(), rec_type[1])
+            data[tag_key] = table.tag(rec_type, data[id_key])
             data.pop(id_key)
 
     return data
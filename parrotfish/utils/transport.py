@@ -0,0 +1,377 @@
+"""
+Shared HTTP transport for every Aquarium session created by ParrotFish
+"""
+
+import gzip
+import json
+import threading
+import types
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from parrotfish.utils.response_cache import is_enabled
+
+
+class CompressingAdapter(HTTPAdapter):
+    """
+    :class:`HTTPAdapter` that optionally gzips large request bodies.
+    Responses are always decompressed by requests.
+    """
+
+    def __init__(self, compress_requests=False, compress_min_size=1024,
+                 **kwargs):
+        self.compress_requests = compress_requests
+        self.compress_min_size = compress_min_size
+        super().__init__(**kwargs)
+
+    def compress(self, request):
+        """
+        Gzips the body of a prepared request in place if compression is
+        enabled and the body is large enough
+
+        :param request: prepared request
+        :type request: requests.PreparedRequest
+        :return: whether the body was compressed
+        :rtype: bool
+        """
+        body = request.body
+        if not self.compress_requests or body is None or \
+                'Content-Encoding' in request.headers:
+            return False
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not isinstance(body, bytes) or len(body) < self.compress_min_size:
+            return False
+        request.body = gzip.compress(body)
+        request.headers['Content-Encoding'] = 'gzip'
+        request.headers['Content-Length'] = str(len(request.body))
+        return True
+
+    def send(self, request, **kwargs):
+        self.compress(request)
+        return super().send(request, **kwargs)
+
+
+class CachingAdapter(BaseAdapter):
+    """
+    Adapter answering read-only queries of Aquarium's json api from a
+    :class:`ResponseCache` and sending every other request through another
+    adapter.
+    """
+
+    # models whose queries are cached (their schema rarely changes)
+    MODELS = ('OperationType', 'Library', 'SampleType', 'ObjectType')
+
+    # json api methods that do not modify anything ('find' has no method)
+    READ_METHODS = ('all', 'where', 'find', 'find_by_name')
+
+    def __init__(self, cache, adapter, models=MODELS):
+        """
+        CachingAdapter constructor
+
+        :param cache: cache of the session
+        :type cache: ResponseCache
+        :param adapter: adapter sending requests to the server
+        :type adapter: BaseAdapter
+        :param models: names of the models whose queries are cached
+        :type models: tuple
+        """
+        super().__init__()
+        self.cache = cache
+        self.adapter = adapter
+        self.models = tuple(models)
+
+    def cache_key(self, request):
+        """
+        Returns the cache key of a read-only query of a cached model
+
+        :param request: prepared request
+        :type request: requests.PreparedRequest
+        :return: cache key or None if the request must not be cached
+        :rtype: str
+        """
+        if request.method != 'POST' or \
+                not urlparse(request.url).path.endswith('/json'):
+            return None
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        try:
+            data = json.loads(body)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(data, dict) or \
+                data.get('model') not in self.models or \
+                data.get('method', 'find') not in self.READ_METHODS:
+            return None
+        return self.cache.key(request.url, data)
+
+    @staticmethod
+    def build_response(request, entry):
+        """Builds a response to a request from a cache entry"""
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = request.url
+        response.request = request
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = 'utf-8'
+        response._content = entry['body'].encode('utf-8')
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    def send(self, request, **kwargs):
+        key = self.cache_key(request) if is_enabled() else None
+        if key is None:
+            return self.adapter.send(request, **kwargs)
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                return self.build_response(request, entry)
+            if entry['etag']:
+                request.headers['If-None-Match'] = entry['etag']
+
+        response = self.adapter.send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            entry = self.cache.renew(key, entry)
+            return self.build_response(request, entry)
+        if response.status_code != 200:
+            return response
+
+        try:
+            body = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            return response
+        if entry is not None and entry['body'] == body:
+            # records and their `updated_at` did not change
+            self.cache.renew(key, entry)
+        else:
+            headers = {k: v for k, v in response.headers.items()
+                       if k.lower() == 'content-type'}
+            self.cache.put(key, body, headers, response.headers.get('ETag'))
+        return response
+
+    def close(self):
+        # the wrapped adapter is shared with other sessions
+        pass
+
+
+class Transport(object):
+    """
+    Keep-alive connection pools shared by every Aquarium session.
+
+    Each session gets its own :class:`requests.Session` (and cookies), but
+    all sessions send requests through the same adapters, so connections to
+    a server are reused across requests, sessions and worker threads
+    instead of being opened for every request. Every host has its own pool
+    of at most `pool_size` connections, unless a different limit is set for
+    it with :meth:`configure_host`.
+    """
+
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_retries=0):
+        """
+        Transport constructor
+
+        :param pool_size: maximum number of connections per host
+        :type pool_size: int
+        :param max_retries: number of retries of failed connections
+        :type max_retries: int
+        """
+        self._lock = threading.Lock()
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.adapter = self._new_adapter(pool_size)
+        # adapters and settings of hosts configured with `configure_host`
+        self.host_adapters = {}
+        self.host_settings = {}
+
+    def _new_adapter(self, pool_size, compress_requests=False):
+        # pool_block makes the pool size a hard limit
+        return CompressingAdapter(pool_maxsize=pool_size, pool_block=True,
+                                  max_retries=self.max_retries,
+                                  compress_requests=compress_requests)
+
+    @staticmethod
+    def _resize(adapter, pool_size):
+        old = adapter.poolmanager
+        adapter.init_poolmanager(adapter._pool_connections, pool_size,
+                                 block=True)
+        # close the idle connections of the replaced pools
+        old.clear()
+
+    def configure_host(self, url, max_connections=None,
+                       compress_requests=False):
+        """
+        Sets the connection limit and request compression of a host.
+        Sessions attached afterwards use the new settings.
+
+        :param url: url prefix of the host (e.g. "http://localhost:3001")
+        :type url: str
+        :param max_connections: maximum number of connections to the host
+                                (the default pool size if None)
+        :type max_connections: int
+        :param compress_requests: gzip request bodies (the server must
+                                  accept gzipped requests)
+        :type compress_requests: bool
+        :return: adapter of the host or None if it uses the default pools
+        :rtype: CompressingAdapter
+        """
+        settings = (max_connections, compress_requests)
+        with self._lock:
+            if settings == (None, False):
+                self.host_settings.pop(url, None)
+                self.host_adapters.pop(url, None)
+                return None
+            if self.host_settings.get(url) != settings:
+                self.host_settings[url] = settings
+                self.host_adapters[url] = self._new_adapter(
+                    max_connections or self.pool_size, compress_requests)
+            return self.host_adapters[url]
+
+    def ensure_pool_size(self, workers):
+        """
+        Grows the default connection pools so that `workers` threads can
+        send requests to the same host concurrently. Limits set for specific
+        hosts are left unchanged.
+
+        :param workers: number of concurrent workers
+        :type workers: int
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if workers <= self.pool_size:
+                return
+            self.pool_size = workers
+            self._resize(self.adapter, workers)
+            for url, (max_connections, _) in self.host_settings.items():
+                if max_connections is None:
+                    self._resize(self.host_adapters[url], workers)
+
+    def session(self, cookies=None, cache=None):
+        """
+        Returns a new :class:`requests.Session` using the shared pools
+
+        :param cookies: cookies of the session
+        :type cookies: dict | RequestsCookieJar
+        :param cache: cache answering read-only queries of the session
+        :type cache: ResponseCache
+        :return: requests session
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        for prefix, adapter in self.host_adapters.items():
+            session.mount(prefix, adapter)
+        if cache is not None:
+            for prefix, adapter in list(session.adapters.items()):
+                session.mount(prefix, CachingAdapter(cache, adapter))
+        if cookies is not None:
+            session.cookies.update(cookies)
+        return session
+
+    def attach(self, aqhttp, cache=None):
+        """
+        Sends the requests of an Aquarium session's http interface through
+        the shared pools, keeping its login cookies. The interface's
+        `request` method (used by every query of the session) is replaced by
+        :func:`pooled_request`.
+
+        :param aqhttp: http interface of an AqSession
+                       (`AqSession.utils.aqhttp`)
+        :type aqhttp: AqHTTP
+        :param cache: cache answering read-only queries of the session
+        :type cache: ResponseCache
+        :return: the http interface
+        :rtype: AqHTTP
+        """
+        session = self.session(cache=cache)
+        previous = getattr(aqhttp, '_requests_session', None)
+        if previous is not None:
+            session.cookies.update(previous.cookies)
+        cookies = getattr(aqhttp, 'cookies', None)
+        if cookies:
+            session.cookies.update(cookies)
+        aqhttp._requests_session = session
+        aqhttp.request = types.MethodType(pooled_request, aqhttp)
+        return aqhttp
+
+
+def pooled_request(aqhttp, method, path, timeout=None, allow_none=True,
+                   **kwargs):
+    """
+    Same as :meth:`AqHTTP.request`, except that the request is sent with the
+    http interface's `_requests_session` (see :meth:`Transport.attach`)
+    instead of opening a new connection for every request.
+
+    :param aqhttp: http interface of an AqSession
+    :type aqhttp: AqHTTP
+    :param method: request method (e.g. 'get' or 'post')
+    :type method: str
+    :param path: path of the request relative to the Aquarium url
+    :type path: str
+    :param timeout: seconds to wait for a response
+    :type timeout: float
+    :param allow_none: if False, raise an error if the json contains None
+    :type allow_none: bool
+    :return: json response
+    :rtype: dict
+    """
+    from pydent.exceptions import ForbiddenRequestError
+    from pydent.utils import url_build
+
+    url = url_build(aqhttp.aquarium_url, path)
+    if not aqhttp._using_requests:
+        raise ForbiddenRequestError(
+            "Attempted a request ({} {}) when requests have been turned OFF."
+            "\nDATA: {}".format(method.upper(), url, kwargs.get("json")))
+    if timeout is None:
+        timeout = aqhttp.timeout
+    if not allow_none and "json" in kwargs:
+        aqhttp._disallow_null_in_json(kwargs["json"])
+
+    aqhttp.num_requests += 1
+    response = aqhttp._requests_session.request(
+        method, url, timeout=timeout, cookies=aqhttp.cookies, **kwargs)
+
+    aqhttp.log.info(aqhttp._format_response_info(response))
+    aqhttp._dispatch_response(response)
+    return aqhttp._response_to_json(response)
+
+
+def use_shared_transport(session, cache=None):
+    """
+    Sends the requests of an :class:`AqSession` through the shared transport
+
+    :param session: Aquarium session
+    :type session: AqSession
+    :param cache: cache answering read-only queries of the session
+    :type cache: ResponseCache
+    :return: the session
+    :rtype: AqSession
+    """
+    get_transport().attach(session.utils.aqhttp, cache=cache)
+    return session
+
+
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+def get_transport():
+    """Returns the transport shared by every session, creating it if
+    necessary"""
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            _TRANSPORT = Transport()
+        return _TRANSPORT
+
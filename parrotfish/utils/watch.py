@@ -0,0 +1,108 @@
+"""
+Polling file watcher used to push protocols as they are edited
+"""
+
+import os
+import time
+
+
+class PollingWatcher(object):
+    """
+    Detects modified files in a directory tree by periodically comparing
+    their modification times and sizes. Changes are debounced: files are
+    reported in a single batch once no further change was seen for
+    `debounce` seconds, so a burst of saves results in one batch.
+    Hidden files and directories are ignored.
+    """
+
+    def __init__(self, root, extensions=('.rb', '.md'), interval=0.5,
+                 debounce=0.5):
+        """
+        PollingWatcher constructor
+
+        :param root: directory to watch
+        :type root: str
+        :param extensions: extensions of the files to watch
+        :type extensions: tuple
+        :param interval: seconds between polls
+        :type interval: float
+        :param debounce: seconds without changes before a batch is reported
+        :type debounce: float
+        """
+        self.root = str(root)
+        self.extensions = tuple(extensions)
+        self.interval = interval
+        self.debounce = debounce
+        self._files = self.snapshot()
+        self._pending = set()
+        self._last_change = None
+
+    def snapshot(self):
+        """
+        Returns the modification time and size of every watched file
+
+        :return: dictionary of path to (mtime, size)
+        :rtype: dict
+        """
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.') or \
+                        not filename.endswith(self.extensions):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def poll(self):
+        """
+        Returns the files that were created or modified since the last poll
+
+        :return: paths of the changed files
+        :rtype: set
+        """
+        files = self.snapshot()
+        changed = {path for path, stat in files.items()
+                   if self._files.get(path) != stat}
+        self._files = files
+        return changed
+
+    def step(self, now=None):
+        """
+        Polls once and returns the pending changes if they settled
+
+        :param now: current time (defaults to time.monotonic())
+        :type now: float
+        :return: sorted paths of the changed files, or an empty list if
+                 nothing changed or changes are still being made
+        :rtype: list
+        """
+        if now is None:
+            now = time.monotonic()
+        changed = self.poll()
+        if changed:
+            self._pending.update(changed)
+            self._last_change = now
+        if self._pending and now - self._last_change >= self.debounce:
+            batch = sorted(self._pending)
+            self._pending = set()
+            return batch
+        return []
+
+    def batches(self):
+        """
+        Polls forever, yielding batches of changed files
+
+        :return: generator of lists of paths
+        :rtype: generator
+        """
+        while True:
+            time.sleep(self.interval)
+            batch = self.step()
+            if batch:
+                yield batch
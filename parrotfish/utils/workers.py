@@ -0,0 +1,76 @@
+"""
+Bounded worker pool for overlapping Aquarium round-trips
+"""
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskResult(object):
+    """Outcome of running a function on a single item"""
+
+    def __init__(self, item, value=None, error=None, elapsed=0.0):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        """Whether the function returned without raising"""
+        return self.error is None
+
+    def __repr__(self):
+        return "TaskResult(item={}, ok={})".format(self.item, self.ok)
+
+
+def _timed_call(fxn, item):
+    start = time.perf_counter()
+    try:
+        value = fxn(item)
+    except Exception as e:
+        return TaskResult(item, error=e,
+                          elapsed=time.perf_counter() - start)
+    return TaskResult(item, value=value, elapsed=time.perf_counter() - start)
+
+
+def imap_ordered(fxn, items, workers=1):
+    """
+    Applies `fxn` to every item using at most `workers` threads.
+
+    Results are yielded as :class:`TaskResult` in the same order as `items`,
+    regardless of which item finishes first, so anything logged by the caller
+    while consuming the results is deterministic. Exceptions are captured per
+    item instead of aborting the remaining items. Items are pulled from
+    `items` lazily (at most twice the number of workers are in flight), so
+    `items` may be a generator.
+
+    :param fxn: function taking a single item
+    :type fxn: callable
+    :param items: items to process
+    :type items: iterable
+    :param workers: maximum number of concurrent threads
+    :type workers: int
+    :return: generator of results
+    :rtype: generator
+    """
+    workers = max(int(workers or 1), 1)
+    if workers == 1:
+        for item in items:
+            yield _timed_call(fxn, item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(_timed_call, fxn, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def map_ordered(fxn, items, workers=1):
+    """Same as :func:`imap_ordered` but returns a list of results"""
+    return list(imap_ordered(fxn, items, workers=workers))
@@ -1,8 +1,13 @@
 # import json
 import os
+import time
 # from pathlib import Path
 #
 import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from pydent.aqhttp import AqHTTP
 
 from parrotfish.core import CLI
 from parrotfish.session_environment import SessionManager
@@ -44,4 +49,76 @@ def cli(sm):
     """Creates a new :class:`CLI` instance with its own temporary directories"""
     return CLI(sm)
 
+@pytest.fixture(scope="function")
+def fake_login(monkeypatch):
+    """
+    Logs in to Aquarium without contacting a server. Each session gets a
+    `remember_token` cookie holding its login. Returns the list of logins.
+    """
+    logins = []
+
+    def login(aqhttp, login, password):
+        # slow enough for concurrent logins to overlap
+        time.sleep(0.01)
+        logins.append(login)
+        aqhttp.cookies = {'remember_token': login}
+
+    monkeypatch.setattr(AqHTTP, '_login', login)
+    return logins
+
+
+class FakeAquarium(BaseAdapter):
+    """
+    Adapter answering requests like Aquarium's json api, either with the
+    same body every time or by querying in-memory records. Responses carry
+    `etag` if it is set, and requests revalidating it get a 304.
+    """
+
+    def __init__(self, body='[]', records=None, etag=None):
+        super().__init__()
+        self.body = body
+        self.records = records
+        self.etag = etag
+        self.requests = []
+        self.queries = []
+
+    def query(self, data):
+        """Answers a json api query from the records"""
+        self.queries.append((data['model'], data.get('arguments')))
+        records = self.records[data['model']]
+        if 'method' not in data:
+            return [r for r in records if r['id'] == data['id']][0]
+        arguments = data.get('arguments') or {}
+        return [r for r in records
+                if all(r.get(k) in (v if isinstance(v, list) else [v])
+                       for k, v in arguments.items())]
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        if self.etag and request.headers.get('If-None-Match') == self.etag:
+            response.status_code = 304
+            response._content = b''
+            return response
+        response.status_code = 200
+        body = self.body
+        if self.records is not None:
+            body = json.dumps(self.query(json.loads(request.body)))
+        response._content = body.encode('utf-8')
+        if self.etag:
+            response.headers['ETag'] = self.etag
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope="function")
+def fake_aquarium():
+    """Returns the :class:`FakeAquarium` adapter class"""
+    return FakeAquarium
+
+
 CustomLogging.set_level(logging.VERBOSE)
@@ -0,0 +1,79 @@
+"""Tests for the completion data refreshed in the background"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+from parrotfish.utils import completion_cache
+from parrotfish.utils.completion_cache import CompletionCache
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_miss_returns_while_the_value_loads():
+    release = threading.Event()
+    loads = []
+
+    def loader():
+        loads.append(threading.current_thread())
+        release.wait(5)
+        return ['Cloning']
+
+    cache = CompletionCache(ttl=300)
+    start = time.monotonic()
+    assert cache.get('nursery', loader) is None
+    # a refresh in progress is not started again
+    assert cache.get('nursery', loader) is None
+    assert time.monotonic() - start < 1
+
+    release.set()
+    _wait_for(lambda: cache.get('nursery', loader) is not None)
+    assert cache.get('nursery', loader) == ['Cloning']
+    assert len(loads) == 1
+    assert loads[0] is not threading.current_thread()
+
+
+def test_stale_values_are_refreshed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(completion_cache, 'time',
+                        SimpleNamespace(monotonic=lambda: now[0]))
+    values = iter([['Cloning'], ['Cloning', 'Sequencing']])
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return next(values)
+
+    cache = CompletionCache(ttl=10)
+    cache.get('nursery', loader)
+    _wait_for(lambda: cache.get('nursery', loader) is not None)
+
+    # fresh values are not reloaded
+    now[0] += 5
+    assert cache.get('nursery', loader) == ['Cloning']
+    assert len(loads) == 1
+
+    # the stale value is returned while the new one loads
+    now[0] += 10
+    assert cache.get('nursery', loader) == ['Cloning']
+    _wait_for(lambda: len(cache.get('nursery', loader)) == 2)
+    assert len(loads) == 2
+
+
+def test_failed_refreshes_keep_the_previous_value():
+    cache = CompletionCache(ttl=300)
+    cache.get('nursery', lambda: ['Cloning'])
+    _wait_for(lambda: cache.get('nursery', None) is not None)
+
+    def loader():
+        raise ConnectionError('server down')
+
+    cache.invalidate('nursery')
+    assert cache.get('nursery', loader) == ['Cloning']
+    _wait_for(lambda: 'nursery' not in cache._refreshing)
+    assert cache.get('nursery', loader) == ['Cloning']
@@ -2,10 +2,16 @@
 
 from parrotfish.core import CLI
 from parrotfish import utils
-from parrotfish.session_environment import SessionManager
+from parrotfish.session_environment import SessionEnvironment, SessionManager
+from parrotfish.utils import docker_testing, sync
+from parrotfish.utils.workers import TaskResult
 import os
+import pytest
 from pydent import AqSession
+import threading
+import time
 import uuid
+from types import SimpleNamespace
 
 
 login = "vrana"
@@ -105,6 +111,19 @@ def test_move_repo(cli, tmpdir_factory, credentials):
     assert os.path.exists(os.path.join(newdir, cli._session_manager.name, "newfile.txt"))
 
 
+def test_set_repo(cli, tmpdir_factory, monkeypatch):
+    meta_dir = tmpdir_factory.mktemp('global_env')
+    monkeypatch.setattr(SessionManager, 'DEFAULT_METADATA_LOC', str(meta_dir))
+    old_repo = os.path.join(str(tmpdir_factory.mktemp('old')), 'FishTank')
+    new_repo = os.path.join(str(tmpdir_factory.mktemp('new')), 'FishTank')
+
+    cli.set_repo(old_repo)
+    assert str(cli._session_manager.abspath) == old_repo
+    cli.set_repo(new_repo)
+    assert str(cli._session_manager.abspath) == new_repo
+    assert cli._session_manager._SessionManager__meta['root'] == new_repo
+
+
 def test_categories(cli, credentials):
     cli.register(**credentials['nursery'])
     categories = cli._get_categories()
@@ -140,6 +159,22 @@ def test_fetch(cli, credentials):
             assert len(files) > 0
 
 
+def test_fetch_sessions(cli, credentials):
+    cli.register(**credentials['nursery'])
+    cli.fetch_sessions(credentials['nursery']['name'],
+                       category="ParrotFishTest", workers=2)
+
+    session = cli._session_manager.list_dirs()[0]
+    assert "ParrotFishTest" in [x.name for x in session.categories]
+
+
+def test_fetch_requires_category_or_all(cli):
+    # neither or both are rejected before contacting a server
+    assert cli.fetch() is None
+    assert cli.fetch("ParrotFishTest", all=True) is None
+    assert not cli._session_manager.list_dirs()
+
+
 def test_push_category(cli, credentials):
     cli.register(**credentials['nursery'])
     cli.fetch("ParrotFishTest")
@@ -168,3 +203,332 @@ def test_push_category(cli, credentials):
     assert new_local_ot.protocol.content == new_content
     assert old_local_ot.protocol.content != new_content
     print(utils.compare_content(old_local_ot.protocol.content, new_local_ot.protocol.content))
+
+
+class _Container(object):
+    """Fake Aquarium container running the test plans of protocols"""
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.started = []
+        self.shared = []
+        self.tested = []
+        self.tree_users = 0
+        self.max_tree_users = 0
+        self.lock = threading.Lock()
+
+    def start_container(self, reset, cid):
+        self.started.append(reset)
+        return {'success': True, 'id': 'abc',
+                'timings': {'start': 1.0, 'ready': 2.0}}
+
+    def load_shared_records(self, protocols):
+        self.shared.append(sorted(p.name for p in protocols))
+
+    def load_data(self, protocol):
+        # shared records are created before the workers start
+        assert self.shared
+        return {'ot': protocol.name}
+
+    def use_tree(self, env):
+        # the manifest must exist before the workers change the tree
+        assert env.manifest is not None
+        with self.lock:
+            self.tree_users += 1
+            self.max_tree_users = max(self.max_tree_users, self.tree_users)
+        time.sleep(0.01)
+        with self.lock:
+            self.tree_users -= 1
+
+    def test_protocol(self, protocol, record_dict):
+        with self.lock:
+            self.tested.append(protocol.name)
+        return {'success': protocol.name not in self.failing,
+                'plan_url': 'http://localhost:3001/plans/1'}
+
+
+def _docker_cli(cli, monkeypatch, container, protocols):
+    for name in ('start_container', 'load_shared_records', 'load_data',
+                 'test_protocol'):
+        monkeypatch.setattr(docker_testing, name, getattr(container, name))
+    monkeypatch.setattr(
+        SessionEnvironment, 'write_operation_type',
+        lambda env, ot, no_code=False, codes=None: container.use_tree(env))
+
+    def push(cli, env, protocols, force=False, workers=1):
+        container.use_tree(env)
+        return {status: [] for status in CLI.PUSH_STATUSES}
+
+    monkeypatch.setattr(CLI, '_push_protocols', push)
+
+    cli.register('vrana', 'pw', 'http://aquarium.test/', 'nursery')
+    cli.set_session('nursery')
+    env = cli._session_manager.current_env
+    for name, has_data in protocols:
+        protocol = env.get_operation_type_dir('Cloning', name)
+        protocol.mkdirs()
+        protocol.meta.dump_json({'name': name})
+        for accessor in ('protocol', 'precondition', 'documentation',
+                         'cost_model'):
+            protocol.get(accessor).write('')
+        if has_data:
+            protocol.add('testing').add_file('data.json', attr='data').write(
+                '{}')
+
+
+def test_test_protocols(cli, monkeypatch, fake_login):
+    container = _Container(failing=('Run Gel',))
+    _docker_cli(cli, monkeypatch, container,
+                [('Make PCR', True), ('Run Gel', True), ('Digest', True)])
+
+    results = cli._test_protocols('Cloning', ['Make PCR', 'Run Gel'],
+                                  workers=2)
+    assert [r.item.name for r in results] == ['Make PCR', 'Run Gel']
+    assert [r.value['success'] for r in results] == [True, False]
+    assert sorted(container.tested) == ['Make PCR', 'Run Gel']
+    assert container.max_tree_users == 1
+    assert container.started == [False]
+    assert container.shared == [['Make PCR', 'Run Gel']]
+
+    # the docker session is removed and the session restored
+    assert set(cli._session_manager.sessions) == {'nursery'}
+    assert cli._session_manager.current_env.name == 'nursery'
+    assert cli._session_manager.get_container_id() == 'abc'
+
+
+def test_test_category(cli, monkeypatch, fake_login):
+    container = _Container()
+    _docker_cli(cli, monkeypatch, container,
+                [('Make PCR', True), ('Run Gel', False), ('Digest', True)])
+
+    cli.test_category('Cloning', workers=3)
+    assert sorted(container.tested) == ['Digest', 'Make PCR']
+    assert container.max_tree_users == 1
+
+
+def test_log_test_report(caplog):
+    class _Protocol(object):
+        def __init__(self, name):
+            self.name = name
+
+    timings = {'load': 1.0, 'push': 0.5, 'plan': 2.0}
+    results = [
+        TaskResult(_Protocol('Make PCR'), value={
+            'success': True, 'plan_url': 'url1', 'timings': timings}),
+        TaskResult(_Protocol('Run Gel'), value={
+            'success': False, 'plan_url': 'url2', 'timings': timings}),
+        TaskResult(_Protocol('Digest'), error=ValueError('no data')),
+    ]
+    with caplog.at_level(0):
+        CLI._log_test_report('Cloning', results, 12.34)
+    lines = [record.getMessage() for record in caplog.records]
+    assert any("  Cloning/Make PCR: passed (load 1.0s, push 0.5s, "
+               "plan 2.0s)" in line for line in lines)
+    assert any("    View plan: url2" in line for line in lines)
+    assert any("Cloning/Run Gel: failed" in line for line in lines)
+    assert any("Cloning/Digest: error (no data)" in line for line in lines)
+    assert "1 passed, 2 failed in 12.3s" in lines[-1]
+
+
+def test_fetch_lines_are_prefixed(caplog):
+    class _Model(object):
+        def __init__(self, id, name):
+            self.id = id
+            self.category = 'Cloning'
+            self.name = name
+
+    class _Env(object):
+        written = {}
+
+        def get_model_dir(self, model):
+            pass
+
+        def write_model(self, model, codes=None):
+            if model.name == 'Run Gel':
+                raise ValueError('no field types')
+            self.written[model.name] = codes
+
+    models = [_Model(1, 'Make PCR'), _Model(2, 'Run Gel')]
+    snapshot = {('_Model', 1): {'protocol': 'code'}}
+    with caplog.at_level(0):
+        results = list(CLI._write_models(_Env(), models, workers=2,
+                                         prefix='[nursery] ',
+                                         snapshot=snapshot))
+        CLI._log_fetch_failures([r for r in results if not r.ok],
+                                prefix='[nursery] ')
+    lines = [record.getMessage() for record in caplog.records]
+    assert any('[nursery] Saving Make PCR' in line for line in lines)
+    assert any('[nursery] Failed to save Cloning/Run Gel' in line
+               for line in lines)
+    assert any('[nursery]   Cloning/Run Gel: no field types' in line
+               for line in lines)
+    # codes already retrieved are written as is
+    assert _Env.written == {'Make PCR': {'protocol': 'code'}}
+
+
+def test_push_continues_after_broken_metadata(cli, monkeypatch):
+    class _Meta(object):
+        def __init__(self, data):
+            self.data = data
+
+        def load_json(self):
+            if isinstance(self.data, Exception):
+                raise self.data
+            return self.data
+
+    class _Protocol(object):
+        def __init__(self, name, meta):
+            self.parent = SimpleNamespace(name='Cloning')
+            self.name = name
+            self.meta = _Meta(meta)
+
+        def has(self, name):
+            return False
+
+    class _Env(object):
+        def code_accessors(self, protocol):
+            return ['protocol']
+
+        def get_sync_manifest(self):
+            return SimpleNamespace(save=lambda: None)
+
+    pushed = []
+
+    def push_protocol(env, protocol, accessors, model_class, meta,
+                      remote_codes, force=False):
+        pushed.append(protocol.name)
+        return 'updated', []
+
+    monkeypatch.setattr(CLI, '_push_protocol', staticmethod(push_protocol))
+    monkeypatch.setattr(sync, 'latest_codes_by_key',
+                        lambda session, keys: {key: {} for key in keys})
+    protocols = [
+        _Protocol('Make PCR', {'id': 1}),
+        _Protocol('Run Gel', ValueError('Expecting value')),
+        _Protocol('Digest', {'name': 'Digest'}),
+        _Protocol('Pour Gel', FileNotFoundError('Pour Gel.json')),
+    ]
+    summary = cli._push_protocols(_Env(), protocols, force=True)
+    assert pushed == ['Make PCR']
+    assert summary['updated'] == ['Cloning/Make PCR']
+    assert summary['failed'] == ['Cloning/Run Gel', 'Cloning/Digest',
+                                 'Cloning/Pour Gel']
+
+
+def test_push_protocols_libraries_first_with_bounded_workers(tmpdir):
+    lock = threading.Lock()
+    updates = []
+    running = []
+    peak = []
+
+    class _Code(object):
+        def __init__(self, id, parent_class, parent_id, name, content,
+                     fail=False):
+            self.id = id
+            self.parent_class = parent_class
+            self.parent_id = parent_id
+            self.name = name
+            self.content = content
+            self.fail = fail
+
+        def update(self):
+            with lock:
+                updates.append((self.parent_class, self.parent_id))
+                running.append(self)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(self)
+            if self.fail:
+                raise ValueError('server error')
+
+    class _CodeInterface(object):
+        def __init__(self, codes):
+            self.codes = codes
+
+        def where(self, query):
+            return [c for c in self.codes
+                    if c.parent_class == query['parent_class'] and
+                    c.parent_id in query['parent_id']]
+
+    class _Protocol(object):
+        def __init__(self, name, model_class, id, base_id, changed=True):
+            self.parent = SimpleNamespace(name='Cloning')
+            self.name = name
+            self.accessor = 'source' if model_class == 'Library' \
+                else 'protocol'
+            self.meta = SimpleNamespace(load_json=lambda: {
+                'id': id, self.accessor: {'id': base_id}})
+            self.changed = [self.accessor] if changed else []
+
+        def has(self, name):
+            return name == self.accessor == 'source'
+
+        def get(self, accessor):
+            return SimpleNamespace(read=lambda: 'local ' + self.name)
+
+    class _Env(object):
+        manifest = sync.SyncManifest(str(tmpdir.join('manifest.json')))
+
+        def changed_code(self, protocol):
+            return protocol.changed
+
+        def code_hashes(self, protocol):
+            return {protocol.accessor: 'hash'}
+
+        def protocol_path(self, protocol):
+            return protocol.name
+
+        def get_sync_manifest(self):
+            return self.manifest
+
+    operation_types = ['Make PCR', 'Run Gel', 'Digest', 'Pour Gel']
+    protocols = [_Protocol(name, 'OperationType', i, 10 + i)
+                 for i, name in enumerate(operation_types, 1)]
+    protocols += [
+        _Protocol('Anneal', 'OperationType', 5, 15, changed=False),
+        _Protocol('Ligate', 'OperationType', 6, 99),
+        _Protocol('Transform', 'OperationType', 7, 17),
+        _Protocol('Cloning Lib', 'Library', 1, 20),
+    ]
+    codes = [_Code(10 + i, 'OperationType', i, 'protocol', 'remote',
+                   fail=i == 7) for i in range(1, 8)]
+    codes.append(_Code(20, 'Library', 1, 'source', 'remote'))
+    session = SimpleNamespace(Code=_CodeInterface(codes))
+    cli = CLI(SimpleNamespace(current_session=session))
+
+    summary = cli._push_protocols(_Env(), protocols, workers=2)
+
+    # the library is pushed before any OperationType
+    assert updates[0] == ('Library', 1)
+    assert sorted(updates[1:]) == [('OperationType', i)
+                                   for i in (1, 2, 3, 4, 7)]
+    assert max(peak) == 2
+    assert summary == {
+        'updated': ['Cloning/Cloning Lib'] +
+                   ['Cloning/' + name for name in operation_types],
+        'skipped': ['Cloning/Anneal'],
+        'conflicted': ['Cloning/Ligate'],
+        'failed': ['Cloning/Transform'],
+    }
+    assert _Env.manifest.get_by_path('Make PCR')['codes'] == {
+        'protocol': {'id': 11, 'hash': 'hash'}}
+
+
+def test_push_all_logs_in_only_when_needed(cli, fake_login):
+    logins = fake_login
+    with pytest.raises(Exception):
+        cli.push_all()
+
+    cli.register('vrana', 'pw', 'http://aquarium.test/', 'nursery')
+    cli._save()
+    sm = cli._session_manager
+    loaded = SessionManager(sm.abspath, meta_dir=sm.metadata.abspath,
+                            meta_name=sm.metadata.env_settings.name)
+    loaded.load()
+    del logins[:]
+
+    # nothing to push
+    CLI(loaded).push_all()
+    assert logins == []
+    assert not loaded.current_env.is_logged_in
@@ -0,0 +1,92 @@
+"""Tests for change detection and diffs"""
+
+import difflib
+import random
+import re
+
+from parrotfish.utils.diff import (Diff, content_equal, shared_lines,
+                                   unified_diff)
+
+
+def test_content_equal():
+    assert content_equal('abc', 'abc')
+    assert not content_equal('abc', 'abcd')
+    assert not content_equal('abc', 'abd')
+    assert not content_equal(None, 'abc')
+
+
+def test_shared_lines():
+    old = 'a\nb\nc\nd\ne'
+    assert shared_lines(old, 'a\nb\nX\nd\ne') == (2, 2)
+    assert shared_lines(old, 'a\nb\nc\nd\ne\nf') == (4, 0)
+    assert shared_lines(old, 'Z\n' + old) == (0, 5)
+
+
+def test_matches_difflib():
+    old = ['line {}'.format(i) for i in range(100)]
+    new = list(old)
+    new[50] = 'changed'
+    new.insert(80, 'inserted')
+    expected = list(difflib.unified_diff(old, new, lineterm=''))
+    assert list(unified_diff(old, new)) == expected
+
+
+def _patch(lines, diff):
+    """Applies unified diff lines, checking every context and removed
+    line against the old lines"""
+    result = []
+    pos = 0
+    for line in diff[2:]:
+        match = re.match(r'@@ -(\d+)(?:,(\d+))? ', line)
+        if match:
+            start = int(match.group(1))
+            if match.group(2) != '0':
+                start -= 1
+            result += lines[pos:start]
+            pos = start
+        elif line[0] == '+':
+            result.append(line[1:])
+        else:
+            assert lines[pos] == line[1:]
+            if line[0] == ' ':
+                result.append(line[1:])
+            pos += 1
+    return result + lines[pos:]
+
+
+def test_random_edits_are_equivalent_to_difflib():
+    rng = random.Random(0)
+    for _ in range(500):
+        # few distinct lines, so repeated lines are common
+        old = [rng.choice('abcde') for _ in range(rng.randint(0, 40))]
+        new = list(old)
+        for _ in range(rng.randint(0, 4)):
+            i = rng.randint(0, len(new))
+            edit = rng.random()
+            if edit < 0.4 or not new:
+                new.insert(i, rng.choice('abcdefg'))
+            elif edit < 0.7:
+                del new[min(i, len(new) - 1)]
+            else:
+                new[min(i, len(new) - 1)] = rng.choice('abcdefg')
+        # lines are split from strings, as done by Diff
+        old_text, new_text = '\n'.join(old), '\n'.join(new)
+        old, new = old_text.split('\n'), new_text.split('\n')
+        expected = list(difflib.unified_diff(old, new, lineterm=''))
+        diff = list(unified_diff(old, new))
+        prefix, suffix = shared_lines(old_text, new_text)
+        assert list(unified_diff(old, new, prefix=prefix,
+                                 suffix=suffix)) == diff
+        assert bool(diff) == bool(expected)
+        assert diff[:2] == expected[:2]
+        assert _patch(old, diff) == new
+
+
+def test_diff_is_rendered_lazily():
+    diff = Diff('a\nb', 'a\nc')
+    assert diff
+    assert not Diff('a', 'a')
+    assert str(Diff('a', 'a')) == ''
+    lines = str(diff).split('\n')
+    assert any('-b' in line for line in lines)
+    assert any('+c' in line for line in lines)
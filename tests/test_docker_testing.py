@@ -0,0 +1,178 @@
+"""Tests for the Aquarium container lifecycle, using a local HTTP server
+in place of Docker"""
+
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from parrotfish.utils import docker_testing
+from parrotfish.utils.docker_testing import AquariumContainer, wait_until_ready
+from parrotfish.utils.workers import imap_ordered
+
+
+class _Docker(object):
+    """Stands in for docker: 'running' the container makes a local server
+    answer like Aquarium after `warmup` requests"""
+
+    def __init__(self, warmup=2):
+        self.warmup = warmup
+        self.running = False
+        self.requests = 0
+        self.runs = 0
+        self.kills = []
+        docker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                docker.requests += 1
+                ready = docker.running and docker.requests > docker.warmup
+                self.send_response(200 if ready else 503)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def running_ids(self):
+        return ['aq1'] if self.running else []
+
+    def run(self, cid):
+        self.runs += 1
+        self.running = True
+        self.requests = 0
+        return 'aq1'
+
+    def kill(self, cid):
+        self.kills.append(cid)
+        self.running = False
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def docker():
+    docker = _Docker()
+    yield docker
+    docker.close()
+
+
+def test_container_lifecycle(docker):
+    container = AquariumContainer(url=docker.url, docker=docker, delay=0.01)
+    assert container.start()
+    assert docker.requests == 3
+    assert set(container.timings) == {'start', 'ready'}
+
+    # a running container is reused
+    warm = AquariumContainer(container.container_id, url=docker.url,
+                             docker=docker, delay=0.01)
+    assert not warm.start()
+    assert docker.runs == 1
+    assert warm.start(reset=True)
+    assert docker.runs == 2
+
+    assert warm.stop()
+    assert docker.kills == ['aq1']
+    assert 'stop' in warm.timings
+    assert not warm.stop()
+
+
+def test_readiness_probe_backs_off(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(docker_testing.time, 'sleep', sleeps.append)
+    attempts = iter([False] * 5 + [True])
+    wait_until_ready('http://localhost', delay=1, max_delay=4,
+                     check=lambda url: next(attempts))
+    assert sleeps == [1, 2, 4, 4, 4]
+
+
+def test_readiness_probe_times_out(docker):
+    with pytest.raises(TimeoutError):
+        wait_until_ready(docker.url, timeout=0.2, delay=0.05)
+    assert not docker_testing.probe('http://127.0.0.1:1/', timeout=1)
+
+
+class _Record(object):
+    def __init__(self, interface, data):
+        self.interface = interface
+        self.name = data['name']
+        self.id = None
+
+    def save(self):
+        self.interface.save(self)
+
+
+class _Interface(object):
+    """Model interface rejecting names that are already taken, like
+    Aquarium"""
+
+    def __init__(self):
+        self.records = {}
+        self.saved = []
+        self.lock = threading.Lock()
+
+    def find_by_name(self, name):
+        return self.records.get(name)
+
+    def load(self, data):
+        return _Record(self, data)
+
+    def save(self, rec):
+        with self.lock:
+            if rec.name in self.records:
+                raise Exception("Name has already been taken")
+            rec.id = len(self.records) + 1
+            self.records[rec.name] = rec
+            self.saved.append(rec.name)
+
+
+class _Session(object):
+    def __init__(self):
+        self.SampleType = _Interface()
+        self.ObjectType = _Interface()
+
+
+class _Protocol(object):
+    def __init__(self, path, name, sample_types):
+        self.path = str(path)
+        self.name = name
+        os.makedirs(os.path.join(self.path, 'testing'))
+        with open(os.path.join(self.path, 'testing', 'data.json'), 'w') as f:
+            json.dump({'records': {
+                'sample_types': [{'tag': st.lower() + '_st',
+                                  'data': {'name': st}}
+                                 for st in sample_types],
+                'object_types': [{'tag': 'stripwell_ot',
+                                  'data': {'name': 'Stripwell'}}]}}, f)
+
+    def open_file(self, path, mode='r'):
+        return open(os.path.join(self.path, path), mode)
+
+
+def test_shared_records_are_created_once(tmpdir):
+    session = _Session()
+    protocols = [
+        _Protocol(tmpdir.join('pcr'), 'Make PCR', ['Fragment', 'Primer']),
+        _Protocol(tmpdir.join('gel'), 'Run Gel', ['Fragment']),
+    ]
+    docker_testing.load_shared_records(protocols, session)
+    assert session.SampleType.saved == ['Fragment', 'Primer']
+    assert session.ObjectType.saved == ['Stripwell']
+
+    def load(protocol):
+        return docker_testing.get_records(
+            session, protocol, docker_testing.read_test_data(protocol)[
+                'records'], docker_testing.SHARED_RECORDS)
+
+    results = list(imap_ordered(load, protocols, workers=2))
+    assert all(r.ok for r in results)
+    assert results[0].value['fragment_st'] is \
+        results[1].value['fragment_st']
+    assert session.SampleType.saved == ['Fragment', 'Primer']
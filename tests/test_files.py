@@ -0,0 +1,34 @@
+"""Tests for atomic, write-if-changed file writes"""
+
+import os
+
+from parrotfish.utils.files import FileWriter, write_if_changed
+
+
+def test_unchanged_files_are_not_rewritten(tmpdir):
+    path = str(tmpdir.join('protocol.rb'))
+    assert write_if_changed(path, 'log "hello"')
+    os.utime(path, (0, 0))
+
+    assert not write_if_changed(path, 'log "hello"')
+    assert os.stat(path).st_mtime == 0
+
+    assert write_if_changed(path, 'log "goodbye"')
+    assert tmpdir.join('protocol.rb').read() == 'log "goodbye"'
+
+
+def test_writes_leave_no_temporary_files(tmpdir):
+    write_if_changed(str(tmpdir.join('a', 'b.json')), '{}')
+    assert tmpdir.join('a').listdir() == [tmpdir.join('a', 'b.json')]
+
+
+def test_writer_counts_modified_files(tmpdir):
+    writer = FileWriter()
+    writer.write(str(tmpdir.join('a.rb')), 'a')
+    writer.dump_json(str(tmpdir.join('a.json')), {'name': 'a'}, indent=4)
+    writer.write(str(tmpdir.join('a.rb')), 'a')
+    writer.dump_json(str(tmpdir.join('a.json')), {'name': 'a'}, indent=4)
+    assert (writer.modified, writer.unchanged) == (2, 2)
+
+    writer.reset()
+    assert (writer.modified, writer.unchanged) == (0, 0)
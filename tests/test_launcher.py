@@ -0,0 +1,48 @@
+"""Tests for answering trivial commands without loading the environment"""
+
+import json
+import os
+import subprocess
+import sys
+
+from parrotfish.launcher import run_quick, SESSION_REGISTRY
+
+
+def write_settings(tmpdir, sessions=None):
+    root = tmpdir.mkdir('FishTank')
+    meta = tmpdir.join('settings.json')
+    meta.write(json.dumps({'root': str(root)}))
+    if sessions is not None:
+        root.join(SESSION_REGISTRY).write(json.dumps({'sessions': sessions}))
+    return str(tmpdir), 'settings.json'
+
+
+def test_quick_commands(tmpdir):
+    meta_dir, meta_name = write_settings(tmpdir, sessions={
+        'nursery': {'name': 'nursery', 'login': 'user',
+                    'aquarium_url': 'http://localhost'}})
+    assert run_quick(['repo'], meta_dir, meta_name)
+    assert run_quick(['sessions'], meta_dir, meta_name)
+
+
+def test_other_commands_are_not_handled(tmpdir):
+    meta_dir, meta_name = write_settings(tmpdir)
+    assert not run_quick(['fetch', 'Cloning'], meta_dir, meta_name)
+    assert not run_quick(['repo', '--help'], meta_dir, meta_name)
+
+    # legacy sessions without a registry need the full environment
+    assert not run_quick(['sessions'], meta_dir, meta_name)
+
+    # nothing to read yet
+    assert not run_quick(['repo'], str(tmpdir), 'missing.json')
+
+
+def test_core_import_is_light():
+    heavy = ['pydent', 'dill', 'cryptography', 'prompt_toolkit', 'fire',
+             'opath', 'inflection']
+    code = "import sys, parrotfish.core; " \
+           "print(','.join(m for m in {} if m in sys.modules))".format(heavy)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root,
+                                  universal_newlines=True)
+    assert out.strip() == ''
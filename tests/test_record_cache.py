@@ -0,0 +1,102 @@
+"""Tests for the record identity map and record store"""
+
+import os
+import threading
+
+from parrotfish.utils.record_cache import RecordCache, RecordStore
+
+
+class SampleType(object):
+
+    def __init__(self, id, updated_at='2018-01-01'):
+        self.id = id
+        self.updated_at = updated_at
+
+
+def test_add_returns_one_instance_per_record():
+    cache = RecordCache()
+    first = SampleType(1)
+    assert cache.add(first) is first
+    assert cache.add(SampleType(1)) is first
+    assert cache.add_records([SampleType(2), None, SampleType(1)])[2] is first
+
+
+def test_records_are_dumped_once():
+    cache = RecordCache()
+    calls = []
+    lock = threading.Lock()
+
+    def dumper(rec):
+        with lock:
+            calls.append(rec.id)
+        return {'id': rec.id}
+
+    threads = [threading.Thread(target=cache.dump,
+                                args=(SampleType(i % 3), dumper))
+               for i in range(30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(calls) == [0, 1, 2]
+
+
+def test_persisted_dumps_are_reused_until_updated(tmpdir):
+    path = str(tmpdir.join('cache.json'))
+    cache = RecordCache(path)
+    cache.dump(SampleType(1), lambda rec: {'name': 'Primer'})
+    cache.save()
+
+    reloaded = RecordCache(path)
+    assert reloaded.dump(SampleType(1), None) == {'name': 'Primer'}
+
+    updated = SampleType(1, updated_at='2018-02-01')
+    assert reloaded.dump(updated, lambda rec: {'name': 'DNA'}) == \
+        {'name': 'DNA'}
+
+
+def test_record_store_links_identical_records(tmpdir):
+    store = RecordStore(str(tmpdir.join('.records')))
+    first = tmpdir.join('ot1', 'sample_types', 'Primer.json')
+    second = tmpdir.join('ot2', 'sample_types', 'Primer.json')
+    store.write(str(first), '{"name": "Primer"}')
+    store.write(str(second), '{"name": "Primer"}')
+
+    assert second.read() == '{"name": "Primer"}'
+    assert len(tmpdir.join('.records').listdir()) == 1
+    assert os.path.samefile(str(first), str(second))
+
+    # changed records get a new copy in the next fetch and unused copies
+    # are pruned
+    store = RecordStore(str(tmpdir.join('.records')))
+    store.write(str(first), '{"name": "Primer", "description": ""}')
+    store.write(str(second), '{"name": "Primer", "description": ""}')
+    assert store.prune() == 1
+    assert len(tmpdir.join('.records').listdir()) == 1
+
+
+def test_record_store_copies_without_hard_links(tmpdir, monkeypatch):
+    def link(source, target):
+        raise OSError("hard links are not supported")
+
+    monkeypatch.setattr(os, 'link', link)
+    store = RecordStore(str(tmpdir.join('.records')))
+    first = tmpdir.join('ot1', 'sample_types', 'Primer.json')
+    second = tmpdir.join('ot2', 'sample_types', 'Primer.json')
+    assert store.write(str(first), '{"name": "Primer"}')
+    assert store.write(str(second), '{"name": "Primer"}')
+    assert second.read() == '{"name": "Primer"}'
+    assert not os.path.samefile(str(first), str(second))
+    assert store.copies
+
+    # unchanged copies are left untouched
+    os.utime(str(first), (0, 0))
+    store = RecordStore(str(tmpdir.join('.records')))
+    assert not store.write(str(first), '{"name": "Primer"}')
+    assert first.mtime() == 0
+
+    # records written during the fetch are kept even though nothing links
+    # to them
+    assert store.prune() == 0
+    assert len(tmpdir.join('.records').listdir()) == 1
+    assert RecordStore(str(tmpdir.join('.records'))).prune() == 1
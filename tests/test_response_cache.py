@@ -0,0 +1,96 @@
+"""Tests for the on-disk cache of read-only queries"""
+
+import os
+
+from pydent import AqSession
+
+from parrotfish.utils import response_cache
+from parrotfish.utils.response_cache import ResponseCache
+from parrotfish.utils.transport import Transport
+
+
+# body of every response unless a test changes it
+BODY = '[{"id": 1, "updated_at": "2019-01-01"}]'
+
+
+def _session(tmpdir, server, max_age=600):
+    transport = Transport()
+    transport.adapter = server
+    cache = ResponseCache(str(tmpdir.join('cache')), max_age=max_age)
+    return transport.session(cache=cache), cache
+
+
+def _all(session, model='OperationType'):
+    return session.post('http://localhost/json',
+                        json={'model': model, 'method': 'all'})
+
+
+def test_read_queries_are_served_from_disk(tmpdir, fake_aquarium):
+    server = fake_aquarium(body=BODY, etag='"v1"')
+    session, cache = _session(tmpdir, server)
+    assert _all(session).json() == [{'id': 1, 'updated_at': '2019-01-01'}]
+    response = _all(session)
+    assert response.json() == [{'id': 1, 'updated_at': '2019-01-01'}]
+    assert getattr(response, 'from_cache', False)
+    assert len(server.requests) == 1
+
+    # writes and other models always reach the server
+    session.post('http://localhost/json/save', json={'model': 'Code'})
+    _all(session, model='Code')
+    assert len(server.requests) == 3
+
+    response_cache.set_enabled(False)
+    try:
+        _all(session)
+    finally:
+        response_cache.set_enabled(True)
+    assert len(server.requests) == 4
+
+
+def test_session_queries_are_cached(tmpdir, fake_login, fake_aquarium):
+    session = AqSession('neptune', 'aquarium', 'http://aquarium.test/')
+    server = fake_aquarium(records={'OperationType': [
+        {'id': 1, 'name': 'Make PCR', 'category': 'Cloning'}]})
+    transport = Transport()
+    transport.adapter = server
+    cache = ResponseCache(str(tmpdir))
+    transport.attach(session.utils.aqhttp, cache=cache)
+
+    assert [ot.name for ot in session.OperationType.all()] == ['Make PCR']
+    assert [ot.name for ot in session.OperationType.all()] == ['Make PCR']
+    assert len(server.requests) == 1
+
+
+def test_stale_responses_are_revalidated(tmpdir, fake_aquarium):
+    server = fake_aquarium(body=BODY, etag='"v1"')
+    session, cache = _session(tmpdir, server, max_age=0)
+    _all(session)
+    response = _all(session)
+    assert server.requests[-1].headers['If-None-Match'] == '"v1"'
+    assert response.status_code == 200
+    assert response.json()[0]['id'] == 1
+
+    server.body = '[{"id": 2, "updated_at": "2019-02-01"}]'
+    server.etag = '"v2"'
+    assert _all(session).json()[0]['id'] == 2
+    cache.max_age = 600
+    assert _all(session).json()[0]['id'] == 2
+    assert len(server.requests) == 3
+
+
+def test_least_recently_used_responses_are_evicted(tmpdir):
+    cache = ResponseCache(str(tmpdir))
+    cache.put('a', 'x' * 100)
+    cache.max_size = 2.5 * cache.size()
+    cache.put('b', 'x' * 100)
+    os.utime(str(tmpdir.join('a.json')), (0, 0))
+    cache.put('c', 'x' * 100)
+    assert cache.get('a') is None
+    assert cache.get('b')['body'] == 'x' * 100
+    assert cache.size() <= cache.max_size
+
+    # entries unused for too long are deleted when the cache is opened
+    os.utime(str(tmpdir.join('b.json')), (0, 0))
+    assert ResponseCache(str(tmpdir)).get('c') is not None
+    assert ResponseCache(str(tmpdir), expire=60).clear() == 1
+    assert not tmpdir.join('b.json').exists()
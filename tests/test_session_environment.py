@@ -1,8 +1,14 @@
 """Tests session managment"""
 
+from parrotfish.core import CLI
 from parrotfish.session_environment import SessionEnvironment, SessionManager
+from parrotfish.utils import sync
+from parrotfish.utils.transport import Transport
+from parrotfish.utils.workers import imap_ordered
 from pydent import AqSession
 import os
+from types import SimpleNamespace
+import dill
 from cryptography.fernet import Fernet
 
 
@@ -102,4 +108,231 @@ def test_session_manager_save_and_load(sm, credentials):
     copied_sm = SessionManager(sm.abspath, meta_dir=sm.metadata.abspath, meta_name=sm.metadata.env_settings.name)
     copied_sm.load()
     assert len(copied_sm._children) == len(sm._children)
-    assert copied_sm.sessions.keys() == sm.sessions.keys()
\ No newline at end of file
+    assert copied_sm.sessions.keys() == sm.sessions.keys()
+
+
+def test_session_manager_saves_only_when_changed(sm):
+    sm.save()
+    settings = sm.metadata.env_settings
+    before = settings.load_json()
+
+    copied_sm = SessionManager(sm.abspath, meta_dir=sm.metadata.abspath,
+                               meta_name=settings.name)
+    copied_sm.load()
+    assert not copied_sm.is_dirty
+    assert not copied_sm.save()
+    assert settings.load_json() == before
+
+    assert copied_sm.save(force=True)
+    assert settings.load_json()['updated_at'] != before['updated_at']
+
+
+def test_session_manager_caches_settings(sm):
+    sm.save()
+    settings = sm.metadata.env_settings
+    assert sm._read_settings() is sm._read_settings()
+
+    sm.set_container_id('abc')
+    assert sm.get_container_id() == 'abc'
+    assert settings.load_json()['container_id'] == 'abc'
+
+    # changes made by another process are picked up
+    data = settings.load_json()
+    data['container_id'] = 'xyz'
+    settings.dump_json(data)
+    path = str(settings.abspath)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert sm.get_container_id() == 'xyz'
+
+
+def test_response_cache_settings_are_registered(tmpdir):
+    key = Fernet.generate_key()
+    env = SessionEnvironment('nursery', 'user', None, 'http://localhost', key,
+                             encrypted_password=Fernet(key).encrypt(b'pw'))
+    env.set_dir(str(tmpdir))
+    assert env.get_response_cache() is None
+    assert 'response_cache' not in env.to_registry()
+
+    env.set_response_cache(True, max_age=60)
+    entry = env.to_registry()
+    assert entry['response_cache']['max_age'] == 60
+    loaded = SessionEnvironment.from_registry(entry, key)
+    loaded.set_dir(str(tmpdir))
+    assert loaded.get_response_cache().max_age == 60
+
+
+def _reload(sm):
+    loaded = SessionManager(sm.abspath, meta_dir=sm.metadata.abspath,
+                            meta_name=sm.metadata.env_settings.name)
+    loaded.load()
+    return loaded
+
+
+def test_registry_keeps_the_encrypted_password(sm, fake_login):
+    logins = fake_login
+    sm.register_session('alice', 'secret', 'http://aquarium.test/',
+                        'nursery')
+    sm.save()
+    encrypted = sm.get('nursery').encrypted_password
+    assert 'secret' not in sm.session_registry.read()
+
+    loaded = _reload(sm)
+    env = loaded.get('nursery')
+    assert env.encrypted_password == encrypted
+    assert env.login == 'alice'
+    assert env.aquarium_url == 'http://aquarium.test/'
+    assert not env.is_logged_in
+
+    # the password is decrypted with the key saved in the settings
+    key = loaded.metadata.env_settings.load_json()['encryption_key']
+    assert Fernet(key.encode()).decrypt(encrypted) == b'secret'
+    assert env.aquarium_session is not None
+    assert logins == ['alice', 'alice']
+
+
+def test_pickled_sessions_are_converted(sm):
+    sm.save()
+    # older versions only wrote the settings and the pickles
+    os.remove(str(sm.session_registry.abspath))
+    key = sm.metadata.env_settings.load_json()['encryption_key'].encode()
+    encrypted = Fernet(key).encrypt(b'secret')
+    env_dir = os.path.join(str(sm.abspath), 'nursery')
+    os.makedirs(env_dir)
+    env_pkl = os.path.join(env_dir, SessionEnvironment.ENV_PKL)
+    with open(env_pkl, 'wb') as f:
+        dill.dump(SimpleNamespace(name='nursery', login='alice',
+                                  aquarium_url='http://aquarium.test/',
+                                  encrypted_password=encrypted), f)
+
+    loaded = _reload(sm)
+    assert list(loaded.sessions) == ['nursery']
+    assert loaded.get('nursery').encrypted_password == encrypted
+    assert sm.session_registry.exists()
+
+    # the registry is used from now on
+    os.remove(env_pkl)
+    assert _reload(sm).get('nursery').login == 'alice'
+
+
+def test_sessions_are_logged_in_lazily(sm, fake_login):
+    logins = fake_login
+    sm.register_session('alice', 'pw', 'http://aquarium.test/', 'nursery')
+    sm.register_session('bob', 'pw', 'http://aquarium.test/', 'production')
+    sm.set_current('production')
+    sm.save()
+    # registering checks the credentials
+    assert logins == ['alice', 'bob']
+    del logins[:]
+
+    loaded = SessionManager(sm.abspath, meta_dir=sm.metadata.abspath,
+                            meta_name=sm.metadata.env_settings.name)
+    loaded.load()
+    cli = CLI(loaded)
+    assert set(cli.sessions) == {'nursery', 'production'}
+    cli.ls()
+    assert logins == []
+
+    # concurrent first accesses log in once
+    env = loaded.get('nursery')
+    results = list(imap_ordered(lambda _: env.aquarium_session, range(8), 8))
+    assert all(r.ok for r in results)
+    assert len({id(r.value) for r in results}) == 1
+    assert logins == ['alice']
+    assert not loaded.get('production').is_logged_in
+
+
+def _records():
+    """Records of a fake Aquarium with two OperationTypes and a Library"""
+    afts = [(1, 5, 6), (2, 5, 6), (2, 7, 6)]
+    accessors = ['protocol', 'precondition', 'documentation', 'cost_model']
+    return {
+        'OperationType': [{'id': i, 'name': 'Make PCR {}'.format(i),
+                           'category': 'Cloning'} for i in (1, 2)],
+        'Library': [{'id': 3, 'name': 'Cloning Lib', 'category': 'Cloning'}],
+        'Code': [{'id': 10 * i + j, 'parent_class': 'OperationType',
+                  'parent_id': i, 'name': name, 'child_id': None,
+                  'content': '# {} {}'.format(name, i)}
+                 for i in (1, 2) for j, name in enumerate(accessors)] +
+                [{'id': 30, 'parent_class': 'Library', 'parent_id': 3,
+                  'name': 'source', 'child_id': None,
+                  'content': '# source 3'}],
+        'FieldType': [{'id': 100 + i, 'parent_class': 'OperationType',
+                       'parent_id': i, 'name': 'Fragment', 'role': 'input',
+                       'routing': 'F', 'ftype': 'sample'} for i in (1, 2)],
+        'AllowableFieldType': [{'id': 200 + n, 'field_type_id': 100 + i,
+                                'sample_type_id': st, 'object_type_id': ot}
+                               for n, (i, st, ot) in enumerate(afts)],
+        'SampleType': [{'id': 5, 'name': 'Fragment'},
+                       {'id': 7, 'name': 'Plasmid'}],
+        'ObjectType': [{'id': 6, 'name': 'Stripwell'}],
+    }
+
+
+def _fake_env(tmpdir, monkeypatch, server):
+    """Returns an environment whose session queries the fake server. The
+    names of the shared records it writes are added to `env.written`."""
+    session = AqSession('neptune', 'aquarium', 'http://aquarium.test/')
+    transport = Transport()
+    transport.adapter = server
+    transport.attach(session.utils.aqhttp)
+
+    key = Fernet.generate_key()
+    env = SessionEnvironment('nursery', 'neptune', None,
+                             'http://aquarium.test/', key,
+                             encrypted_password=Fernet(key).encrypt(b'pw'))
+    env.aquarium_session = session
+    env.set_dir(str(tmpdir))
+    env.written = []
+    monkeypatch.setattr(env, 'write_records_to_dir',
+                        lambda target_dir, records: env.written.append(
+                            sorted(set(r.name for r in records))))
+    return env
+
+
+def test_shared_records_are_fetched_once(tmpdir, monkeypatch, fake_login,
+                                         fake_aquarium):
+    server = fake_aquarium(records=_records())
+    env = _fake_env(tmpdir, monkeypatch, server)
+    session = env.aquarium_session
+
+    def record_queries():
+        queries = [q for q in server.queries
+                   if q[0] in ('SampleType', 'ObjectType')]
+        del server.queries[:]
+        return queries
+
+    for ot in session.OperationType.all():
+        env.write_operation_type(ot)
+    assert record_queries() == [('SampleType', {'id': [5]}),
+                                ('ObjectType', {'id': [6]}),
+                                ('SampleType', {'id': [7]})]
+    assert env.written == [['Fragment'], ['Stripwell'],
+                       ['Fragment', 'Plasmid'], ['Stripwell']]
+
+    meta = env.get_operation_type_dir('Cloning', 'Make PCR 1').meta
+    aft = meta.load_json()['field_types'][0]['allowable_field_types'][0]
+    assert aft['sample_type']['name'] == 'Fragment'
+    assert aft['object_type_tag'] == 'stripwell_ot'
+
+
+def test_snapshot_codes_are_not_loaded_again(tmpdir, monkeypatch, fake_login,
+                                            fake_aquarium):
+    server = fake_aquarium(records=_records())
+    env = _fake_env(tmpdir, monkeypatch, server)
+    session = env.aquarium_session
+    models = session.OperationType.all() + session.Library.all()
+    snapshot = sync.latest_codes_for(session, models)
+    del server.queries[:]
+
+    for model in models:
+        env.write_model(model, codes=snapshot[(model.__class__.__name__,
+                                               model.id)])
+    assert [q for q in server.queries if q[0] == 'Code'] == []
+
+    ot_dir = env.get_operation_type_dir('Cloning', 'Make PCR 2')
+    assert ot_dir.get('cost_model').read() == '# cost_model 2'
+    assert ot_dir.meta.load_json()['protocol']['id'] == 20
+    lib_dir = env.get_library_type_dir('Cloning', 'Cloning Lib')
+    assert lib_dir.source.read() == '# source 3'
+    assert lib_dir.meta.load_json()['source']['id'] == 30
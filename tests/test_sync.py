@@ -0,0 +1,239 @@
+"""Tests for the sync manifest"""
+
+import os
+
+from parrotfish.utils.sync import (SyncManifest, hash_file, iter_pages,
+                                   latest_codes_for, session_status)
+
+
+class _Model(object):
+    def __init__(self, id, name, updated_at='2018-01-01'):
+        self.id = id
+        self.name = name
+        self.category = 'ParrotFishTest'
+        self.updated_at = updated_at
+
+
+class OperationType(_Model):
+    pass
+
+
+class Library(_Model):
+    pass
+
+
+class _Code(object):
+    def __init__(self, id, parent_id, name):
+        self.id = id
+        self.parent_id = parent_id
+        self.name = name
+
+
+class _CodeInterface(object):
+    def __init__(self, codes):
+        self.codes = codes
+        self.queries = []
+
+    def where(self, query):
+        self.queries.append(query)
+        return [c for c in self.codes if c.parent_id in query['parent_id']]
+
+
+class _Session(object):
+    def __init__(self, codes):
+        self.Code = _CodeInterface(codes)
+
+
+def test_manifest_detects_changes(tmpdir):
+    path = os.path.join(str(tmpdir), '.sync_manifest.json')
+    manifest = SyncManifest(path)
+    ot = OperationType(1, 'Protocol1')
+    codes = {'protocol': _Code(10, 1, 'protocol')}
+
+    assert not manifest.is_current(ot, codes)
+    manifest.record(ot, codes)
+    assert manifest.is_current(ot, codes)
+
+    # new code version on the server
+    assert not manifest.is_current(ot, {'protocol': _Code(11, 1, 'protocol')})
+
+    # OperationType itself updated
+    assert not manifest.is_current(
+        OperationType(1, 'Protocol1', updated_at='2019-01-01'), codes)
+
+
+def test_manifest_saves_only_when_changed(tmpdir):
+    path = os.path.join(str(tmpdir), '.sync_manifest.json')
+    manifest = SyncManifest(path)
+    manifest.save()
+    assert not os.path.exists(path)
+
+    ot = OperationType(1, 'Protocol1')
+    codes = {'protocol': _Code(10, 1, 'protocol')}
+    manifest.record(ot, codes)
+    manifest.save()
+    assert SyncManifest(path).is_current(ot, codes)
+
+
+def test_latest_codes_uses_one_query_per_model():
+    session = _Session([_Code(10, 1, 'protocol'), _Code(11, 1, 'precondition'),
+                        _Code(12, 2, 'protocol'), _Code(20, 5, 'source')])
+    models = [OperationType(1, 'P1'), OperationType(2, 'P2'), Library(5, 'L')]
+    snapshot = latest_codes_for(session, models)
+    assert len(session.Code.queries) == 2
+    assert set(snapshot[('OperationType', 1)]) == {'protocol', 'precondition'}
+    assert snapshot[('Library', 5)]['source'].id == 20
+
+
+def test_manifest_tracks_local_file_hashes(tmpdir):
+    path = os.path.join(str(tmpdir), '.sync_manifest.json')
+    manifest = SyncManifest(path)
+    ot = OperationType(1, 'Protocol1')
+    codes = {'protocol': _Code(10, 1, 'protocol'),
+             'precondition': _Code(11, 1, 'precondition')}
+    hashes = {'protocol': 'aaa', 'precondition': 'bbb'}
+    protocol_path = 'protocols/ParrotFishTest/Protocol1'
+
+    # never recorded, so everything is changed
+    assert set(manifest.changed_files(protocol_path, hashes)) == set(hashes)
+
+    manifest.record(ot, codes, path=protocol_path, hashes=hashes)
+    assert manifest.changed_files(protocol_path, hashes) == []
+
+    edited = dict(hashes, protocol='ccc')
+    assert manifest.changed_files(protocol_path, edited) == ['protocol']
+
+    # pushing records the new hash
+    manifest.record_code('OperationType', 1, 'protocol', 12, 'ccc')
+    assert manifest.changed_files(protocol_path, edited) == []
+    assert manifest.get('OperationType', 1)['codes']['protocol']['id'] == 12
+
+
+def test_pushing_recreates_missing_entries(tmpdir):
+    path = os.path.join(str(tmpdir), '.sync_manifest.json')
+    manifest = SyncManifest(path)
+    protocol_path = 'protocols/ParrotFishTest/Protocol1'
+    hashes = {'protocol': 'aaa', 'precondition': 'bbb'}
+
+    manifest.record_code('OperationType', 1, 'protocol', 10, 'aaa',
+                         path=protocol_path)
+    assert manifest.changed_files(protocol_path, hashes) == ['precondition']
+    manifest.record_code('OperationType', 1, 'precondition', 11, 'bbb',
+                         path=protocol_path)
+    manifest.save()
+
+    entry = SyncManifest(path).get_by_path(protocol_path)
+    assert entry['model'] == 'OperationType' and entry['id'] == 1
+    assert entry['codes'] == {'protocol': {'id': 10, 'hash': 'aaa'},
+                              'precondition': {'id': 11, 'hash': 'bbb'}}
+
+
+def test_hash_file(tmpdir):
+    f = tmpdir.join('protocol.rb')
+    f.write('content')
+    assert hash_file(str(f)) == hash_file(str(f))
+    assert hash_file(str(tmpdir.join('missing.rb'))) is None
+
+
+def test_session_status(tmpdir):
+    manifest = SyncManifest(os.path.join(str(tmpdir), '.sync_manifest.json'))
+    protocol_hash = hash_file(__file__)
+
+    def code(id, parent_id, content=''):
+        c = _Code(id, parent_id, 'protocol')
+        c.content = content
+        return c
+
+    def local(id, name, file_hash):
+        return {'name': 'ParrotFishTest/' + name, 'model': 'OperationType',
+                'id': id, 'path': name, 'hashes': {'protocol': file_hash}}
+
+    models = [OperationType(i, 'Protocol{}'.format(i)) for i in range(1, 6)]
+    snapshot = {('OperationType', m.id): {'protocol': code(m.id * 10, m.id)}
+                for m in models}
+    for m in models[:4]:
+        manifest.record(m, snapshot[('OperationType', m.id)], path=m.name,
+                        hashes={'protocol': protocol_hash})
+
+    # Protocol2 and 3 have new code on the server
+    for i in (2, 3):
+        snapshot[('OperationType', i)] = {'protocol': code(i * 10 + 1, i)}
+    snapshot[('OperationType', 7)] = {'protocol': code(70, 7)}
+    # Protocol5 was never recorded but has the same content
+    with open(__file__) as f:
+        snapshot[('OperationType', 5)] = {'protocol': code(50, 5, f.read())}
+
+    report = session_status(
+        [local(1, 'Protocol1', protocol_hash),
+         local(2, 'Protocol2', protocol_hash),
+         local(3, 'Protocol3', 'edited'),
+         local(4, 'Protocol4', 'edited'),
+         local(5, 'Protocol5', protocol_hash),
+         local(None, 'Protocol6', 'new')],
+        models[1:] + [OperationType(7, 'Protocol7')], snapshot, manifest)
+    assert report['clean'] == ['ParrotFishTest/Protocol5']
+    assert report['remote_modified'] == ['ParrotFishTest/Protocol2']
+    assert report['conflicting'] == ['ParrotFishTest/Protocol3']
+    assert report['local_modified'] == ['ParrotFishTest/Protocol4']
+    assert report['local_only'] == ['ParrotFishTest/Protocol1',
+                                    'ParrotFishTest/Protocol6']
+    assert report['remote_only'] == ['ParrotFishTest/Protocol7']
+
+
+class _PagedInterface(object):
+    """Evaluates keyset queries the way ActiveRecord would"""
+
+    def __init__(self, models):
+        self.models = models
+        self.queries = []
+
+    def where(self, criteria, opts=None):
+        self.queries.append((criteria, opts))
+        values = list(criteria[1:])
+        tests = []
+        for condition in criteria[0].split(' AND '):
+            key, op = condition.split(' ')[:2]
+            if op == 'IS':
+                tests.append((key, lambda a: a is None))
+            elif op == 'IN':
+                tests.append((key, lambda a, v=values.pop(0): a in v))
+            elif op == '>':
+                tests.append((key, lambda a, v=values.pop(0): a > v))
+            else:
+                tests.append((key, lambda a, v=values.pop(0): a == v))
+        matching = sorted((m for m in self.models
+                           if all(test(getattr(m, key))
+                                  for key, test in tests)),
+                          key=lambda m: m.id)
+        return matching[:opts['limit']]
+
+
+def test_iter_pages():
+    models = [OperationType(i, str(i)) for i in (4, 1, 5, 2, 3)]
+    interface = _PagedInterface(models)
+    pages = iter_pages(interface, {'category': 'ParrotFishTest'}, page_size=2)
+    assert [[m.id for m in page] for page in pages] == [[1, 2], [3, 4], [5]]
+    assert [q[0] for q in interface.queries] == [
+        ['category = ? AND id > ?', 'ParrotFishTest', last_id]
+        for last_id in (0, 2, 4)]
+    assert interface.queries[0][1] == {'limit': 2, 'order': 'id'}
+
+    # a model created before the last listed id is not listed twice
+    interface = _PagedInterface([OperationType(i, str(i))
+                                 for i in (2, 3, 4, 5)])
+    pages = iter_pages(interface, {}, page_size=2)
+    first = next(pages)
+    interface.models.append(OperationType(1, '1'))
+    ids = [m.id for m in first] + [m.id for page in pages for m in page]
+    assert ids == [2, 3, 4, 5]
+
+
+def test_iter_pages_when_models_are_removed():
+    # removing a listed model does not shift the next page
+    interface = _PagedInterface([OperationType(i, str(i))
+                                 for i in range(1, 6)])
+    pages = iter_pages(interface, {'id': [1, 2, 3, 4, 5]}, page_size=2)
+    first = next(pages)
+    del interface.models[0]
+    ids = [m.id for m in first] + [m.id for page in pages for m in page]
+    assert ids == [1, 2, 3, 4, 5]
@@ -31,3 +31,54 @@ def test_run_random_ops(sm, credentials):
 
     result = testing_tools.run_operation_test_with_random(ot, 5)
     pass
+
+
+class _Record(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class _Interface(object):
+    def __init__(self, names):
+        self.names = names
+        self.queries = []
+
+    def where(self, query):
+        self.queries.append(query)
+        return [_Record(i, self.names[i]) for i in query['id']]
+
+
+class _Session(object):
+    def __init__(self):
+        self.SampleType = _Interface({1: 'Primer', 2: 'Plasmid'})
+        self.ObjectType = _Interface({10: 'Primer Stock'})
+
+
+def test_tagify_resolves_ids_in_bulk():
+    session = _Session()
+    table = testing_tools.TagTable(session)
+    data = {
+        'name': 'Protocol3',
+        'field_types': [
+            {'parent_class': 'OperationType',
+             'allowable_field_types': [
+                 {'sample_type_id': 1, 'object_type_id': 10},
+                 {'sample_type_id': 2, 'object_type_id': 10}]},
+            {'parent_class': 'OperationType',
+             'allowable_field_types': [
+                 {'sample_type_id': 1, 'object_type_id': None}]}
+        ]
+    }
+    tagged = testing_tools.tagify(data, session, table)
+    afts = [aft for ft in tagged['field_types']
+            for aft in ft['allowable_field_types']]
+    assert afts[0] == {'sample_type_tag': 'primer_st',
+                       'object_type_tag': 'primer stock_ot'}
+    assert afts[1]['sample_type_tag'] == 'plasmid_st'
+    assert len(session.SampleType.queries) == 1
+    assert len(session.ObjectType.queries) == 1
+
+    # names are remembered between calls
+    testing_tools.tagify({'sample_type_id': 2}, session, table)
+    assert len(session.SampleType.queries) == 1
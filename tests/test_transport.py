@@ -0,0 +1,91 @@
+"""Tests for the shared HTTP transport"""
+
+import gzip
+
+import requests
+
+from pydent import AqSession
+
+from parrotfish.utils.transport import CompressingAdapter, Transport
+
+
+def test_sessions_share_pools_and_keep_cookies(fake_login, fake_aquarium):
+    transport = Transport(pool_size=2)
+    transport.adapter = fake_aquarium(body='{"id": 1, "name": "Make PCR"}')
+    session1 = AqSession('alice', 'pw', 'http://aquarium.test/')
+    session2 = AqSession('bob', 'pw', 'http://aquarium.test/')
+    aqhttp1 = transport.attach(session1.utils.aqhttp)
+    aqhttp2 = transport.attach(session2.utils.aqhttp)
+    assert aqhttp1._requests_session.get_adapter('http://aquarium.test/') is \
+        aqhttp2._requests_session.get_adapter('http://aquarium.test/')
+
+    # queries of real sessions go through the shared adapter
+    assert session1.OperationType.find(1).name == 'Make PCR'
+    session2.OperationType.find(1)
+    requests_sent = transport.adapter.requests
+    assert [r.url for r in requests_sent] == ['http://aquarium.test/json'] * 2
+    assert requests_sent[0].headers['Cookie'] == 'remember_token=alice'
+    assert requests_sent[1].headers['Cookie'] == 'remember_token=bob'
+    assert aqhttp1.num_requests == 1
+
+
+def test_pools_grow_with_workers():
+    transport = Transport(pool_size=2)
+    transport.configure_host('http://slow', max_connections=1)
+    transport.configure_host('http://gzip', compress_requests=True)
+    old = transport.adapter.poolmanager
+    old.connection_from_url('http://localhost')
+    transport.ensure_pool_size(8)
+    assert transport.adapter._pool_maxsize == 8
+    assert transport.host_adapters['http://gzip']._pool_maxsize == 8
+    assert transport.host_adapters['http://slow']._pool_maxsize == 1
+    # the idle connections of the replaced pools are closed
+    assert len(old.pools) == 0
+
+    session = transport.session()
+    assert session.get_adapter('http://slow/api') is \
+        transport.host_adapters['http://slow']
+    assert session.get_adapter('http://other/api') is transport.adapter
+
+
+def test_hosts_are_configured_from_the_session_settings(monkeypatch,
+                                                        fake_login):
+    from parrotfish.session_environment import SessionEnvironment
+    from parrotfish.utils import transport as transport_module
+    from cryptography.fernet import Fernet
+
+    transport = Transport(pool_size=2)
+    monkeypatch.setattr(transport_module, '_TRANSPORT', transport)
+    key = Fernet.generate_key()
+    env = SessionEnvironment('neptune', 'neptune', 'aquarium',
+                             'http://aquarium.test/', key)
+    env.set_transport(max_connections=3, compress_requests=True)
+    adapter = transport.host_adapters['http://aquarium.test/']
+    assert adapter._pool_maxsize == 3 and adapter.compress_requests
+    aqhttp = env.aquarium_session.utils.aqhttp
+    assert aqhttp._requests_session.get_adapter(
+        'http://aquarium.test/json') is adapter
+
+    # the settings are kept in the session registry
+    entry = env.to_registry()
+    assert entry['transport'] == {'max_connections': 3,
+                                  'compress_requests': True}
+    copy = SessionEnvironment.from_registry(entry, key)
+    assert copy.transport_settings == entry['transport']
+
+    env.set_transport()
+    assert 'http://aquarium.test/' not in transport.host_adapters
+    assert 'transport' not in env.to_registry()
+
+
+def test_large_request_bodies_are_compressed():
+    adapter = CompressingAdapter(compress_requests=True, compress_min_size=10)
+    request = requests.Request('POST', 'http://localhost',
+                               json={'content': 'x' * 100}).prepare()
+    body = request.body
+    assert adapter.compress(request)
+    assert request.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(request.body) == body
+
+    small = requests.Request('POST', 'http://localhost', json={}).prepare()
+    assert not adapter.compress(small)
@@ -0,0 +1,39 @@
+"""Tests for the polling file watcher"""
+
+import os
+
+from parrotfish.utils.watch import PollingWatcher
+
+
+def touch(path, content, mtime):
+    path.write(content, ensure=True)
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_poll_reports_modified_code_files(tmpdir):
+    protocol = tmpdir.join('Cloning', 'Make PCR')
+    touch(protocol.join('Make PCR.rb'), 'a', 1)
+    touch(protocol.join('Make PCR.json'), '{}', 1)
+    watcher = PollingWatcher(str(tmpdir))
+    assert watcher.poll() == set()
+
+    touch(protocol.join('Make PCR.rb'), 'b', 2)
+    touch(protocol.join('Make PCR.json'), '{"id": 1}', 2)
+    touch(protocol.join('Make PCR__documentation.md'), 'docs', 2)
+    touch(tmpdir.join('.records', 'abc.rb'), 'a', 2)
+    assert watcher.poll() == {str(protocol.join('Make PCR.rb')),
+                              str(protocol.join('Make PCR__documentation.md'))}
+
+
+def test_changes_are_debounced(tmpdir):
+    code = tmpdir.join('Cloning', 'Make PCR', 'Make PCR.rb')
+    touch(code, 'a', 1)
+    watcher = PollingWatcher(str(tmpdir), debounce=1.0)
+
+    touch(code, 'b', 2)
+    assert watcher.step(now=10.0) == []
+    touch(code, 'c', 3)
+    assert watcher.step(now=10.5) == []
+    assert watcher.step(now=11.0) == []
+    assert watcher.step(now=11.5) == [str(code)]
+    assert watcher.step(now=20.0) == []
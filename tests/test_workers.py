@@ -0,0 +1,57 @@
+"""Tests for the bounded worker pool"""
+
+import threading
+import time
+
+from parrotfish.utils.workers import imap_ordered, map_ordered
+
+
+def test_results_keep_input_order():
+    def slow_for_small(x):
+        time.sleep(0.01 * (5 - x))
+        return x * 2
+
+    results = map_ordered(slow_for_small, range(5), workers=4)
+    assert [r.item for r in results] == list(range(5))
+    assert [r.value for r in results] == [0, 2, 4, 6, 8]
+
+
+def test_failures_are_collected():
+    def fail_on_odd(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+
+    results = map_ordered(fail_on_odd, range(6), workers=3)
+    assert [r.ok for r in results] == [True, False] * 3
+    assert all(isinstance(r.error, ValueError) for r in results if not r.ok)
+
+
+def test_concurrency_is_bounded():
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def track(x):
+        with lock:
+            active.append(x)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.remove(x)
+
+    map_ordered(track, range(20), workers=3)
+    assert max(peak) <= 3
+
+
+def test_items_are_consumed_lazily():
+    pulled = []
+
+    def gen():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    results = imap_ordered(lambda x: x, gen(), workers=2)
+    next(results)
+    assert len(pulled) < 100